@@ -0,0 +1,16 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def inline_thumbnails(settings):
+    """В тестах миниатюры строятся сразу, а не в фоновом пуле: иначе
+    пул пишет в MEDIA_ROOT, который фикстура уже удаляет."""
+    settings.THUMBNAIL_WORKERS = 0
+
+
+@pytest.fixture(autouse=True, scope='session')
+def isolated_caches():
+    """Тесты чистят кэш: пусть это будет временный, а не кэш сайта."""
+    from core.testing import temporary_caches
+    with temporary_caches():
+        yield
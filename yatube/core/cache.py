@@ -0,0 +1,250 @@
+"""Кэш на SQLite в режиме WAL, общий для всех процессов на хосте.
+
+LocMemCache у каждого воркера свой: с ростом числа воркеров падает доля
+попаданий, а инвалидация не доходит до соседних процессов. Этот бэкенд
+хранит записи в одном файле SQLite, поэтому все воркеры видят одни и те же
+ключи (в том числе счётчики поколений лент), а внешний сервер не нужен.
+
+Подключение::
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'core.cache.SQLiteCache',
+            'LOCATION': '/var/tmp/yatube-cache.sqlite3',
+            'OPTIONS': {'MAX_ENTRIES': 100000, 'MAX_SIZE': 256 * 2 ** 20},
+        }
+    }
+
+Вытеснение - LRU по времени последнего чтения; время чтения обновляется
+не чаще раза в ``TOUCH_INTERVAL`` секунд, чтобы чтения не превращались
+в запись.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires REAL,
+    accessed REAL NOT NULL,
+    size INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires);
+'''
+
+
+class SQLiteCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._path = location
+        self._max_size = int(options.get('MAX_SIZE', 0)) or None
+        self._touch_interval = float(options.get('TOUCH_INTERVAL', 10))
+        self._cull_every = int(options.get('CULL_EVERY', 100))
+        self._busy_timeout = float(options.get('BUSY_TIMEOUT', 5))
+        # у каждого потока своё соединение: транзакции BEGIN IMMEDIATE
+        # двух потоков на одном соединении перемешались бы
+        self._local = threading.local()
+        self._writes = 0
+
+    @property
+    def _db(self):
+        local = self._local
+        # соединение нельзя переносить через fork: открываем заново
+        if getattr(local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(
+                self._path, timeout=self._busy_timeout,
+                isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+            local.connection = connection
+            local.pid = os.getpid()
+        return local.connection
+
+    def _write(self, sql_list):
+        """Выполняет запросы одной транзакцией с блокировкой на запись."""
+        db = self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            result = [db.execute(sql, params) for sql, params in sql_list]
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return result
+
+    @staticmethod
+    def _dumps(value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _row(self, key, value, timeout, now):
+        blob = self._dumps(value)
+        expires = self.get_backend_timeout(timeout)
+        return (key, blob, expires, now, len(blob))
+
+    def _fetch(self, keys):
+        now = time.time()
+        found, stale, touch = {}, [], []
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self._db.execute(
+                'SELECT key, value, expires, accessed FROM cache '
+                'WHERE key IN (%s)' % ','.join('?' * len(chunk)), chunk)
+            for key, blob, expires, accessed in rows:
+                if expires is not None and expires <= now:
+                    stale.append(key)
+                    continue
+                found[key] = pickle.loads(blob)
+                if now - accessed > self._touch_interval:
+                    touch.append(key)
+        if stale or touch:
+            self._write(
+                [('DELETE FROM cache WHERE key = ? AND expires <= ?',
+                  (key, now)) for key in stale]
+                + [('UPDATE cache SET accessed = ? WHERE key = ?',
+                    (now, key)) for key in touch])
+        return found
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return self._fetch([key]).get(key, default)
+
+    def get_many(self, keys, version=None):
+        made = {self.make_key(key, version=version): key for key in keys}
+        for key in made:
+            self.validate_key(key)
+        found = self._fetch(list(made))
+        return {made[key]: value for key, value in found.items()}
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self._set_rows([self._row(key, value, timeout, time.time())])
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        now = time.time()
+        rows = []
+        for key, value in data.items():
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            rows.append(self._row(key, value, timeout, now))
+        self._set_rows(rows)
+        return []
+
+    def _set_rows(self, rows):
+        if not rows:
+            return
+        self._write([(
+            'INSERT OR REPLACE INTO cache (key, value, expires, accessed, '
+            'size) VALUES (?, ?, ?, ?, ?)', row) for row in rows])
+        self._writes += len(rows)
+        if self._writes >= self._cull_every:
+            self._writes = 0
+            self._cull()
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        now = time.time()
+        _, inserted = self._write([
+            ('DELETE FROM cache WHERE key = ? AND expires <= ?', (key, now)),
+            ('INSERT OR IGNORE INTO cache (key, value, expires, accessed, '
+             'size) VALUES (?, ?, ?, ?, ?)',
+             self._row(key, value, timeout, now)),
+        ])
+        return inserted.rowcount == 1
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        now = time.time()
+        updated, = self._write([(
+            'UPDATE cache SET expires = ?, accessed = ? WHERE key = ? '
+            'AND (expires IS NULL OR expires > ?)',
+            (self.get_backend_timeout(timeout), now, key, now))])
+        return updated.rowcount == 1
+
+    def incr(self, key, delta=1, version=None):
+        """Атомарно: чтение и запись идут под одной блокировкой записи."""
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        db = self._db
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                'SELECT value FROM cache WHERE key = ? '
+                'AND (expires IS NULL OR expires > ?)', (key, now)).fetchone()
+            if row is None:
+                raise ValueError("Key '%s' not found" % key)
+            value = pickle.loads(row[0]) + delta
+            blob = self._dumps(value)
+            db.execute(
+                'UPDATE cache SET value = ?, size = ?, accessed = ? '
+                'WHERE key = ?', (blob, len(blob), now, key))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return value
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        row = self._db.execute(
+            'SELECT 1 FROM cache WHERE key = ? '
+            'AND (expires IS NULL OR expires > ?)',
+            (key, time.time())).fetchone()
+        return row is not None
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self._write([('DELETE FROM cache WHERE key = ?', (key,))])
+
+    def delete_many(self, keys, version=None):
+        made = [self.make_key(key, version=version) for key in keys]
+        for key in made:
+            self.validate_key(key)
+        self._write([
+            ('DELETE FROM cache WHERE key = ?', (key,)) for key in made])
+
+    def clear(self):
+        self._write([('DELETE FROM cache', ())])
+
+    def _cull(self):
+        """Удаляет просроченные записи, затем самые давно читанные."""
+        now = time.time()
+        db = self._db
+        self._write([('DELETE FROM cache WHERE expires <= ?', (now,))])
+        count, size = db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache').fetchone()
+        excess = 0
+        if count > self._max_entries:
+            # как в FileBasedCache: сносим долю 1 / cull_frequency
+            excess = max(count - self._max_entries,
+                         count // self._cull_frequency
+                         if self._cull_frequency else count)
+        if self._max_size and size > self._max_size:
+            average = size / count
+            excess = max(excess, int((size - self._max_size) / average) + 1)
+        if excess:
+            self._write([(
+                'DELETE FROM cache WHERE key IN (SELECT key FROM cache '
+                'ORDER BY accessed LIMIT ?)', (excess,))])
+
+    def close(self, **kwargs):
+        # соединение живёт весь процесс, как и сам файл кэша
+        pass
@@ -0,0 +1,62 @@
+"""Межпроцессная блокировка «один делает - остальные ждут» на одном хосте.
+
+Блокировка - ``flock`` на файле, имя которого получено из ключа, поэтому
+её видят все воркеры на хосте, а при падении процесса ядро снимает её
+само. Файлы блокировок не удаляются: удаление файла под ``flock`` гонится
+с его повторным открытием, а пустые файлы почти ничего не весят.
+"""
+import hashlib
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: без блокировки, каждый процесс сам по себе
+    fcntl = None
+
+POLL_INTERVAL = 0.05
+
+
+class Flight:
+    def __init__(self):
+        # leader - блокировка взята; waited - пришлось ждать другой процесс
+        self.leader = False
+        self.waited = False
+
+
+def _try_lock(fd):
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+@contextmanager
+def single_flight(key, wait=0, directory=None):
+    """Пытается взять блокировку ``key``, ожидая до ``wait`` секунд."""
+    flight = Flight()
+    if fcntl is None:
+        flight.leader = True
+        yield flight
+        return
+    directory = directory or os.path.join(
+        tempfile.gettempdir(), 'yatube-locks')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(
+        directory, hashlib.md5(key.encode()).hexdigest() + '.lock')
+    fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+    try:
+        deadline = time.monotonic() + wait
+        flight.leader = _try_lock(fd)
+        while not flight.leader and time.monotonic() < deadline:
+            flight.waited = True
+            time.sleep(POLL_INTERVAL)
+            flight.leader = _try_lock(fd)
+        flight.waited = flight.waited or not flight.leader
+        yield flight
+    finally:
+        # закрытие дескриптора снимает flock
+        os.close(fd)
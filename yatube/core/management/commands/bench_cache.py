@@ -0,0 +1,99 @@
+import multiprocessing
+import random
+import shutil
+import tempfile
+import time
+
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+
+from core.cache import SQLiteCache
+
+VALUE = {'html': 'x' * 2048}
+
+
+def _workload(cache, keys, queue):
+    hits = 0
+    for key in keys:
+        if cache.get(key) is None:
+            cache.set(key, VALUE)
+        else:
+            hits += 1
+    queue.put(hits)
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает SQLiteCache с LocMemCache и FileBasedCache: '
+            'скорость операций и долю попаданий у нескольких воркеров.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ops', type=int, default=5000)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--keys', type=int, default=500)
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp()
+        try:
+            backends = {
+                'locmem': lambda: LocMemCache(
+                    'bench', {'OPTIONS': {'MAX_ENTRIES': 10 ** 6}}),
+                'filebased': lambda: FileBasedCache(
+                    f'{directory}/files', {'OPTIONS': {
+                        'MAX_ENTRIES': 10 ** 6}}),
+                'sqlite': lambda: SQLiteCache(
+                    f'{directory}/cache.sqlite3', {'OPTIONS': {
+                        'MAX_ENTRIES': 10 ** 6}}),
+            }
+            self.stdout.write(
+                f'{"бэкенд":<10} {"set":>9} {"get":>9} {"get_many":>9} '
+                f'{"incr":>9}   операций/с; попаданий у '
+                f'{options["workers"]} воркеров')
+            for name, factory in backends.items():
+                speed = self.bench_ops(factory(), options['ops'])
+                hit_rate = self.bench_workers(
+                    factory, options['workers'], options['keys'])
+                self.stdout.write(
+                    f'{name:<10} ' + ' '.join(f'{v:9.0f}' for v in speed)
+                    + f'   {hit_rate:6.1%}')
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    @staticmethod
+    def rate(func, number):
+        start = time.perf_counter()
+        for i in range(number):
+            func(i)
+        return number / (time.perf_counter() - start)
+
+    def bench_ops(self, cache, number):
+        cache.clear()
+        keys = [f'bench:{i}' for i in range(number)]
+        speed = (
+            self.rate(lambda i: cache.set(keys[i], VALUE), number),
+            self.rate(lambda i: cache.get(keys[i]), number),
+            self.rate(lambda i: cache.get_many(keys[i * 10:i * 10 + 10]),
+                      number // 10) * 10,
+        )
+        cache.set('counter', 0)
+        return speed + (
+            self.rate(lambda i: cache.incr('counter'), number),
+        )
+
+    def bench_workers(self, factory, workers, number):
+        """Каждый воркер читает одни и те же ключи в своём порядке."""
+        factory().clear()
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        processes = []
+        for _ in range(workers):
+            keys = [f'page:{i}' for i in range(number)]
+            random.shuffle(keys)
+            process = context.Process(
+                target=_workload, args=(factory(), keys, queue))
+            process.start()
+            processes.append(process)
+        hits = sum(queue.get() for _ in processes)
+        for process in processes:
+            process.join()
+        return hits / (workers * number)
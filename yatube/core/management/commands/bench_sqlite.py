@@ -0,0 +1,147 @@
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections
+from django.test.utils import override_settings
+
+from core.testing import temporary_caches
+from posts.models import Comment, Post
+
+User = get_user_model()
+# режим Django «из коробки»: журнал отката, полный fsync
+ROLLBACK_JOURNAL = {'journal_mode': 'DELETE'}
+
+
+def _reader(deadline, queue):
+    timings, errors = [], 0
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            list(Post.objects.select_related('author', 'group')[:10])
+        except OperationalError:
+            errors += 1
+            continue
+        timings.append(time.perf_counter() - started)
+    connections.close_all()
+    queue.put(('read', timings, errors))
+
+
+def _writer(deadline, post_ids, author_ids, queue):
+    timings, errors = [], 0
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            # как add_comment: запись и сигналы счётчиков
+            Comment.objects.create(post_id=random.choice(post_ids),
+                                   author_id=random.choice(author_ids),
+                                   text='нагрузка')
+        except OperationalError:
+            errors += 1
+            continue
+        timings.append(time.perf_counter() - started)
+    connections.close_all()
+    queue.put(('write', timings, errors))
+
+
+def percentile(timings, share):
+    if not timings:
+        return 0
+    timings = sorted(timings)
+    return timings[min(int(share * len(timings)), len(timings) - 1)]
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает пропускную способность чтения SQLite во время '
+            'записи: журнал отката Django по умолчанию против '
+            'settings.SQLITE_PRAGMAS (WAL, mmap, busy_timeout).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--writers', type=int, default=2)
+        parser.add_argument('--seconds', type=float, default=5)
+        parser.add_argument('--posts', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp()
+        connection.settings_dict['TEST']['NAME'] = os.path.join(
+            directory, 'bench.sqlite3')
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        try:
+            # сигналы пользователей и комментариев пишут в кэш: не в кэш сайта
+            with temporary_caches():
+                self.bench(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def bench(self, options):
+        post_ids, author_ids = self.populate(options['posts'])
+        self.stdout.write(
+            f'{options["readers"]} читателей, {options["writers"]} '
+            f'писателей, {options["seconds"]:.0f} с')
+        self.stdout.write(
+            f'{"режим":<16}{"чтений/с":>10}{"p95 чтения":>12}'
+            f'{"записей/с":>11}{"p95 записи":>12}{"ошибок":>8}')
+        modes = (('rollback', {**settings.SQLITE_PRAGMAS,
+                               **ROLLBACK_JOURNAL,
+                               'synchronous': 'FULL'}),
+                 ('tuned', settings.SQLITE_PRAGMAS))
+        for name, pragmas in modes:
+            with override_settings(SQLITE_PRAGMAS=pragmas):
+                self.report(name, self.run(options, post_ids, author_ids))
+
+    def populate(self, number):
+        authors = [User.objects.create_user(username=f'bench{i}')
+                   for i in range(20)]
+        Post.objects.bulk_create(
+            Post(author=random.choice(authors), text=f'пост {i}')
+            for i in range(number))
+        return (list(Post.objects.values_list('pk', flat=True)),
+                [author.pk for author in authors])
+
+    def run(self, options, post_ids, author_ids):
+        # соединение нельзя переносить через fork, а режим журнала
+        # применится при открытии нового
+        connections.close_all()
+        connection.ensure_connection()
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        deadline = time.monotonic() + options['seconds']
+        processes = [
+            context.Process(target=_reader, args=(deadline, queue))
+            for _ in range(options['readers'])
+        ] + [
+            context.Process(target=_writer,
+                            args=(deadline, post_ids, author_ids, queue))
+            for _ in range(options['writers'])
+        ]
+        for process in processes:
+            process.start()
+        results = {'read': ([], 0), 'write': ([], 0)}
+        for _ in processes:
+            kind, timings, errors = queue.get()
+            total, failed = results[kind]
+            results[kind] = (total + timings, failed + errors)
+        for process in processes:
+            process.join()
+        return results, options['seconds']
+
+    def report(self, name, run):
+        results, seconds = run
+        reads, read_errors = results['read']
+        writes, write_errors = results['write']
+        self.stdout.write(
+            f'{name:<16}{len(reads) / seconds:>10.0f}'
+            f'{percentile(reads, 0.95) * 1000:>10.1f}мс'
+            f'{len(writes) / seconds:>11.0f}'
+            f'{percentile(writes, 0.95) * 1000:>10.1f}мс'
+            f'{read_errors + write_errors:>8}')
@@ -0,0 +1,36 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.replicas import copy
+
+
+class Command(BaseCommand):
+    help = ('Копирует основную базу SQLite во все реплики из '
+            'settings.READ_REPLICAS через backup API; с --interval - '
+            'раз в столько секунд, пока не остановят.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='повторять раз в столько секунд; 0 - '
+                                 'один раз')
+
+    def handle(self, *args, **options):
+        if not settings.READ_REPLICAS:
+            raise CommandError('settings.READ_REPLICAS пуст')
+        # реплика не должна отставать дольше, чем автор читает основную базу
+        if options['interval'] >= settings.REPLICA_STICKY_SECONDS:
+            raise CommandError(
+                f'--interval должен быть меньше REPLICA_STICKY_SECONDS '
+                f'({settings.REPLICA_STICKY_SECONDS} с)')
+        source = settings.DATABASES['default']['NAME']
+        while True:
+            for alias in settings.READ_REPLICAS:
+                started = time.monotonic()
+                copy(source, settings.DATABASES[alias]['NAME'])
+                self.stdout.write(
+                    f'{alias}: {time.monotonic() - started:.2f} с')
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,97 @@
+"""Учёт SQL-запросов каждого запроса и бюджеты запросов по view.
+
+Для каждого HTTP-запроса считаются число SQL-запросов, общее время в БД
+и повторы одинакового SQL (типичный след N+1). Итог уходит в заголовок
+``Server-Timing`` и одной JSON-строкой в лог ``core.middleware``.
+
+Бюджеты - словари ``BUDGETS`` вида ``{'app:view_name': число запросов}``
+в модулях из ``settings.QUERY_BUDGET_MODULES``. Превышение пишется
+в лог как предупреждение, а при ``settings.QUERY_BUDGET_ENFORCE``
+запрос падает с ``QueryBudgetExceeded`` - так бюджеты проверяют тесты.
+"""
+import json
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack
+from importlib import import_module
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            self.statements[sql] += 1
+
+    def duplicates(self):
+        """Число лишних повторов одинакового SQL (параметры не в счёт)."""
+        return sum(count - 1 for count in self.statements.values())
+
+
+def load_budgets():
+    budgets = {}
+    for path in getattr(settings, 'QUERY_BUDGET_MODULES', ()):
+        budgets.update(import_module(path).BUDGETS)
+    return budgets
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.budgets = load_budgets()
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        total = time.perf_counter() - started
+        match = request.resolver_match
+        view = match.view_name if match else None
+        response['Server-Timing'] = (
+            f'db;dur={recorder.duration * 1000:.1f};'
+            f'desc="{recorder.count} queries, '
+            f'{recorder.duplicates()} duplicated", '
+            f'total;dur={total * 1000:.1f}')
+        record = {
+            'view': view,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': recorder.count,
+            'db_ms': round(recorder.duration * 1000, 1),
+            'duplicated': recorder.duplicates(),
+            'total_ms': round(total * 1000, 1),
+        }
+        budget = self.budgets.get(view)
+        if budget is None or recorder.count <= budget:
+            logger.info(json.dumps(record, ensure_ascii=False))
+            return response
+        record['budget'] = budget
+        record['repeated'] = [
+            sql for sql, count in recorder.statements.most_common(3)
+            if count > 1]
+        logger.warning(json.dumps(record, ensure_ascii=False))
+        if getattr(settings, 'QUERY_BUDGET_ENFORCE', False):
+            raise QueryBudgetExceeded(
+                f'{view}: {recorder.count} запросов при бюджете {budget}')
+        return response
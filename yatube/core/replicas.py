@@ -0,0 +1,95 @@
+"""Чтение с реплик SQLite и «свои записи видны сразу».
+
+Страницы из ``settings.REPLICA_VIEWS``, открытые методом GET, читают
+данные со случайной базы из ``settings.READ_REPLICAS``. Все записи идут
+в ``default``. Если за время запроса что-то записывалось, браузер
+получает cookie ``REPLICA_STICKY_COOKIE`` на ``REPLICA_STICKY_SECONDS``
+секунд. Пока cookie жива, запросы читают только из ``default``, поэтому
+автор сразу видит свой пост, комментарий или подписку, даже если реплика
+ещё не догнала основную базу. Сессии и KV-хранилище миниатюр sorl всегда
+читаются из ``default``: только что созданная сессия могла ещё не дойти до
+реплики, а отсутствие миниатюры sorl запоминает в кэше на годы.
+
+Общие кэши не должны запоминать прочитанное с отстающей реплики:
+фрагменты лент с реплики кэшируются под своим ключом и не дольше окна
+отставания, а отрицательные ответы подтверждает основная база.
+
+Без ``READ_REPLICAS`` роутер ничего не меняет. Реплики обновляет команда
+``sync_replicas`` через backup API SQLite.
+"""
+import random
+import sqlite3
+import threading
+
+from django.conf import settings
+
+# эти приложения всегда читаются из основной базы
+PRIMARY_ONLY = {'sessions', 'thumbnail'}
+COOKIE = getattr(settings, 'REPLICA_STICKY_COOKIE', 'primary_reads')
+
+_state = threading.local()
+
+
+def current():
+    """Реплика, с которой читает текущий запрос; None - основная база."""
+    return getattr(_state, 'replica', None)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in PRIMARY_ONLY:
+            return None
+        return current()
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # реплики - копии default: объекты из разных баз связаны
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db in settings.READ_REPLICAS:
+            return False
+        return None
+
+
+class ReplicaMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _state.replica, _state.wrote = None, False
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.replica = None
+        if _state.wrote and settings.READ_REPLICAS:
+            response.set_cookie(
+                COOKIE, '1', max_age=settings.REPLICA_STICKY_SECONDS,
+                httponly=True, samesite='Lax')
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        replicas = settings.READ_REPLICAS
+        if (replicas and request.method in ('GET', 'HEAD')
+                and COOKIE not in request.COOKIES
+                and request.resolver_match.view_name
+                in settings.REPLICA_VIEWS):
+            _state.replica = random.choice(replicas)
+
+
+def copy(source, target, timeout=5):
+    """Копирует базу ``source`` в ``target`` одним шагом backup API.
+
+    Шаг один (``pages=-1``), поэтому читатели реплики видят либо прежнюю
+    копию целиком, либо новую.
+    """
+    with sqlite3.connect(source, timeout=timeout) as primary:
+        replica = sqlite3.connect(target, timeout=timeout)
+        try:
+            primary.backup(replica, pages=-1)
+        finally:
+            replica.close()
+    primary.close()
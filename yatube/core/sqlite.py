@@ -0,0 +1,30 @@
+"""Настройка соединений Django с SQLite при их открытии.
+
+Обработчик ``connection_created`` выполняет ``PRAGMA`` из
+``settings.SQLITE_PRAGMAS`` по порядку для каждого нового соединения
+с SQLite. Нужные для продакшена:
+
+* ``journal_mode=WAL`` - читатели не ждут писателя и наоборот (режим
+  хранится в самом файле базы, но повторная установка ничего не стоит);
+* ``synchronous=NORMAL`` - в WAL без fsync на каждый коммит, база при этом
+  не портится, теряются лишь последние коммиты при отключении питания;
+* ``busy_timeout`` - ждать освобождения блокировки, а не сразу падать
+  с "database is locked";
+* ``mmap_size`` и ``cache_size`` - чтение страниц через отображение файла
+  и больший кэш страниц на соединение.
+
+``busy_timeout`` стоит первым: переключение в WAL само берёт блокировку.
+"""
+from django.conf import settings
+
+
+def pragma_statements(pragmas):
+    return [f'PRAGMA {name}={value}' for name, value in pragmas.items()]
+
+
+def configure(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', {})
+    for statement in pragma_statements(pragmas):
+        connection.connection.execute(statement)
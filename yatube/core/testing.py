@@ -0,0 +1,54 @@
+"""Изоляция тестов и замеров от кэша работающего сайта."""
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+@contextmanager
+def temporary_caches():
+    """Все кэши - во временной папке, которая удаляется на выходе.
+
+    Иначе ``cache.clear()`` в тестах и замерах стирает общий
+    cache.sqlite3 сайта: счётчики поколений, журналы индексов и т. п.
+    """
+    directory = tempfile.mkdtemp()
+    caches = {
+        alias: {**config,
+                'LOCATION': os.path.join(directory, f'{alias}.sqlite3')}
+        for alias, config in settings.CACHES.items()
+    }
+    try:
+        with override_settings(CACHES=caches):
+            yield directory
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class TestRunner(DiscoverRunner):
+    """``manage.py test`` с временными кэшами и обязательными бюджетами.
+
+    Любая страница в любом тесте, вышедшая за бюджет запросов, роняет тест;
+    строка лога на каждый запрос тестам не нужна.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.caches = temporary_caches()
+        self.caches.__enter__()
+        self.budgets = override_settings(QUERY_BUDGET_ENFORCE=True)
+        self.budgets.enable()
+        self.logger = logging.getLogger('core.middleware')
+        self.level = self.logger.level
+        self.logger.setLevel(logging.WARNING)
+
+    def teardown_test_environment(self, **kwargs):
+        self.logger.setLevel(self.level)
+        self.budgets.disable()
+        self.caches.__exit__(None, None, None)
+        super().teardown_test_environment(**kwargs)
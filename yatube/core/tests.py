@@ -0,0 +1,238 @@
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from io import StringIO
+
+from django.contrib.sessions.models import Session
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connections, router
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.urls import resolve
+from sorl.thumbnail.models import KVStore
+
+from posts.models import Post
+
+from . import replicas
+from .cache import SQLiteCache
+from .locks import single_flight
+
+
+def _hold_lock(directory, locked, release):
+    with single_flight('key', directory=directory):
+        locked.set()
+        release.wait(5)
+
+
+def _increment(path, times):
+    cache = SQLiteCache(path, {})
+    for _ in range(times):
+        cache.incr('counter')
+
+
+class SQLiteCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.sqlite3')
+        self.cache = SQLiteCache(self.path, {})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_set_get_delete(self):
+        self.cache.set('key', {'value': [1, 2]})
+        self.assertEqual(self.cache.get('key'), {'value': [1, 2]})
+        self.assertTrue(self.cache.has_key('key'))
+        self.cache.delete('key')
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_expiry_and_add(self):
+        self.cache.set('short', 1, 0.05)
+        self.assertFalse(self.cache.add('short', 2))
+        time.sleep(0.1)
+        self.assertIsNone(self.cache.get('short'))
+        self.assertTrue(self.cache.add('short', 3))
+        self.assertEqual(self.cache.get('short'), 3)
+
+    def test_many(self):
+        self.cache.set_many({'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(self.cache.get_many(['a', 'c', 'missing']),
+                         {'a': 1, 'c': 3})
+        self.cache.delete_many(['a', 'b'])
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']), {'c': 3})
+
+    def test_shared_between_instances(self):
+        """Второй экземпляр (как другой воркер) видит те же ключи."""
+        self.cache.set('shared', 'value')
+        other = SQLiteCache(self.path, {})
+        self.assertEqual(other.get('shared'), 'value')
+        other.clear()
+        self.assertIsNone(self.cache.get('shared'))
+
+    def test_incr_is_atomic_across_processes(self):
+        self.cache.set('counter', 0)
+        context = multiprocessing.get_context('fork')
+        workers = [
+            context.Process(target=_increment, args=(self.path, 100))
+            for _ in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(self.cache.get('counter'), 400)
+        with self.assertRaises(ValueError):
+            self.cache.incr('missing')
+
+    def test_lru_eviction(self):
+        cache = SQLiteCache(self.path, {
+            'OPTIONS': {'MAX_ENTRIES': 10, 'CULL_EVERY': 1,
+                        'TOUCH_INTERVAL': 0}})
+        cache.set('hot', 'value')
+        for i in range(30):
+            cache.get('hot')
+            cache.set(f'cold{i}', i)
+        self.assertEqual(cache.get('hot'), 'value')
+        self.assertIsNone(cache.get('cold0'))
+        count, = cache._db.execute('SELECT COUNT(*) FROM cache').fetchone()
+        self.assertLessEqual(count, 10)
+
+    def test_threads_have_own_connections(self):
+        cache = self.cache
+        cache.set('counter', 0)
+
+        def work():
+            for _ in range(50):
+                cache.incr('counter')
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.get('counter'), 200)
+
+
+class SingleFlightTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        context = multiprocessing.get_context('fork')
+        self.locked, self.release = context.Event(), context.Event()
+        self.holder = context.Process(
+            target=_hold_lock,
+            args=(self.directory, self.locked, self.release))
+        self.holder.start()
+        self.locked.wait(5)
+
+    def tearDown(self):
+        self.release.set()
+        self.holder.join()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_other_process_holds_lock(self):
+        with single_flight('key', directory=self.directory) as flight:
+            self.assertFalse(flight.leader)
+            self.assertTrue(flight.waited)
+        with single_flight('other', directory=self.directory) as flight:
+            self.assertTrue(flight.leader)
+            self.assertFalse(flight.waited)
+
+    def test_waits_for_release(self):
+        threading.Timer(0.1, self.release.set).start()
+        with single_flight('key', 5, self.directory) as flight:
+            self.assertTrue(flight.leader)
+            self.assertTrue(flight.waited)
+
+
+class SQLitePragmaTest(SimpleTestCase):
+    @override_settings(SQLITE_PRAGMAS={
+        'busy_timeout': 1234, 'journal_mode': 'WAL',
+        'synchronous': 'NORMAL', 'mmap_size': 2 ** 20})
+    def test_pragmas_applied_to_new_connections(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        wrapper = connections['default'].__class__({
+            **connections['default'].settings_dict,
+            'NAME': os.path.join(directory, 'db.sqlite3'),
+        }, alias='tuned')
+        wrapper.ensure_connection()
+        self.addCleanup(wrapper.close)
+        db = wrapper.connection
+        values = {name: db.execute(f'PRAGMA {name}').fetchone()[0]
+                  for name in ('busy_timeout', 'journal_mode',
+                               'synchronous', 'mmap_size')}
+        # synchronous: 1 - NORMAL
+        self.assertEqual(values, {'busy_timeout': 1234, 'journal_mode': 'wal',
+                                  'synchronous': 1, 'mmap_size': 2 ** 20})
+
+
+@override_settings(READ_REPLICAS=['replica'])
+class ReplicaRouterTest(SimpleTestCase):
+    def request(self, path, method='get', write=False, **extra):
+        request = getattr(RequestFactory(), method)(path, **extra)
+        request.resolver_match = resolve(path)
+        seen = {}
+
+        def view(request):
+            seen['post'] = router.db_for_read(Post)
+            seen['session'] = router.db_for_read(Session)
+            seen['thumbnail'] = router.db_for_read(KVStore)
+            if write:
+                router.db_for_write(Post)
+            return HttpResponse()
+
+        middleware = replicas.ReplicaMiddleware(
+            lambda request: middleware.process_view(
+                request, view, (), {}) or view(request))
+        response = middleware(request)
+        return seen, response
+
+    def test_read_only_views_use_replica(self):
+        seen, response = self.request('/')
+        self.assertEqual(seen, {'post': 'replica', 'session': 'default',
+                                'thumbnail': 'default'})
+        self.assertNotIn(replicas.COOKIE, response.cookies)
+        # вне запроса чтение снова идёт в основную базу
+        self.assertEqual(router.db_for_read(Post), 'default')
+
+    def test_other_views_and_methods_use_primary(self):
+        self.assertEqual(self.request('/follow/')[0]['post'], 'default')
+        self.assertEqual(
+            self.request('/', method='post')[0]['post'], 'default')
+
+    def test_write_makes_reads_sticky(self):
+        _, response = self.request('/', method='post', write=True)
+        cookie = response.cookies[replicas.COOKIE]
+        self.assertEqual(cookie['max-age'], 15)
+        seen, _ = self.request(
+            '/', HTTP_COOKIE=f'{replicas.COOKIE}=1')
+        self.assertEqual(seen['post'], 'default')
+
+    def test_sync_interval_below_sticky_window(self):
+        with self.assertRaisesMessage(CommandError, 'REPLICA_STICKY_SECONDS'):
+            call_command('sync_replicas', '--interval', '15',
+                         stdout=StringIO())
+
+    def test_copy(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        source, target = (os.path.join(directory, name)
+                          for name in ('db.sqlite3', 'replica.sqlite3'))
+        with sqlite3.connect(source) as primary:
+            primary.execute('PRAGMA journal_mode=WAL')
+            primary.execute('CREATE TABLE t (value)')
+            primary.execute('INSERT INTO t VALUES (1)')
+        replicas.copy(source, target)
+        with sqlite3.connect(source) as primary:
+            primary.execute('INSERT INTO t VALUES (2)')
+        replicas.copy(source, target)
+        replica = sqlite3.connect(target)
+        self.assertEqual(replica.execute('SELECT count(*) FROM t').fetchone(),
+                         (2,))
+        replica.close()
+        primary.close()
@@ -1,5 +1,6 @@
 from django.contrib import admin
 from .models import Post, Group
+from .search import post_ids
 
 
 @admin.register(Post)
@@ -18,6 +19,12 @@ class PostAdmin(admin.ModelAdmin):
     # скрыть author поле, чтобы оно не отображалось в форме изменений
     exclude = ('author',)
 
+    def get_search_results(self, request, queryset, search_term):
+        # поиск по индексу FTS5 вместо LIKE '%...%' по всей таблице
+        if not search_term:
+            return queryset, False
+        return queryset.filter(pk__in=post_ids(search_term)), False
+
     def save_model(self, request, obj, form, change):
         if not obj.pk:
             obj.author = request.user
@@ -0,0 +1,215 @@
+"""Автодополнение имён пользователей и групп по префиксу.
+
+Индекс - отсортированный массив ключей в памяти процесса, поиск по нему
+идёт ``bisect``, поэтому ответ не обращается к БД. Сигналы правят индекс
+своего процесса на месте и пишут изменение в журнал в кэше под номером
+поколения. Другие процессы сверяются с поколением не чаще раза
+в ``SYNC_INTERVAL`` секунд и дочитывают журнал, правя свой индекс так же.
+Целиком, одним потоком процесса, индекс пересобирается, только если
+журнал не удалось дочитать (вытеснен или пропущен ``invalidate``).
+"""
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.urls import reverse
+
+from .models import Group
+
+User = get_user_model()
+
+GENERATION_KEY = 'autocomplete:generation'
+SYNC_INTERVAL = getattr(settings, 'AUTOCOMPLETE_SYNC_INTERVAL', 1)
+USER = 'user'
+GROUP = 'group'
+PUT = 'put'
+REMOVE = 'remove'
+# дочитывать журнал дольше, чем пересобрать индекс
+MAX_REPLAY = 1000
+LOG_TIMEOUT = 60 * 60
+
+
+class PrefixIndex:
+    """Отсортированные ключи ``(префикс-ключ, тип, pk)`` и их записи."""
+
+    def __init__(self):
+        self.keys = []
+        self.items = {}
+        self.item_keys = {}
+
+    def put(self, kind, pk, keys, item):
+        self.remove(kind, pk)
+        keys = {key.lower() for key in keys if key}
+        for key in keys:
+            insort(self.keys, (key, kind, pk))
+        self.items[kind, pk] = item
+        self.item_keys[kind, pk] = keys
+
+    def remove(self, kind, pk):
+        for key in self.item_keys.pop((kind, pk), ()):
+            position = bisect_left(self.keys, (key, kind, pk))
+            del self.keys[position]
+        self.items.pop((kind, pk), None)
+
+    def complete(self, prefix, limit):
+        prefix = prefix.lower()
+        found = {}
+        position = bisect_left(self.keys, (prefix,))
+        for key, kind, pk in self.keys[position:]:
+            if not key.startswith(prefix) or len(found) == limit:
+                break
+            found.setdefault((kind, pk), self.items[kind, pk])
+        return list(found.values())
+
+
+def _user(user):
+    return [user.username], {'type': USER, 'value': user.username,
+                             'label': user.username}
+
+
+def _group(group):
+    return [group.slug, group.title], {'type': GROUP, 'value': group.slug,
+                                       'label': group.title}
+
+
+class _State:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # полную пересборку делает один поток, остальные ждут её
+        self.build_lock = threading.Lock()
+        self.index = None
+        self.generation = None
+        self.checked = 0
+        self.builds = 0
+
+
+state = _State()
+
+
+def _build():
+    index = PrefixIndex()
+    users = User.objects.filter(is_active=True).only('username')
+    for user in users.iterator():
+        index.put(USER, user.pk, *_user(user))
+    for group in Group.objects.only('slug', 'title').iterator():
+        index.put(GROUP, group.pk, *_group(group))
+    return index
+
+
+def _log_key(generation):
+    return f'autocomplete:change:{generation}'
+
+
+def _generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, 0, None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def _apply(index, change):
+    action, kind, pk, *entry = change
+    if action == PUT:
+        index.put(kind, pk, *entry)
+    else:
+        index.remove(kind, pk)
+
+
+def _rebuild(generation):
+    builds = state.builds
+    with state.build_lock:
+        if state.builds != builds:
+            # пока ждали, индекс пересобрал другой поток
+            return
+        index = _build()
+        with state.lock:
+            state.index, state.generation = index, generation
+            state.builds += 1
+
+
+def _sync():
+    """Доводит индекс процесса до поколения в кэше по журналу изменений."""
+    generation = _generation()
+    if state.index is None or generation < state.generation or (
+            generation - state.generation > MAX_REPLAY):
+        return _rebuild(generation)
+    if generation == state.generation:
+        return
+    keys = [_log_key(number)
+            for number in range(state.generation + 1, generation + 1)]
+    changes = cache.get_many(keys)
+    if len(changes) < len(keys):
+        return _rebuild(generation)
+    with state.lock:
+        for key in keys:
+            _apply(state.index, changes[key])
+        state.generation = max(state.generation, generation)
+
+
+def get_index():
+    """Индекс этого процесса, сверенный с журналом в кэше."""
+    now = time.monotonic()
+    if state.index is None or now - state.checked >= SYNC_INTERVAL:
+        _sync()
+        state.checked = now
+    return state.index
+
+
+def complete(prefix, limit=10):
+    """Записи, чьё имя, slug или название начинается с ``prefix``."""
+    index = get_index()
+    with state.lock:
+        items = index.complete(prefix, limit)
+    return [{**item, 'url': _url(item)} for item in items]
+
+
+def _url(item):
+    if item['type'] == USER:
+        return reverse('posts:profile', args=[item['value']])
+    return reverse('posts:group_list', args=[item['value']])
+
+
+def _changed(change):
+    """Правит индекс процесса и пишет изменение в журнал для остальных."""
+    _generation()
+    generation = cache.incr(GENERATION_KEY)
+    cache.set(_log_key(generation), change, LOG_TIMEOUT)
+    with state.lock:
+        if state.index is None:
+            return
+        _apply(state.index, change)
+        # более ранние изменения других процессов дочитает _sync
+        if state.generation == generation - 1:
+            state.generation = generation
+
+
+def invalidate():
+    """Изменения в обход сигналов (bulk_create): все пересоберут индекс."""
+    _generation()
+    # номер без записи в журнале: дочитать его нельзя, и _sync пересоберёт
+    # индекс; старый индекс до того продолжает отвечать другим потокам
+    cache.incr(GENERATION_KEY)
+    state.checked = 0
+
+
+def user_saved(user):
+    if user.is_active:
+        _changed((PUT, USER, user.pk, *_user(user)))
+    else:
+        user_deleted(user)
+
+
+def user_deleted(user):
+    _changed((REMOVE, USER, user.pk))
+
+
+def group_saved(group):
+    _changed((PUT, GROUP, group.pk, *_group(group)))
+
+
+def group_deleted(group):
+    _changed((REMOVE, GROUP, group.pk))
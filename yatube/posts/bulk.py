@@ -0,0 +1,31 @@
+"""Помощники массовой записи: пачки для bulk_create и даты из данных."""
+from contextlib import contextmanager
+
+
+def batches(items, size):
+    """Список за списком по ``size`` элементов из любого итератора."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@contextmanager
+def explicit_dates(model, *names):
+    """Даты ``auto_now_add`` берутся из объектов, а не из текущего времени.
+
+    Меняет поле модели для всего процесса, поэтому годится только для
+    команд, а не для кода, который выполняется в запросах.
+    """
+    fields = [model._meta.get_field(name) for name in names]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
@@ -0,0 +1,127 @@
+"""Версионированный кэш фрагментов лент и карточек постов.
+
+Каждая лента (главная, группа, автор) имеет счётчик поколения в кэше.
+Он входит в ключ ``{% cache %}``, а создание, правка и удаление поста
+увеличивают счётчики затронутых лент: старые фрагменты просто перестают
+читаться и вытесняются по TTL. Имя автора и название группы тоже выводятся
+в лентах, поэтому их смена увеличивает счётчики лент, где они показаны.
+
+Карточка поста кэшируется отдельно под ключом из id поста и хэша всего,
+что в неё выводится (текст, картинка, автор, группа), поэтому смена любого
+из этих значений сама даёт новый ключ.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+from core import replicas
+
+from . import thumbnails, variants
+
+POSTCARD_TEMPLATE = 'includes/postcard.html'
+
+INDEX = 'index'
+
+
+def group_scope(group_id):
+    return f'group:{group_id}'
+
+
+def author_scope(author_id):
+    return f'author:{author_id}'
+
+
+def _key(scope):
+    return f'posts:generation:{scope}'
+
+
+def _initial():
+    # начинаем с текущего времени, чтобы после вытеснения счётчика
+    # не совпасть с поколением ещё живых старых фрагментов
+    return int(time.time() * 1000)
+
+
+def get_generation(scope):
+    key = _key(scope)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, _initial(), None)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_generation(*scopes):
+    for scope in scopes:
+        key = _key(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, _initial(), None)
+
+
+def post_scopes(post, *group_ids):
+    """Ленты, в которых показывается пост (и его прежние группы)."""
+    scopes = {INDEX, author_scope(post.author_id)}
+    scopes.update(
+        group_scope(group_id)
+        for group_id in (post.group_id, *group_ids) if group_id
+    )
+    return scopes
+
+
+def listing_context(scope):
+    """Переменные шаблона для ключа ``{% cache %}`` ленты."""
+    replica = replicas.current()
+    timeout = settings.LISTING_CACHE_TIMEOUT
+    if replica:
+        # реплика может отставать от поколения: её фрагменты не смешиваем
+        # с фрагментами основной базы и держим не дольше окна отставания
+        timeout = min(timeout, settings.REPLICA_STICKY_SECONDS)
+    return {
+        'listing_generation': get_generation(scope),
+        'listing_source': replica or 'default',
+        'listing_timeout': timeout,
+    }
+
+
+def postcard_key(post):
+    group = post.group
+    version = hashlib.md5(repr((
+        post.text, post.pub_date, post.image.name, post.image_variants,
+        post.author.username,
+        group and (group.pk, group.slug, group.title),
+    )).encode()).hexdigest()
+    return f'posts:postcard:{post.pk}:{version}'
+
+
+def render_postcards(posts):
+    """HTML карточек страницы: один ``get_many``, промахи - одним set_many."""
+    keys = {postcard_key(post): post for post in posts}
+    cards = cache.get_many(keys)
+    misses = {key: post for key, post in keys.items() if key not in cards}
+    if misses:
+        template = get_template(POSTCARD_TEMPLATE)
+        pictures = {key: variants.picture(post)
+                    for key, post in misses.items()}
+        # миниатюры промахов без манифеста - одним обращением к KV-хранилищу
+        pending = [post.image for key, post in misses.items()
+                   if post.image and not pictures[key]]
+        images = thumbnails.ready_thumbnails(pending) if pending else {}
+        rendered, ready = {}, {}
+        for key, post in misses.items():
+            thumbnail = images.get(post.image.name)
+            rendered[key] = template.render({
+                'post': post,
+                'picture': pictures[key],
+                'thumbnail': thumbnail,
+            })
+            # карточку с заглушкой вместо картинки не кэшируем
+            if pictures[key] or thumbnail or not post.image:
+                ready[key] = rendered[key]
+        cache.set_many(ready, settings.POSTCARD_CACHE_TIMEOUT)
+        cards.update(rendered)
+    return [mark_safe(cards[key]) for key in keys]
@@ -0,0 +1,116 @@
+"""Потоковая выгрузка постов, комментариев и подписок.
+
+Таблица читается keyset-порциями по pk (``WHERE id > :last LIMIT n``),
+каждая порция - через ``.iterator()``, и сразу превращается в строки
+JSONL или CSV (по желанию сжатые gzip). В памяти одновременно не больше
+одной порции, каким бы большим ни был размер таблицы.
+
+Поля постов и комментариев совпадают с форматом ``import_posts``,
+поэтому выгрузку одного сайта можно загрузить в другой.
+"""
+import csv
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Comment, Follow, Post
+
+CHUNK_SIZE = 2000
+FORMATS = ('jsonl', 'csv')
+
+# имя выгрузки -> (модель, {ключ в выгрузке: поле для values()}, константы)
+EXPORTS = {
+    'posts': (Post, {
+        'id': 'pk',
+        'author': 'author__username',
+        'group': 'group__slug',
+        'text': 'text',
+        'pub_date': 'pub_date',
+        'image': 'image',
+    }, {'type': 'post'}),
+    'comments': (Comment, {
+        'id': 'pk',
+        'post': 'post_id',
+        'author': 'author__username',
+        'text': 'text',
+        'created': 'created',
+    }, {'type': 'comment'}),
+    'follows': (Follow, {
+        'id': 'pk',
+        'user': 'user__username',
+        'author': 'author__username',
+    }, {}),
+}
+
+
+def columns(name):
+    _, fields, constants = EXPORTS[name]
+    return [*constants, *fields]
+
+
+def rows(name, chunk_size=CHUNK_SIZE):
+    """Словари строк выгрузки по возрастанию pk, порциями."""
+    model, fields, constants = EXPORTS[name]
+    queryset = model.objects.order_by('pk').values_list(*fields.values())
+    last = 0
+    while True:
+        count = 0
+        for values in queryset.filter(pk__gt=last)[:chunk_size].iterator(
+                chunk_size=chunk_size):
+            count += 1
+            last = values[0]
+            yield {**constants, **dict(zip(fields, values))}
+        if count < chunk_size:
+            return
+
+
+class _Line:
+    """Файл для csv.writer: отдаёт записанную строку, а не копит её."""
+
+    def write(self, value):
+        return value
+
+
+def lines(name, fmt='jsonl', chunk_size=CHUNK_SIZE):
+    """Строки выгрузки в формате ``jsonl`` или ``csv``."""
+    if fmt == 'csv':
+        writer = csv.writer(_Line())
+        header = columns(name)
+        yield writer.writerow(header)
+        for row in rows(name, chunk_size):
+            yield writer.writerow(
+                [_csv_value(row[column]) for column in header])
+        return
+    for row in rows(name, chunk_size):
+        line = json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False)
+        yield line + '\n'
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def encode(chunks, compress=False):
+    """Байты строк; с ``compress`` - поток gzip."""
+    if not compress:
+        for chunk in chunks:
+            yield chunk.encode()
+        return
+    # wbits=31: заголовок и контрольная сумма gzip
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream(name, fmt='jsonl', compress=False, chunk_size=CHUNK_SIZE):
+    return encode(lines(name, fmt, chunk_size), compress)
+
+
+def filename(name, fmt='jsonl', compress=False):
+    return f'{name}.{fmt}' + ('.gz' if compress else '')
@@ -0,0 +1,195 @@
+"""Лента подписок: гибрид fan-out on write и fan-out on read.
+
+Посты обычных авторов раскладываются по лентам подписчиков при публикации
+(таблица FeedEntry). Авторы, у которых подписчиков больше
+``settings.FEED_PUSH_THRESHOLD``, в ленты не раскладываются: их свежие
+посты подмешиваются при чтении k-way слиянием.
+
+Режим автора хранится в ``AuthorStats.feed_pulled``. На подмешивание
+автор переходит сразу, в запросе подписки (``update_mode``): это одна
+UPDATE. Обратно - только в ``sync_modes`` (команда ``rebuild_feeds``) и
+лишь когда подписчиков стало меньше ``FEED_PUSH_RETURN_RATIO`` от порога:
+возврат раскладывает по лентам все посты автора, написанные в том числе,
+пока они подмешивались, а это слишком долго для запроса отписки.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import AuthorStats, FeedEntry, Follow, Post
+from .paginator import MergedCursorPaginator
+
+BATCH_SIZE = getattr(settings, 'FEED_BATCH_SIZE', 1000)
+PULL_AUTHORS_KEY = 'feed:pull_authors'
+PULL_AUTHORS_TIMEOUT = 60
+
+
+def _bulk_insert(entries):
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= BATCH_SIZE:
+            FeedEntry.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    if batch:
+        FeedEntry.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def pull_author_ids():
+    """Авторы, чьи посты подмешиваются при чтении, а не раскладываются."""
+    authors = cache.get(PULL_AUTHORS_KEY)
+    if authors is None:
+        authors = set(AuthorStats.objects.filter(
+            feed_pulled=True).values_list('user_id', flat=True))
+        cache.set(PULL_AUTHORS_KEY, authors, PULL_AUTHORS_TIMEOUT)
+    return authors
+
+
+def _pulled(author_id):
+    # запись в ленты сверяется с БД: по устаревшему кэшу пост не попал бы
+    # ни в ленты, ни в чтение после смены режима
+    return AuthorStats.objects.filter(
+        user_id=author_id, feed_pulled=True).exists()
+
+
+def _return_below():
+    return settings.FEED_PUSH_THRESHOLD * settings.FEED_PUSH_RETURN_RATIO
+
+
+def _mode_changed():
+    transaction.on_commit(lambda: cache.delete(PULL_AUTHORS_KEY))
+
+
+def update_mode(author_id):
+    """Переводит автора на подмешивание, если подписчиков больше порога."""
+    threshold = settings.FEED_PUSH_THRESHOLD
+    stats = AuthorStats.objects.filter(user_id=author_id)
+    mode = stats.values_list('feed_pulled', 'followers_count').first()
+    if mode is None or mode[0] or mode[1] <= threshold:
+        return False
+    # условия повторены в UPDATE: режим сменит только один процесс
+    changed = stats.filter(
+        feed_pulled=False, followers_count__gt=threshold).update(
+        feed_pulled=True)
+    if changed:
+        _mode_changed()
+    return bool(changed)
+
+
+def _return_to_push(author_id):
+    """Возвращает автора к раскладке вместе со всеми его постами."""
+    with transaction.atomic():
+        # UPDATE первой берёт блокировку записи: пост, опубликованный
+        # позже, уже сам разложится, а раньше - попадёт в _fan_out_all
+        changed = AuthorStats.objects.filter(
+            user_id=author_id, feed_pulled=True,
+            followers_count__lt=_return_below()).update(feed_pulled=False)
+        if changed:
+            _fan_out_all(author_id)
+            _mode_changed()
+    return bool(changed)
+
+
+def sync_modes():
+    """Режимы всех авторов по текущему порогу (например, после его смены)."""
+    authors = AuthorStats.objects.values_list('user_id', flat=True)
+    pulled = list(authors.filter(
+        feed_pulled=False,
+        followers_count__gt=settings.FEED_PUSH_THRESHOLD))
+    pushed = list(authors.filter(
+        feed_pulled=True, followers_count__lt=_return_below()))
+    return (sum(map(update_mode, pulled))
+            + sum(map(_return_to_push, pushed)))
+
+
+def _fan_out_all(author_id):
+    """Раскладывает все посты автора в ленты всех его подписчиков."""
+    followers = list(Follow.objects.filter(
+        author_id=author_id).values_list('user_id', flat=True))
+    posts = Post.objects.filter(author_id=author_id).values_list(
+        'pk', 'pub_date')
+    _bulk_insert(
+        FeedEntry(user_id=user_id, post_id=post_id,
+                  author_id=author_id, pub_date=pub_date)
+        for post_id, pub_date in posts.iterator()
+        for user_id in followers
+    )
+
+
+def fan_out(post):
+    """Раскладывает новый пост в ленты всех подписчиков автора."""
+    if _pulled(post.author_id):
+        return
+    followers = Follow.objects.filter(
+        author_id=post.author_id).values_list('user_id', flat=True)
+    _bulk_insert(
+        FeedEntry(user_id=user_id, post_id=post.pk,
+                  author_id=post.author_id, pub_date=post.pub_date)
+        for user_id in followers.iterator()
+    )
+
+
+def backfill(user_id, author_id):
+    """Добавляет в ленту читателя все посты нового автора."""
+    if _pulled(author_id):
+        return
+    posts = Post.objects.filter(author_id=author_id).values_list(
+        'pk', 'pub_date')
+    _bulk_insert(
+        FeedEntry(user_id=user_id, post_id=post_id,
+                  author_id=author_id, pub_date=pub_date)
+        for post_id, pub_date in posts.iterator()
+    )
+
+
+def trim(user_id, author_id):
+    """Убирает из ленты читателя посты автора, от которого он отписался."""
+    FeedEntry.objects.filter(user_id=user_id, author_id=author_id).delete()
+
+
+def rebuild(user_ids):
+    """Пересобирает ленты указанных читателей с нуля."""
+    user_ids = list(user_ids)
+    follows = Follow.objects.filter(
+        user_id__in=user_ids).values_list('author_id', 'user_id')
+    pull = pull_author_ids()
+    readers = {}
+    for author_id, user_id in follows:
+        if author_id not in pull:
+            readers.setdefault(author_id, []).append(user_id)
+    posts = Post.objects.filter(author_id__in=readers).values_list(
+        'pk', 'author_id', 'pub_date')
+    with transaction.atomic():
+        FeedEntry.objects.filter(user_id__in=user_ids).delete()
+        _bulk_insert(
+            FeedEntry(user_id=user_id, post_id=post_id,
+                      author_id=author_id, pub_date=pub_date)
+            for post_id, author_id, pub_date in posts.iterator()
+            for user_id in readers[author_id]
+        )
+
+
+def get_feed_page(user, per_page, cursor=None, number=None):
+    """Страница ленты: FeedEntry, слитый с постами «популярных» авторов."""
+    pull = []
+    if pull_author_ids():
+        pull = list(Follow.objects.filter(
+            user=user, author__in=pull_author_ids()
+        ).values_list('author', flat=True))
+    entries = FeedEntry.objects.select_related(
+        'post__author', 'post__group').filter(user=user)
+    if pull:
+        # записи, разложенные до того, как автор стал «популярным»
+        entries = entries.exclude(author__in=pull)
+    sources = [(entries, ('-pub_date', '-post_id'), _entry_post)]
+    posts = Post.objects.select_related('author', 'group')
+    sources.extend(
+        (posts.filter(author_id=author_id), ('-pub_date', '-id'), None)
+        for author_id in pull
+    )
+    paginator = MergedCursorPaginator(sources, per_page, Post)
+    return paginator.get_page(cursor, number)
+
+
+def _entry_post(entry):
+    return entry.post
@@ -1,5 +1,7 @@
+from .ingest import ingest
 from .models import Post, Comment
 from django import forms
+from django.core.files.uploadedfile import UploadedFile
 
 
 class PostForm(forms.ModelForm):
@@ -18,6 +20,13 @@ class PostForm(forms.ModelForm):
             raise forms.ValidationError('Вы должны что-то написать')
         return data
 
+    def clean_image(self):
+        image = self.cleaned_data['image']
+        # новая загрузка, а не уже сохранённая картинка поста
+        if isinstance(image, UploadedFile):
+            return ingest(image)
+        return image
+
 
 class CommentForm(forms.ModelForm):
     class Meta:
@@ -0,0 +1,123 @@
+"""Приём картинки поста: проверка лимитов, очистка и уменьшение оригинала.
+
+Загрузка приходит уже во временном файле (``TemporaryFileUploadHandler``),
+поэтому в памяти держится только декодированная картинка. Её размер
+ограничен заранее: пиксели проверяются по заголовку до декодирования,
+а большой JPEG декодируется сразу в уменьшенном масштабе (``draft``).
+Пересохранение без ``exif`` убирает метаданные (геопозицию и т.п.),
+поворот из EXIF перед этим применяется к самим пикселям.
+
+Анимированные GIF и WebP не принимаются: пересохранение, миниатюры
+и варианты оставили бы от них только первый кадр.
+"""
+import os
+import tempfile
+import warnings
+
+from django import forms
+from django.conf import settings
+from django.core.files import File
+from PIL import Image, ImageOps
+
+# форматы, которые сохраняем как есть; остальное перекодируем в PNG
+KEEP_FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'WEBP': '.webp'}
+# режимы, которые формат пишет сам; прочие (CMYK, LAB, YCbCr...) переводим
+# в RGB, а с прозрачностью - в RGBA (GIF и WebP Pillow переводит сам)
+WRITABLE_MODES = {
+    'JPEG': {'RGB', 'L'},
+    'PNG': {'1', 'L', 'LA', 'I', 'I;16', 'P', 'RGB', 'RGBA'},
+}
+ALPHA_MODES = {'LA', 'PA', 'RGBA', 'RGBa'}
+
+
+def _open(upload):
+    """Открывает картинку, читая только заголовок; проверяет лимиты."""
+    if upload.size > settings.POST_IMAGE_MAX_BYTES:
+        raise forms.ValidationError(
+            'Файл больше %(limit)s МБ.',
+            params={'limit': settings.POST_IMAGE_MAX_BYTES // 2 ** 20},
+            code='file_too_large')
+    upload.seek(0)
+    with warnings.catch_warnings():
+        # предупреждение Pillow о «бомбе» считаем ошибкой
+        warnings.simplefilter('error', Image.DecompressionBombWarning)
+        try:
+            image = Image.open(upload)
+        except (Image.DecompressionBombError,
+                Image.DecompressionBombWarning):
+            image = None
+        except OSError:
+            raise forms.ValidationError(
+                'Файл не является картинкой.', code='invalid_image')
+    if image is None or (
+            image.width * image.height > settings.POST_IMAGE_MAX_PIXELS):
+        raise forms.ValidationError(
+            'Картинка больше %(limit)s Мпикс.',
+            params={'limit': settings.POST_IMAGE_MAX_PIXELS // 10 ** 6},
+            code='too_many_pixels')
+    if getattr(image, 'is_animated', False):
+        raise forms.ValidationError(
+            'Анимированные картинки не поддерживаются.',
+            code='animated_image')
+    return image
+
+
+def _name(upload, fmt):
+    root, extension = os.path.splitext(os.path.basename(upload.name))
+    if EXTENSIONS.get(fmt) == extension.lower().replace('.jpeg', '.jpg'):
+        return root + extension
+    return root + EXTENSIONS[fmt]
+
+
+def _convert(image, fmt):
+    """Картинка в режиме, который ``fmt`` умеет записать."""
+    if image.mode in WRITABLE_MODES.get(fmt, {image.mode}):
+        return image
+    alpha = image.mode in ALPHA_MODES and fmt != 'JPEG'
+    converted = image.convert('RGBA' if alpha else 'RGB')
+    # ICC-профиль описывает исходное пространство (например, CMYK)
+    converted.info.pop('icc_profile', None)
+    return converted
+
+
+def _reencode(image, fmt, output):
+    """Уменьшает, поворачивает и записывает картинку в ``output``."""
+    side = settings.POST_IMAGE_MAX_SIDE
+    ratio = min(side / image.width, side / image.height, 1)
+    # JPEG сразу декодируется не крупнее нужного (масштаб 1/2, 1/4, 1/8);
+    # reducing_gap=None, иначе thumbnail() перезапишет этот draft
+    image.draft('RGB', (max(1, round(image.width * ratio)),
+                        max(1, round(image.height * ratio))))
+    image.thumbnail((side, side), Image.LANCZOS, reducing_gap=None)
+    # поворот - уже на уменьшенной копии, чтобы не держать две большие
+    image = ImageOps.exif_transpose(image)
+    image = _convert(image, fmt)
+    options = {}
+    if image.info.get('icc_profile'):
+        options['icc_profile'] = image.info['icc_profile']
+    if fmt == 'JPEG':
+        options.update(quality=90, optimize=True)
+    if fmt == 'GIF' and 'transparency' in image.info:
+        options['transparency'] = image.info['transparency']
+    # exif не передаём: метаданные в новый файл не попадают
+    image.save(output, fmt, **options)
+
+
+def ingest(upload):
+    """Проверенная и очищенная копия загрузки во временном файле."""
+    image = _open(upload)
+    fmt = image.format if image.format in KEEP_FORMATS else 'PNG'
+    output = tempfile.TemporaryFile()
+    try:
+        # битый файл (например, обрезанный JPEG) проходит проверку
+        # заголовка и падает только при декодировании пикселей
+        _reencode(image, fmt, output)
+    except OSError:
+        output.close()
+        raise forms.ValidationError(
+            'Файл не является картинкой.', code='invalid_image')
+    finally:
+        image.close()
+    output.seek(0)
+    return File(output, name=_name(upload, fmt))
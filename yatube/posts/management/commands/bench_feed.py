@@ -0,0 +1,118 @@
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from core.testing import temporary_caches
+from posts import feed
+from posts.models import AuthorStats, Follow, Post
+from posts.paginator import CursorPaginator
+
+User = get_user_model()
+PER_PAGE = 10
+
+
+def create_users(prefix, number):
+    """bulk_create в SQLite не возвращает pk, поэтому перечитываем."""
+    User.objects.bulk_create(
+        User(username=f'{prefix}{i}') for i in range(number))
+    return list(User.objects.filter(username__startswith=prefix))
+
+
+def measure(func, repeat):
+    """Медиана времени выполнения func в миллисекундах."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает push-, pull- и гибридную ленту на крайних случаях: '
+            'автор с огромным числом подписчиков и читатель, подписанный '
+            'на тысячи авторов. Работает на временной тестовой базе.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--followers', type=int, default=20000,
+                            help='подписчиков у «популярного» автора')
+        parser.add_argument('--following', type=int, default=2000,
+                            help='подписок у «тяжёлого» читателя')
+        parser.add_argument('--posts-per-author', type=int, default=5)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with temporary_caches():
+                self.bench_write(options['followers'], options['repeat'])
+                self.bench_read(options['following'],
+                                options['posts_per_author'],
+                                options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def report(self, title, value):
+        self.stdout.write(f'  {title:<44} {value:9.2f} ms')
+
+    def bench_write(self, followers, repeat):
+        self.stdout.write(
+            f'Публикация поста автором с {followers} подписчиками:')
+        star = User.objects.create(username='star')
+        fans = create_users('fan', followers)
+        Follow.objects.bulk_create(
+            Follow(user=fan, author=star) for fan in fans)
+        AuthorStats.objects.filter(user=star).update(
+            followers_count=followers)
+        for title, threshold in (('push (fan-out on write)', followers),
+                                 ('hybrid (автор выше порога)', 0)):
+            with override_settings(FEED_PUSH_THRESHOLD=threshold):
+                feed.update_mode(star.pk)
+                cache.clear()
+                feed.pull_author_ids()
+                self.report(title, measure(
+                    lambda: Post.objects.create(author=star, text='x'),
+                    repeat))
+
+    def bench_read(self, following, posts_per_author, repeat):
+        self.stdout.write(
+            f'Лента читателя с {following} подписками '
+            f'({posts_per_author} постов у каждого автора):')
+        reader = User.objects.create(username='reader')
+        authors = create_users('author', following)
+        Follow.objects.bulk_create(
+            Follow(user=reader, author=author) for author in authors)
+        Post.objects.bulk_create(
+            Post(author=author, text='x')
+            for _ in range(posts_per_author) for author in authors)
+        cache.clear()
+        feed.rebuild([reader.pk])
+
+        def pull_page(cursor=None):
+            authors = Follow.objects.filter(
+                user=reader).values_list('author', flat=True)
+            posts = Post.objects.select_related(
+                'author', 'group').filter(author__in=authors)
+            return CursorPaginator(posts, PER_PAGE).get_page(cursor)
+
+        def feed_page(cursor=None):
+            return feed.get_feed_page(reader, PER_PAGE, cursor)
+
+        for title, get_page in (('pull (fan-out on read)', pull_page),
+                                ('push/hybrid (FeedEntry)', feed_page)):
+            first = get_page()
+            deep = first
+            for _ in range(50):
+                if deep.next_cursor:
+                    deep = get_page(deep.next_cursor)
+            cursor = deep.previous_cursor
+            self.report(f'{title}: первая страница',
+                        measure(lambda: list(get_page()), repeat))
+            self.report(f'{title}: страница ~50',
+                        measure(lambda: list(get_page(cursor)), repeat))
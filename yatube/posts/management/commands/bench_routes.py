@@ -0,0 +1,289 @@
+import json
+import random
+import resource
+import time
+import tracemalloc
+from datetime import timedelta
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from faker import Faker
+from mixer.backend.django import mixer
+
+from about import urls as about_urls
+from core.middleware import QueryRecorder
+from core.testing import temporary_caches
+from posts import autocomplete, feed, membership
+from posts.bulk import batches, explicit_dates
+from posts import urls as posts_urls
+from posts.models import Comment, Follow, Group, Post
+
+User = get_user_model()
+BATCH_SIZE = 5000
+# показатель Ципфа: у немногих авторов большая часть подписчиков и постов
+SKEW = 1.1
+TEXTS = 2000
+# параметры GET для маршрутов, которым без них нечего делать
+QUERIES = {
+    'posts:search': {'q': 'пост'},
+    'posts:autocomplete': {'q': 'a'},
+}
+# маршруты, которые читателю ответят редиректом: их меряем от имени
+# автора поста и сотрудника
+AS_AUTHOR = {'posts:post_edit'}
+AS_STAFF = {'posts:export'}
+
+
+def percentile(timings, share):
+    """Значение по рангу из отсортированного списка."""
+    rank = max(round(share * len(timings)) - 1, 0)
+    return timings[min(rank, len(timings) - 1)]
+
+
+def peak_rss():
+    """Пик RSS процесса в КБ (VmHWM; без /proc - ru_maxrss)."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Command(BaseCommand):
+    help = ('Заполняет временную базу большим объёмом данных и прогоняет '
+            'все именованные маршруты posts и about через тестовый клиент: '
+            'p50/p95/p99, запросы к БД и память на маршрут, итог - в JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100000)
+        parser.add_argument('--posts', type=int, default=1000000)
+        parser.add_argument('--follows', type=int, default=2000000)
+        parser.add_argument('--comments', type=int, default=500000)
+        parser.add_argument('--groups', type=int, default=100)
+        parser.add_argument('--requests', type=int, default=50,
+                            help='замеров на маршрут после прогрева')
+        parser.add_argument('--db',
+                            help='файл SQLite для данных; сохраняется '
+                                 'между запусками и заполняется один раз')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='зерно генератора случайных данных')
+        parser.add_argument('--output', help='куда сохранить JSON')
+        parser.add_argument('--compare', help='JSON прошлого прогона')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.random = random.Random(options['seed'])
+        keep = bool(options['db'])
+        if keep:
+            connection.settings_dict['TEST']['NAME'] = options['db']
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False, keepdb=keep)
+        try:
+            # cache.clear() в замерах не должен стирать кэш сайта
+            with temporary_caches():
+                if not Post.objects.exists():
+                    self.populate()
+                # индексы процесса собраны до bulk_create
+                membership.state.filter = None
+                autocomplete.state.index = None
+                # база из --db могла быть заполнена с другими объёмами
+                volumes = {model._meta.model_name: model.objects.count()
+                           for model in (User, Post, Follow, Comment, Group)}
+                # DEBUG копит все запросы в connection.queries
+                with override_settings(DEBUG=False):
+                    results = self.run_routes()
+        finally:
+            if not keep:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+        report = {
+            'started': timezone.now().isoformat(),
+            'volumes': volumes,
+            'requests': options['requests'],
+            'peak_rss_kb': peak_rss(),
+            'routes': results,
+        }
+        output = options['output'] or time.strftime(
+            'bench-routes-%Y%m%d-%H%M%S.json')
+        with open(output, 'w') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        self.print_report(results)
+        if options['compare']:
+            self.compare(results, options['compare'])
+        self.stdout.write(self.style.SUCCESS(f'Результаты: {output}'))
+
+    def populate(self):
+        fake = Faker('ru_RU')
+        fake.seed_instance(self.options['seed'])
+        started = time.monotonic()
+        texts = [fake.text(max_nb_chars=300) for _ in range(TEXTS)]
+        groups = [mixer.blend(Group, slug=f'group-{i}')
+                  for i in range(self.options['groups'])]
+        users = (User(username=f'{fake.user_name()}{i}', password='!')
+                 for i in range(self.options['users']))
+        for batch in batches(users, BATCH_SIZE):
+            User.objects.bulk_create(batch)
+        user_ids = list(User.objects.values_list('pk', flat=True))
+        weights = self.zipf(len(user_ids))
+        self.seed_follows(user_ids, weights)
+        start = timezone.now() - timedelta(days=365)
+        step = timedelta(days=365) / max(self.options['posts'], 1)
+        posts = (
+            Post(author_id=author_id, text=self.random.choice(texts),
+                 group=self.random.choice(groups + [None]),
+                 pub_date=start + step * i)
+            for i, author_id in enumerate(self.choose(
+                user_ids, weights, self.options['posts'])))
+        with explicit_dates(Post, 'pub_date'):
+            for batch in batches(posts, BATCH_SIZE):
+                Post.objects.bulk_create(batch)
+        last_post = Post.objects.order_by('-pk').values_list(
+            'pk', flat=True).first()
+        comments = (
+            Comment(post_id=self.random.randint(1, last_post),
+                    author_id=self.random.choice(user_ids),
+                    text=self.random.choice(texts)[:100])
+            for _ in range(self.options['comments']))
+        for batch in batches(comments, BATCH_SIZE):
+            Comment.objects.bulk_create(batch)
+        # bulk_create не шлёт сигналов: счётчики пересчитываем
+        call_command('reconcile_stats', stdout=StringIO())
+        self.stdout.write(
+            f'Данные созданы за {time.monotonic() - started:.0f} с')
+
+    def zipf(self, number):
+        total, weights = 0.0, []
+        for rank in range(number):
+            total += 1 / (rank + 1) ** SKEW
+            weights.append(total)
+        return weights
+
+    def choose(self, population, cum_weights, number):
+        for batch in batches(range(number), BATCH_SIZE):
+            yield from self.random.choices(
+                population, cum_weights=cum_weights, k=len(batch))
+
+    def seed_follows(self, user_ids, weights):
+        authors = self.choose(user_ids, weights, self.options['follows'])
+        pairs = (
+            Follow(user_id=self.random.choice(user_ids), author_id=author)
+            for author in authors)
+        for batch in batches(pairs, BATCH_SIZE):
+            Follow.objects.bulk_create(
+                [follow for follow in batch
+                 if follow.user_id != follow.author_id],
+                ignore_conflicts=True)
+
+    def fixtures(self):
+        """Значения параметров маршрутов: самые «тяжёлые» объекты."""
+        author = User.objects.order_by(
+            '-stats__followers_count').first()
+        reader = User.objects.order_by(
+            '-stats__following_count').first()
+        post = Post.objects.filter(author=author).order_by(
+            '-pk').first() or Post.objects.first()
+        group = Group.objects.order_by('pk').first()
+        feed.rebuild([reader.pk])
+        staff, _ = User.objects.get_or_create(
+            username='bench-staff', defaults={'is_staff': True})
+        return {'reader': reader, 'author': post.author, 'staff': staff}, {
+            'username': author.username,
+            'slug': group.slug,
+            'post_id': post.pk,
+            'name': 'posts',
+        }
+
+    def routes(self, values):
+        for app_name, module in (('posts', posts_urls),
+                                 ('about', about_urls)):
+            for pattern in module.urlpatterns:
+                if not pattern.name:
+                    continue
+                kwargs = {name: values[name]
+                          for name in pattern.pattern.converters}
+                yield f'{app_name}:{pattern.name}', kwargs
+
+    def run_routes(self):
+        users, values = self.fixtures()
+        clients = {}
+        for role, user in users.items():
+            clients[role] = Client()
+            clients[role].force_login(user)
+        results = {}
+        for name, kwargs in self.routes(values):
+            url = reverse(name, kwargs=kwargs)
+            client = clients['author' if name in AS_AUTHOR else (
+                'staff' if name in AS_STAFF else 'reader')]
+            method, data = client.get, QUERIES.get(name)
+            if name == 'posts:add_comment':
+                method, data = client.post, {'text': 'замер'}
+            results[name] = self.measure(method, url, data)
+            self.stdout.write(f'{name}: p95 {results[name]["p95_ms"]} ms')
+        return results
+
+    def measure(self, method, url, data):
+        cache.clear()
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            status = method(url, data).status_code
+        cold = (time.perf_counter() - started) * 1000
+        cold_queries = recorder.count
+        timings = []
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            for _ in range(self.options['requests']):
+                started = time.perf_counter()
+                method(url, data)
+                timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        tracemalloc.start()
+        method(url, data)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        requests = max(self.options['requests'], 1)
+        return {
+            'url': url,
+            'status': status,
+            'cold_ms': round(cold, 2),
+            'p50_ms': round(percentile(timings, 0.50), 2) if timings else None,
+            'p95_ms': round(percentile(timings, 0.95), 2) if timings else None,
+            'p99_ms': round(percentile(timings, 0.99), 2) if timings else None,
+            'cold_queries': cold_queries,
+            'queries': round(recorder.count / requests, 1),
+            'duplicated_queries': round(recorder.duplicates() / requests, 1),
+            'peak_alloc_kb': peak // 1024,
+        }
+
+    def print_report(self, results):
+        self.stdout.write(
+            f'{"маршрут":<28}{"p50":>9}{"p95":>9}{"p99":>9}'
+            f'{"запросы":>9}{"память, КБ":>12}')
+        for name, row in results.items():
+            self.stdout.write(
+                f'{name:<28}{row["p50_ms"]:>9}{row["p95_ms"]:>9}'
+                f'{row["p99_ms"]:>9}{row["queries"]:>9}'
+                f'{row["peak_alloc_kb"]:>12}')
+
+    def compare(self, results, path):
+        with open(path) as file:
+            previous = json.load(file)['routes']
+        self.stdout.write(f'Сравнение p95 с {path}:')
+        for name, row in results.items():
+            before = previous.get(name)
+            if not before or not before['p95_ms'] or not row['p95_ms']:
+                continue
+            change = (row['p95_ms'] / before['p95_ms'] - 1) * 100
+            self.stdout.write(
+                f'  {name:<28}{before["p95_ms"]:>9} -> {row["p95_ms"]:>9} '
+                f'({change:+.0f}%)')
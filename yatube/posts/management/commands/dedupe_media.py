@@ -0,0 +1,90 @@
+import os
+from itertools import islice
+
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from posts import media
+from posts.models import Post, StoredFile
+from posts.storage import content_hash, hashed_name
+
+UPLOAD_TO = 'posts'
+
+
+class Command(BaseCommand):
+    help = ('Переименовывает картинки постов по хэшу содержимого: '
+            'одинаковые файлы остаются на диске в одном экземпляре.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='только посчитать, ничего не менять')
+
+    def handle(self, *args, **options):
+        self.storage = media.storage()
+        self.dry_run = options['dry_run']
+        # в пробном прогоне файлы не переносятся: помним, что уже «занято»
+        self.planned = set()
+        self.moved = self.removed = self.freed = 0
+        root = self.storage.path(UPLOAD_TO)
+        if os.path.isdir(root):
+            entries = media.scan(root)
+            while True:
+                batch = list(islice(entries, options['batch_size']))
+                if not batch:
+                    break
+                self.dedupe(batch)
+        verb = 'будет' if self.dry_run else 'было'
+        self.stdout.write(self.style.SUCCESS(
+            f'Перенесено файлов: {self.moved}, удалено дубликатов: '
+            f'{self.removed}, освобождено {verb} {self.freed} байт'))
+
+    def dedupe(self, entries):
+        names = {
+            os.path.relpath(entry.path, self.storage.location).replace(
+                os.sep, '/'): entry
+            for entry in entries
+        }
+        referenced = Post.objects.filter(image__in=names).values_list(
+            'image', flat=True).distinct()
+        for name in referenced:
+            entry = names[name]
+            with open(entry.path, 'rb') as source:
+                digest = content_hash(File(source))
+            target = hashed_name(
+                UPLOAD_TO, digest, os.path.splitext(name)[1])
+            if target == name:
+                continue
+            duplicate = (target in self.planned
+                         or self.storage.exists(target))
+            if duplicate:
+                self.removed += 1
+                self.freed += entry.stat().st_size
+            else:
+                self.moved += 1
+            if self.dry_run:
+                self.planned.add(target)
+                continue
+            if duplicate:
+                os.remove(entry.path)
+            else:
+                os.makedirs(os.path.dirname(self.storage.path(target)),
+                            exist_ok=True)
+                os.replace(entry.path, self.storage.path(target))
+            self.relink(name, target)
+
+    def relink(self, name, target):
+        """Переводит посты и счётчик ссылок со старого имени на новое."""
+        posts = Post.objects.filter(image=name)
+        manifests = set(posts.values_list('image_variants', flat=True))
+        with transaction.atomic():
+            count = posts.update(image=target, image_variants='')
+            StoredFile.objects.filter(name=name).delete()
+            StoredFile.objects.get_or_create(name=target)
+            StoredFile.objects.filter(name=target).update(
+                references=F('references') + count)
+        # миниатюры и варианты старого имени больше не нужны
+        for manifest in manifests:
+            media.remove(name, manifest)
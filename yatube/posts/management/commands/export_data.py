@@ -0,0 +1,38 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from posts import export
+
+
+class Command(BaseCommand):
+    help = ('Потоково выгружает посты, комментарии или подписки в JSONL '
+            'или CSV (по желанию gzip) при постоянном расходе памяти.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(export.EXPORTS))
+        parser.add_argument('--format', choices=export.FORMATS,
+                            default='jsonl')
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--output',
+                            help='файл; по умолчанию - имя выгрузки, '
+                                 '"-" - стандартный вывод')
+        parser.add_argument('--chunk-size', type=int,
+                            default=export.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        name, fmt = options['name'], options['format']
+        output = options['output'] or export.filename(
+            name, fmt, options['gzip'])
+        chunks = export.stream(name, fmt, options['gzip'],
+                               options['chunk_size'])
+        written = 0
+        if output == '-':
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            return
+        with open(output, 'wb') as file:
+            for chunk in chunks:
+                written += file.write(chunk)
+        self.stdout.write(self.style.SUCCESS(
+            f'{output}: {written} байт'))
@@ -0,0 +1,164 @@
+import os
+import re
+import shutil
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from sorl.thumbnail import default
+from sorl.thumbnail.conf import settings as thumbnail_settings
+from sorl.thumbnail.helpers import deserialize
+from sorl.thumbnail.images import ImageFile
+from sorl.thumbnail.kvstores.base import add_prefix, del_prefix
+from sorl.thumbnail.models import KVStore as KVStoreModel
+
+from posts import media
+from posts.models import Post, StoredFile
+
+UPLOAD_TO = 'posts'
+# posts/<корень>.<ширина>w.<формат>, см. posts.variants.variant_name
+VARIANT = re.compile(r'(.+)\.\d+w\.\w+$')
+# корней в одном запросе: OR-цепочка упирается в глубину выражения SQLite
+ROOTS_PER_QUERY = 100
+
+
+class Command(BaseCommand):
+    help = ('Находит в MEDIA_ROOT картинки постов, их варианты и миниатюры '
+            'sorl, на которые ничто не ссылается, и убирает их в карантин '
+            '(или удаляет с --delete).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--min-age', type=int, default=24 * 60 * 60,
+                            help='не трогать файлы моложе стольких секунд')
+        parser.add_argument('--delete', action='store_true',
+                            help='удалять, а не переносить в карантин')
+        parser.add_argument('--quarantine',
+                            default=settings.MEDIA_QUARANTINE_ROOT)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='только показать сироты')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.root = settings.MEDIA_ROOT
+        self.cutoff = time.time() - options['min_age']
+        self.scanned = self.orphans = self.size = 0
+        stale = self.prune_kvstore()
+        for directory in (UPLOAD_TO, thumbnail_settings.THUMBNAIL_PREFIX):
+            path = os.path.join(self.root, directory)
+            if not os.path.isdir(path):
+                continue
+            entries = media.scan(path)
+            while True:
+                batch = list(islice(entries, options['batch_size']))
+                if not batch:
+                    break
+                self.collect(batch)
+        verb = 'найдено' if options['dry_run'] else (
+            'удалено' if options['delete'] else 'в карантине')
+        self.stdout.write(self.style.SUCCESS(
+            f'Просмотрено файлов: {self.scanned}, {verb} сирот: '
+            f'{self.orphans} ({self.size} байт), записей sorl без '
+            f'картинки поста: {stale}'))
+
+    def prune_kvstore(self):
+        """Снимает из KV-хранилища sorl миниатюры картинок без постов.
+
+        Их файлы после этого не найдутся в KV-хранилище и уйдут как сироты.
+        """
+        prefix = add_prefix('', 'thumbnails')
+        last, stale = prefix, 0
+        while True:
+            lists = dict(KVStoreModel.objects.filter(
+                key__startswith=prefix, key__gt=last).order_by(
+                'key').values_list('key', 'value')[
+                :self.options['batch_size']])
+            if not lists:
+                return stale
+            last = max(lists)
+            sources = KVStoreModel.objects.filter(key__in=[
+                add_prefix(del_prefix(key)) for key in lists
+            ]).values_list('key', 'value')
+            names = {deserialize(value)['name']: key
+                     for key, value in sources}
+            used = set(Post.objects.filter(image__in=names).values_list(
+                'image', flat=True))
+            for name in names.keys() - used:
+                stale += 1
+                if self.options['dry_run']:
+                    continue
+                # файлы не трогаем: их судьбу решит проход по диску
+                source = names[name]
+                thumbnails = add_prefix(del_prefix(source), 'thumbnails')
+                default.kvstore._delete_raw(source, thumbnails, *(
+                    add_prefix(key)
+                    for key in deserialize(lists[thumbnails])))
+
+    def live_variants(self, names):
+        """Варианты из пачки, которые числятся в манифестах постов.
+
+        Расширение оригинала по имени варианта не угадать, поэтому берутся
+        посты с любой картинкой того же корня (диапазон по индексу
+        ``image``), а живые варианты - из их манифестов.
+        """
+        roots = sorted({match.group(1) for match in map(VARIANT.match, names)
+                        if match})
+        live = set()
+        for start in range(0, len(roots), ROOTS_PER_QUERY):
+            query = Q()
+            for root in roots[start:start + ROOTS_PER_QUERY]:
+                # root.* лежит между "root." и "root/": "." < "/"
+                query |= Q(image__gt=root + '.', image__lt=root + '/')
+            manifests = Post.objects.filter(query).exclude(
+                image_variants='').values_list(
+                'image_variants', flat=True).order_by()
+            live.update(name for manifest in manifests
+                        for name in media.variant_names(manifest))
+        return live.intersection(names)
+
+    def collect(self, entries):
+        names = {}
+        for entry in entries:
+            self.scanned += 1
+            # свежий файл может принадлежать ещё не сохранённому посту
+            if entry.stat().st_mtime > self.cutoff:
+                continue
+            name = os.path.relpath(entry.path, self.root).replace(os.sep, '/')
+            names[name] = entry
+        used = self.referenced(list(names))
+        for name in names.keys() - used:
+            self.orphan(name, names[name])
+        if not self.options['dry_run']:
+            StoredFile.objects.filter(
+                name__in=names.keys() - used).delete()
+
+    def referenced(self, names):
+        """Имена из пачки, на которые ссылаются пост или KV-хранилище."""
+        used = set(Post.objects.filter(image__in=names).values_list(
+            'image', flat=True))
+        used.update(self.live_variants(names))
+        thumbnails = {
+            add_prefix(ImageFile(name, default.storage).key): name
+            for name in names
+            if name.startswith(thumbnail_settings.THUMBNAIL_PREFIX)
+        }
+        used.update(
+            thumbnails[key] for key in KVStoreModel.objects.filter(
+                key__in=thumbnails).values_list('key', flat=True))
+        return used
+
+    def orphan(self, name, entry):
+        self.orphans += 1
+        self.size += entry.stat().st_size
+        if self.options['verbosity'] > 1:
+            self.stdout.write(name)
+        if self.options['dry_run']:
+            return
+        if self.options['delete']:
+            os.remove(entry.path)
+            return
+        target = os.path.join(self.options['quarantine'], name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(entry.path, target)
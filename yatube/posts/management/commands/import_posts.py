@@ -0,0 +1,302 @@
+import csv
+import json
+import os
+import time
+from collections import Counter
+from io import StringIO
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from posts import autocomplete, caching, feed, membership
+from posts.bulk import batches, explicit_dates
+from posts.models import (Comment, Follow, Group, ImportedPost,
+                          ImportProgress, Post)
+
+User = get_user_model()
+FEED_CHUNK = 500
+
+
+def read_jsonl(file):
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_csv(file):
+    for row in csv.DictReader(file):
+        yield {key: value or None for key, value in row.items()}
+
+
+def kind(record):
+    """Тип строки: явный или по ссылке на пост."""
+    return record.get('type') or (
+        'comment' if record.get('post') else 'post')
+
+
+def parse_date(value):
+    """Дата строки; без даты - сейчас, неразборчивая или несуществующая
+    (например, 2021-13-45) - None: такую строку пропускаем."""
+    if not value:
+        return timezone.now()
+    try:
+        date = parse_datetime(value)
+    except ValueError:
+        return None
+    if date is None:
+        return None
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date, timezone.utc)
+    return date
+
+
+class Command(BaseCommand):
+    help = ('Импортирует посты и комментарии из JSONL или CSV пачками '
+            'bulk_create. Прерванный импорт продолжается с места сбоя.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=('jsonl', 'csv'),
+                            help='по умолчанию - по расширению файла')
+        parser.add_argument('--source',
+                            help='имя импорта для продолжения; по умолчанию '
+                                 '- имя файла')
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help='строк в одной транзакции')
+        parser.add_argument('--create-missing', action='store_true',
+                            help='создавать неизвестных авторов и группы')
+        parser.add_argument('--keep-indexes', action='store_true',
+                            help='не снимать индексы постов на время импорта')
+
+    def handle(self, *args, **options):
+        self.options = options
+        if not os.path.isfile(options['path']):
+            raise CommandError(f'Нет файла {options["path"]}')
+        self.source = options['source'] or os.path.basename(options['path'])
+        progress, _ = ImportProgress.objects.get_or_create(
+            source=self.source)
+        if progress.finished:
+            self.stdout.write(f'{self.source} уже импортирован')
+            return
+        if progress.rows:
+            self.stdout.write(f'Продолжаем после строки {progress.rows}')
+        self.authors, self.groups, self.posts = {}, {}, {}
+        self.done = progress.rows
+        self.imported = self.skipped = self.created_users = 0
+        # комментарии к ещё не встреченным постам: {внешний id: сколько}
+        self.waiting = Counter()
+        self.early = 0
+        deferred = [] if options['keep_indexes'] else self.drop_indexes()
+        started = time.monotonic()
+        fmt = options['format'] or (
+            'csv' if options['path'].endswith('.csv') else 'jsonl')
+        reader = read_csv if fmt == 'csv' else read_jsonl
+        with open(options['path'], encoding='utf-8', newline='') as file:
+            records = islice(enumerate(reader(file)), progress.rows, None)
+            for batch in batches(records, options['batch_size']):
+                self.import_batch(batch)
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f'Строк: {self.done}, '
+                    f'{(self.done - progress.rows) / elapsed:.0f} строк/с')
+        self.finish(deferred)
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Импортировано: {self.imported}, пропущено: {self.skipped}, '
+            f'новых авторов: {self.created_users}, '
+            f'{(self.done - progress.rows) / max(elapsed, 1e-9):.0f} '
+            f'строк/с'))
+        if self.early:
+            self.stdout.write(self.style.WARNING(
+                f'Из пропущенных комментариев {self.early} стоят в файле '
+                f'раньше своего поста: перенесите их ниже и повторите '
+                f'импорт с другим --source'))
+
+    def drop_indexes(self):
+        """Снимает индексы постов и комментариев; вернёт их finish()."""
+        dropped = []
+        with connection.cursor() as cursor:
+            existing = {
+                model: connection.introspection.get_constraints(
+                    cursor, model._meta.db_table)
+                for model in (Post, Comment)}
+        with connection.schema_editor() as editor:
+            for model in (Post, Comment):
+                for index in model._meta.indexes:
+                    if index.name in existing[model]:
+                        editor.remove_index(model, index)
+                # после сбоя индексы уже сняты, но вернуть их всё равно нужно
+                dropped.extend((model, index) for index in model._meta.indexes)
+        return dropped
+
+    def import_batch(self, batch):
+        posts = [(row, record) for row, record in batch
+                 if kind(record) == 'post']
+        comments = [(row, record) for row, record in batch
+                    if kind(record) == 'comment']
+        self.skipped += len(batch) - len(posts) - len(comments)
+        done = batch[-1][0] + 1
+        with transaction.atomic(), explicit_dates(Post, 'pub_date'), (
+                explicit_dates(Comment, 'created')):
+            # прогресс пишется первым: эта запись берёт блокировку записи
+            # SQLite, и до коммита никто не вставит посты (см. insert_posts)
+            ImportProgress.objects.filter(source=self.source).update(
+                rows=done)
+            self.resolve_authors(record for _, record in batch)
+            self.resolve_groups(record for _, record in posts)
+            self.insert_posts(posts)
+            self.insert_comments(comments)
+        self.done = done
+
+    def resolve_authors(self, records):
+        names = {record.get('author') for record in records} - {None}
+        unknown = names - self.authors.keys()
+        if not unknown:
+            return
+        self.authors.update(User.objects.filter(
+            username__in=unknown).values_list('username', 'pk'))
+        missing = unknown - self.authors.keys()
+        if not missing or not self.options['create_missing']:
+            return
+        User.objects.bulk_create(
+            User(username=name, password=make_password(None))
+            for name in missing)
+        self.authors.update(User.objects.filter(
+            username__in=missing).values_list('username', 'pk'))
+        self.created_users += len(missing)
+        for name in missing:
+            membership.added(membership.USER, name)
+
+    def resolve_groups(self, records):
+        slugs = {record.get('group') for record in records} - {None}
+        unknown = slugs - self.groups.keys()
+        if not unknown:
+            return
+        self.groups.update(Group.objects.filter(
+            slug__in=unknown).values_list('slug', 'pk'))
+        missing = unknown - self.groups.keys()
+        if not missing or not self.options['create_missing']:
+            return
+        for slug in missing:
+            # групп мало: обычный save, чтобы сработали сигналы
+            self.groups[slug] = Group.objects.create(
+                slug=slug, title=slug).pk
+
+    def insert_posts(self, rows):
+        # строки без id получают номер строки: он не меняется между запусками
+        external = {str(record.get('id') or f'#{row}'): record
+                    for row, record in rows}
+        self.posts.update(ImportedPost.objects.filter(
+            source=self.source, external_id__in=external).values_list(
+            'external_id', 'post_id'))
+        for external_id in external.keys() & self.waiting.keys():
+            self.early += self.waiting.pop(external_id)
+        dates = {external_id: parse_date(record.get('pub_date'))
+                 for external_id, record in external.items()}
+        new = [(external_id, record)
+               for external_id, record in external.items()
+               if external_id not in self.posts
+               and record.get('author') in self.authors
+               and dates[external_id] is not None]
+        self.skipped += len(rows) - len(new)
+        if not new:
+            return
+        # bulk_create в SQLite не возвращает pk, поэтому назначаем их сами:
+        # соответствие строк и постов точное. Пост с тем же pk из другого
+        # процесса дал бы IntegrityError и откат пачки, а не чужой пост
+        first = self.next_post_pk()
+        pks = range(first, first + len(new))
+        Post.objects.bulk_create(
+            Post(pk=pk, author_id=self.authors[record['author']],
+                 group_id=self.groups.get(record.get('group')),
+                 text=record.get('text') or '',
+                 pub_date=dates[external_id])
+            for (external_id, record), pk in zip(new, pks))
+        ImportedPost.objects.bulk_create(
+            ImportedPost(source=self.source, external_id=external_id,
+                         post_id=pk)
+            for (external_id, _), pk in zip(new, pks))
+        self.posts.update(
+            (external_id, pk) for (external_id, _), pk in zip(new, pks))
+        self.imported += len(new)
+
+    def next_post_pk(self):
+        """pk после всех выданных, в том числе у удалённых постов."""
+        last = Post.objects.aggregate(last=Max('pk'))['last'] or 0
+        if connection.vendor == 'sqlite':
+            # AUTOINCREMENT помнит выданные pk в sqlite_sequence
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT seq FROM sqlite_sequence WHERE name = %s',
+                    [Post._meta.db_table])
+                row = cursor.fetchone()
+            last = max(last, row[0] if row else 0)
+        return last + 1
+
+    def insert_comments(self, rows):
+        wanted = {str(record['post']) for _, record in rows
+                  if record.get('post')} - self.posts.keys()
+        if wanted:
+            self.posts.update(ImportedPost.objects.filter(
+                source=self.source, external_id__in=wanted).values_list(
+                'external_id', 'post_id'))
+        comments = []
+        for _, record in rows:
+            post = str(record.get('post'))
+            created = parse_date(record.get('created'))
+            if post not in self.posts:
+                # пост может встретиться ниже: тогда об этом сообщим
+                self.waiting[post] += 1
+            elif record.get('author') in self.authors and created:
+                comments.append(Comment(
+                    post_id=self.posts[post],
+                    author_id=self.authors[record['author']],
+                    text=record.get('text') or '', created=created))
+        self.skipped += len(rows) - len(comments)
+        Comment.objects.bulk_create(comments)
+        self.imported += len(comments)
+
+    def finish(self, deferred):
+        """Всё, что отложено до конца: индексы, счётчики, ленты, кэши."""
+        self.stdout.write('Возвращаем индексы, пересчитываем счётчики')
+        if deferred:
+            with connection.cursor() as cursor:
+                existing = {
+                    model: connection.introspection.get_constraints(
+                        cursor, model._meta.db_table)
+                    for model in (Post, Comment)}
+            with connection.schema_editor() as editor:
+                for model, index in deferred:
+                    if index.name not in existing[model]:
+                        editor.add_index(model, index)
+        imported = Post.objects.filter(pk__in=ImportedPost.objects.filter(
+            source=self.source).values('post'))
+        authors = set(imported.values_list('author_id', flat=True))
+        # bulk_create не шлёт сигналов: счётчики и ленты - отдельно.
+        # Комментарии импорта - только к импортированным постам
+        commenters = set(Comment.objects.filter(
+            post__in=imported).values_list('author_id', flat=True))
+        if authors | commenters:
+            call_command('reconcile_stats', users=authors | commenters,
+                         stdout=StringIO())
+        groups = set(imported.exclude(group=None).values_list(
+            'group_id', flat=True))
+        readers = Follow.objects.filter(author__in=authors).values_list(
+            'user_id', flat=True).distinct().order_by('user_id')
+        for chunk in batches(readers.iterator(), FEED_CHUNK):
+            feed.rebuild(chunk)
+        caching.bump_generation(
+            caching.INDEX, *map(caching.author_scope, authors),
+            *map(caching.group_scope, groups))
+        # авторы из bulk_create (и в прерванных запусках) не прошли
+        # через сигналы: индекс автодополнения пересоберут все процессы
+        autocomplete.invalidate()
+        ImportProgress.objects.filter(source=self.source).update(
+            finished=True)
@@ -0,0 +1,45 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from posts import feed
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = ('Пересобирает материализованные ленты подписок порциями '
+            '(например, после bulk_create, который не шлёт сигналов).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*',
+                            help='только ленты этих пользователей')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='сколько читателей пересобирать за раз')
+        parser.add_argument('--modes-only', action='store_true',
+                            help='только сменить режимы авторов по порогу')
+
+    def handle(self, *args, **options):
+        # порог мог смениться, а к раскладке авторы возвращаются только
+        # здесь: сначала режимы авторов, затем ленты
+        switched = feed.sync_modes()
+        if switched:
+            self.stdout.write(f'Сменили режим авторов: {switched}')
+        if options['modes_only']:
+            self.stdout.write(self.style.SUCCESS('Готово'))
+            return
+        users = User.objects.order_by('pk')
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+        chunk_size = options['chunk_size']
+        last_pk = 0
+        done = 0
+        while True:
+            chunk = list(users.filter(pk__gt=last_pk).values_list(
+                'pk', flat=True)[:chunk_size])
+            if not chunk:
+                break
+            feed.rebuild(chunk)
+            last_pk = chunk[-1]
+            done += len(chunk)
+            self.stdout.write(f'Пересобрано лент: {done}')
+        self.stdout.write(self.style.SUCCESS('Готово'))
@@ -0,0 +1,76 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from posts.models import AuthorStats
+from posts.stats import COUNTERS, recount
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = ('Пересчитывает счётчики AuthorStats порциями пользователей '
+            'и сообщает о расхождениях с данными.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='только показать расхождения')
+        parser.add_argument('--users', type=int, nargs='+',
+                            help='проверить только этих пользователей (id)')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        checked = drifted = 0
+        for user_ids in self.user_batches(options['users'], batch_size):
+            checked += len(user_ids)
+            drifted += self.reconcile(user_ids, dry_run)
+        verb = 'найдено' if dry_run else 'исправлено'
+        self.stdout.write(self.style.SUCCESS(
+            f'Проверено пользователей: {checked}, {verb} расхождений: '
+            f'{drifted}'))
+
+    def user_batches(self, users, batch_size):
+        if users:
+            users = sorted(set(users))
+            for start in range(0, len(users), batch_size):
+                yield users[start:start + batch_size]
+            return
+        last_pk = 0
+        while True:
+            user_ids = list(User.objects.filter(pk__gt=last_pk).order_by(
+                'pk').values_list('pk', flat=True)[:batch_size])
+            if not user_ids:
+                return
+            last_pk = user_ids[-1]
+            yield user_ids
+
+    def reconcile(self, user_ids, dry_run):
+        actual = recount(user_ids)
+        stored = AuthorStats.objects.in_bulk(user_ids)
+        missing, changed = [], []
+        for user_id, counts in actual.items():
+            stats = stored.get(user_id)
+            if stats is None:
+                self.stdout.write(f'user={user_id}: нет записи статистики')
+                missing.append(AuthorStats(user_id=user_id, **counts))
+                continue
+            drift = {
+                name: (getattr(stats, name), value)
+                for name, value in counts.items()
+                if getattr(stats, name) != value
+            }
+            if drift:
+                self.stdout.write(f'user={user_id}: ' + ', '.join(
+                    f'{name} {old} -> {new}'
+                    for name, (old, new) in drift.items()))
+                for name, (_, value) in drift.items():
+                    setattr(stats, name, value)
+                changed.append(stats)
+        if not dry_run:
+            with transaction.atomic():
+                AuthorStats.objects.bulk_create(missing,
+                                                ignore_conflicts=True)
+                AuthorStats.objects.bulk_update(changed, list(COUNTERS))
+        return len(missing) + len(changed)
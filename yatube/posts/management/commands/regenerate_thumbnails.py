@@ -0,0 +1,190 @@
+import os
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from io import BytesIO
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from PIL import Image, ImageOps
+
+from posts import thumbnails, variants
+from posts.models import Post
+
+DEFAULT_CHECKPOINT = os.path.join(
+    tempfile.gettempdir(), 'yatube-regenerate-thumbnails.checkpoint')
+PAGE_SIZE = 500
+
+
+def _init_worker():
+    # родитель закрыл соединения перед fork; свои процесс откроет сам
+    connections.close_all()
+
+
+def _regenerate(name, force):
+    try:
+        return name, thumbnails.build(name, force), None
+    except Exception as error:
+        return name, 0, repr(error)
+
+
+def estimate_cpu(name):
+    """CPU на картинку: та же работа, что у build(), но без записи."""
+    started = time.process_time()
+    with Post._meta.get_field('image').storage.open(name) as source:
+        image = Image.open(source).convert('RGB')
+    width, height = map(int, thumbnails.POST_GEOMETRY.split('x'))
+    sizes = [(width, height, 'JPEG')] + [
+        (size, round(size * variants.ASPECT), fmt)
+        for fmt in variants.formats() for size in settings.POST_IMAGE_WIDTHS
+    ]
+    for width, height, fmt in sizes:
+        resized = ImageOps.fit(image, (width, height), Image.LANCZOS)
+        resized.save(BytesIO(), fmt)
+    return time.process_time() - started
+
+
+class Command(BaseCommand):
+    help = ('Перестраивает миниатюры и WebP/AVIF-варианты всех картинок '
+            'постов в пуле процессов, с продолжением с места остановки.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='процессов в пуле; 0 - без пула')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='не больше стольких картинок в секунду')
+        parser.add_argument('--force', action='store_true',
+                            help='удалить и построить заново готовые')
+        parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT,
+                            help='файл с последней обработанной картинкой')
+        parser.add_argument('--restart', action='store_true',
+                            help='начать сначала, забыв checkpoint')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='только оценить CPU-время на выборке')
+        parser.add_argument('--sample', type=int, default=5)
+        parser.add_argument('--progress-every', type=int, default=100)
+
+    def handle(self, *args, **options):
+        self.options = options
+        last = '' if options['restart'] else self.read_checkpoint()
+        images = Post.objects.exclude(image='').order_by(
+            'image').values_list('image', flat=True).distinct()
+        total = images.filter(image__gt=last).count()
+        if last:
+            self.stdout.write(f'Продолжаем после {last}')
+        if options['dry_run']:
+            return self.estimate(images.filter(image__gt=last), total)
+        self.done = self.failed = 0
+        self.cpu = 0.0
+        self.started = time.monotonic()
+        self.next_slot = 0
+        if options['workers']:
+            self.run_pool(self.pages(images, last), total)
+        else:
+            for page in self.pages(images, last):
+                for name in page:
+                    self.throttle()
+                    self.finished(_regenerate(name, options['force']), total)
+                    self.write_checkpoint(name)
+        # прогон дошёл до конца: следующий начнётся сначала
+        if os.path.exists(options['checkpoint']):
+            os.remove(options['checkpoint'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Готово: {self.done}, ошибок: {self.failed}, '
+            f'CPU {self.cpu:.1f} с'))
+
+    def pages(self, images, last):
+        """Имена картинок keyset-страницами по возрастанию."""
+        while True:
+            page = list(images.filter(image__gt=last)[:PAGE_SIZE])
+            if not page:
+                return
+            last = page[-1]
+            yield page
+
+    def run_pool(self, pages, total):
+        workers = self.options['workers']
+        # checkpoint двигаем только по непрерывному префиксу готовых имён
+        order, completed = deque(), set()
+        pending = set()
+        with ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+            for page in pages:
+                # пул форкает процессы на submit: соединение с БД
+                # к этому моменту должно быть закрыто
+                connections.close_all()
+                for name in page:
+                    self.throttle()
+                    order.append(name)
+                    pending.add(pool.submit(
+                        _regenerate, name, self.options['force']))
+                    # не больше двух задач на процесс в очереди
+                    if len(pending) >= workers * 2:
+                        done, pending = wait(
+                            pending, return_when=FIRST_COMPLETED)
+                        self.collect(done, order, completed, total)
+            done, _ = wait(pending)
+            self.collect(done, order, completed, total)
+
+    def collect(self, futures, order, completed, total):
+        for future in futures:
+            name = self.finished(future.result(), total)
+            completed.add(name)
+        last = None
+        while order and order[0] in completed:
+            last = order.popleft()
+            completed.discard(last)
+        if last is not None:
+            self.write_checkpoint(last)
+
+    def finished(self, result, total):
+        name, cpu, error = result
+        self.done += 1
+        self.cpu += cpu
+        if error:
+            self.failed += 1
+            self.stderr.write(f'{name}: {error}')
+        if self.done % self.options['progress_every'] == 0:
+            elapsed = time.monotonic() - self.started
+            rate = self.done / elapsed if elapsed else 0
+            left = (total - self.done) / rate if rate else 0
+            self.stdout.write(
+                f'{self.done}/{total}, {rate:.1f} картинок/с, '
+                f'осталось ~{left:.0f} с')
+        return name
+
+    def throttle(self):
+        """Не чаще ``--rate`` запусков в секунду."""
+        rate = self.options['rate']
+        if not rate:
+            return
+        now = time.monotonic()
+        if self.next_slot > now:
+            time.sleep(self.next_slot - now)
+        self.next_slot = max(self.next_slot, now) + 1 / rate
+
+    def estimate(self, images, total):
+        sample = list(images[:self.options['sample']])
+        if not sample:
+            self.stdout.write('Нечего перестраивать')
+            return
+        per_image = sum(map(estimate_cpu, sample)) / len(sample)
+        workers = self.options['workers'] or 1
+        self.stdout.write(
+            f'Картинок: {total}, CPU на картинку ~{per_image:.3f} с, '
+            f'всего ~{per_image * total:.0f} с CPU, '
+            f'~{per_image * total / workers:.0f} с на {workers} процессах')
+
+    def read_checkpoint(self):
+        try:
+            with open(self.options['checkpoint']) as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            return ''
+
+    def write_checkpoint(self, name):
+        path = self.options['checkpoint']
+        with open(path + '.tmp', 'w') as file:
+            file.write(name)
+        os.replace(path + '.tmp', path)
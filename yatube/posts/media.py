@@ -0,0 +1,145 @@
+"""Счётчик ссылок постов на файлы хранилища картинок.
+
+Одинаковые загрузки хранятся одним файлом (``posts.storage``), поэтому
+удалять файл вместе с постом нельзя. Сигналы постов вызывают ``acquire``
+и ``release``; файл, его миниатюры sorl и WebP/AVIF-варианты удаляются
+после коммита, когда ссылок не осталось.
+
+Хранилище, найдя на диске такой же файл, сразу берёт на него ссылку
+(``hold``), и только потом проверяет, есть ли файл; сигнал сохранения поста
+забирает эту ссылку, а не берёт вторую. Если пост так и не сохранился,
+незабранная ссылка снимается на выходе из ``Post.save`` (``holding``).
+``remove_unused`` удаляет строку и файл в одной транзакции, поэтому
+``hold`` ждёт её конца: файл либо останется, либо его уже не будет
+и хранилище запишет его заново.
+"""
+import json
+import logging
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from django.core.exceptions import SuspiciousFileOperation
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from sorl.thumbnail import default
+from sorl.thumbnail.images import ImageFile
+
+from . import thumbnails
+from .models import Post, StoredFile
+
+logger = logging.getLogger(__name__)
+
+# ссылки, взятые хранилищем в этом потоке и ещё не забранные acquire
+_held = threading.local()
+
+
+def scan(path):
+    """Файлы каталога рекурсивно через ``os.scandir``, без полного списка."""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+def storage():
+    return Post._meta.get_field('image').storage
+
+
+def _held_names():
+    if not hasattr(_held, 'names'):
+        _held.names = Counter()
+    return _held.names
+
+
+def _increment(name):
+    # обе записи ждут конца ещё не завершённой remove_unused и видят строку
+    # уже после неё; INSERT OR IGNORE не спорит с параллельной вставкой
+    StoredFile.objects.bulk_create(
+        [StoredFile(name=name, references=0)], ignore_conflicts=True)
+    StoredFile.objects.filter(name=name).update(
+        references=F('references') + 1)
+
+
+def hold(name):
+    """Ссылка хранилища на файл до сохранения поста; её заберёт acquire."""
+    _increment(name)
+    _held_names()[name] += 1
+
+
+@contextmanager
+def holding():
+    """Снимает ссылки хранилища, которые за блок так и не забрал acquire."""
+    held = _held_names()
+    before = held.copy()
+    try:
+        yield
+    finally:
+        for name, count in (held - before).items():
+            held[name] -= count
+            # при откате транзакции откатится и увеличение из hold
+            if not (connection.in_atomic_block
+                    and connection.needs_rollback):
+                StoredFile.objects.filter(name=name).update(
+                    references=Greatest(F('references') - count, 0))
+                transaction.on_commit(
+                    lambda name=name: remove_unused(name))
+
+
+def acquire(name):
+    if not name:
+        return
+    held = _held_names()
+    if held[name]:
+        held[name] -= 1
+        return
+    _increment(name)
+
+
+def release(name, manifest=''):
+    if not name:
+        return
+    StoredFile.objects.filter(name=name).update(
+        references=Greatest(F('references') - 1, 0))
+    transaction.on_commit(lambda: remove_unused(name, manifest))
+
+
+def shared_variants(name):
+    """Готовый манифест вариантов у другого поста с той же картинкой."""
+    return Post.objects.filter(image=name).exclude(
+        image_variants='').values_list('image_variants', flat=True).first()
+
+
+def remove_unused(name, manifest=''):
+    """Удаляет файл и всё, что из него построено, если ссылок нет."""
+    # файл удаляется до коммита: hold на это имя ждёт конца транзакции
+    with transaction.atomic():
+        deleted, _ = StoredFile.objects.filter(
+            name=name, references=0).delete()
+        if deleted:
+            remove(name, manifest)
+
+
+def variant_names(manifest):
+    """Имена файлов WebP/AVIF-вариантов из манифеста поста."""
+    try:
+        sources = json.loads(manifest)['sources'] if manifest else []
+        return [name for source in sources for name, _ in source['files']]
+    except (ValueError, TypeError, KeyError):
+        return []
+
+
+def remove(name, manifest=''):
+    files = storage()
+    try:
+        # миниатюры sorl удаляются вместе с их записями в KV-хранилище
+        default.kvstore.delete(ImageFile(name))
+        for path in [*variant_names(manifest), name]:
+            files.delete(path)
+    except SuspiciousFileOperation:
+        logger.warning('Файл %s вне хранилища картинок, не удаляем', name)
+    thumbnails.forget(name)
@@ -0,0 +1,167 @@
+"""Быстрый ответ «такого пользователя или группы нет» без запроса к БД.
+
+В памяти процесса держится фильтр Блума по именам пользователей и slug
+групп. «Нет в фильтре» значит «точно нет» - такой ответ даётся сразу.
+«Есть» может оказаться ложным срабатыванием; тогда после запроса к БД
+имя на ``NEGATIVE_CACHE_TIMEOUT`` секунд запоминается в кэше как
+отсутствующее.
+
+Новые имена процесс добавляет в свой фильтр и в журнал в кэше под
+номером поколения. Перед отрицательным ответом процесс дочитывает журнал
+и добавляет недостающие имена к себе. Если журнал не удалось дочитать,
+фильтр пересобирается из БД. Удалённые имена остаются в фильтре:
+на них ответит БД и отрицательный кэш.
+"""
+import hashlib
+import math
+import threading
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from .models import Group
+
+User = get_user_model()
+
+USER = 'user'
+GROUP = 'group'
+GENERATION_KEY = 'membership:generation'
+FALSE_POSITIVE_RATE = getattr(settings, 'MEMBERSHIP_FALSE_POSITIVE_RATE',
+                              0.01)
+NEGATIVE_CACHE_TIMEOUT = getattr(settings, 'NEGATIVE_CACHE_TIMEOUT', 60)
+# дочитывать журнал дольше, чем пересобрать фильтр
+MAX_REPLAY = 1000
+LOG_TIMEOUT = 60 * 60
+
+
+class BloomFilter:
+    """Фильтр Блума с двойным хэшированием одного blake2b."""
+
+    def __init__(self, capacity, error_rate=FALSE_POSITIVE_RATE):
+        capacity = max(capacity, 1000)
+        self.capacity = capacity
+        self.size = math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size
+                for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+
+def _key(kind, name):
+    return f'{kind}:{name}'
+
+
+def _missing_key(kind, name):
+    digest = hashlib.md5(name.encode()).hexdigest()
+    return f'membership:missing:{kind}:{digest}'
+
+
+def _log_key(generation):
+    return f'membership:added:{generation}'
+
+
+class _State:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.filter = None
+        self.generation = None
+
+
+state = _State()
+
+
+def _build():
+    # фильтр общий для процесса: собираем его по основной базе, а не по
+    # реплике, с которой может читать текущий запрос
+    names = [_key(USER, name) for name in User.objects.using(
+        'default').values_list('username', flat=True).iterator()]
+    names.extend(_key(GROUP, slug) for slug in Group.objects.using(
+        'default').values_list('slug', flat=True).iterator())
+    # запас вдвое, чтобы новые имена не поднимали долю ложных срабатываний
+    bloom = BloomFilter(len(names) * 2)
+    for name in names:
+        bloom.add(name)
+    return bloom
+
+
+def _generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, 0, None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def _rebuild(generation):
+    bloom = _build()
+    with state.lock:
+        state.filter, state.generation = bloom, generation
+
+
+def _sync():
+    """Доводит фильтр процесса до поколения в кэше."""
+    generation = _generation()
+    if state.filter is None or generation < state.generation or (
+            generation - state.generation > MAX_REPLAY):
+        return _rebuild(generation)
+    if generation == state.generation:
+        return
+    keys = [_log_key(number)
+            for number in range(state.generation + 1, generation + 1)]
+    added = cache.get_many(keys)
+    if len(added) < len(keys):
+        return _rebuild(generation)
+    with state.lock:
+        for key in keys:
+            state.filter.add(added[key])
+        state.generation = max(state.generation, generation)
+
+
+def added(kind, name):
+    """Новое имя: в фильтр процесса, в журнал для остальных."""
+    key = _key(kind, name)
+    cache.delete(_missing_key(kind, name))
+    _generation()
+    generation = cache.incr(GENERATION_KEY)
+    cache.set(_log_key(generation), key, LOG_TIMEOUT)
+    with state.lock:
+        if state.filter is None:
+            return
+        state.filter.add(key)
+        if state.generation == generation - 1:
+            state.generation = generation
+        if state.filter.count > state.filter.capacity:
+            # фильтр переполнен: следующий запрос соберёт его заново
+            state.filter = None
+
+
+def may_exist(kind, name):
+    """False - имени точно нет; True - нужно спросить БД."""
+    if state.filter is None or _key(kind, name) not in state.filter:
+        # отрицательный ответ даём только по свежему фильтру
+        _sync()
+        if _key(kind, name) not in state.filter:
+            return False
+    return not cache.get(_missing_key(kind, name))
+
+
+def remember_missing(kind, name):
+    """Ложное срабатывание фильтра: имени нет и в БД."""
+    cache.set(_missing_key(kind, name), True, NEGATIVE_CACHE_TIMEOUT)
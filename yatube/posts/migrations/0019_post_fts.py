@@ -0,0 +1,54 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import posts.models
+
+# внешний контент: FTS5 хранит только индекс, тексты берёт из posts_post
+CREATE = '''
+CREATE VIRTUAL TABLE posts_post_fts USING fts5(
+    text, content='posts_post', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER posts_post_fts_insert AFTER INSERT ON posts_post BEGIN
+    INSERT INTO posts_post_fts(rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER posts_post_fts_delete AFTER DELETE ON posts_post BEGIN
+    INSERT INTO posts_post_fts(posts_post_fts, rowid, text)
+    VALUES ('delete', old.id, old.text);
+END;
+CREATE TRIGGER posts_post_fts_update AFTER UPDATE OF text ON posts_post BEGIN
+    INSERT INTO posts_post_fts(posts_post_fts, rowid, text)
+    VALUES ('delete', old.id, old.text);
+    INSERT INTO posts_post_fts(rowid, text) VALUES (new.id, new.text);
+END;
+INSERT INTO posts_post_fts(posts_post_fts) VALUES ('rebuild');
+'''
+
+DROP = '''
+DROP TRIGGER posts_post_fts_update;
+DROP TRIGGER posts_post_fts_delete;
+DROP TRIGGER posts_post_fts_insert;
+DROP TABLE posts_post_fts;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0018_stored_files'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE, DROP),
+        migrations.CreateModel(
+            name='PostText',
+            fields=[
+                ('post', models.OneToOneField(db_column='rowid', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='+', serialize=False, to='posts.Post')),
+                ('text', posts.models.FullTextField(verbose_name='текст')),
+                ('rank', models.FloatField(verbose_name='релевантность')),
+            ],
+            options={
+                'db_table': 'posts_post_fts',
+                'managed': False,
+            },
+        ),
+    ]
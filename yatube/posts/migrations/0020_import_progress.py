@@ -0,0 +1,43 @@
+# Generated by Django 2.2.16 on 2026-10-18 09:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0019_post_fts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportProgress',
+            fields=[
+                ('source', models.CharField(max_length=255, primary_key=True, serialize=False, verbose_name='источник')),
+                ('rows', models.PositiveIntegerField(default=0, verbose_name='строк')),
+                ('finished', models.BooleanField(default=False, verbose_name='завершён')),
+            ],
+            options={
+                'verbose_name': 'Ход импорта',
+                'verbose_name_plural': 'Ход импорта',
+            },
+        ),
+        migrations.CreateModel(
+            name='ImportedPost',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255, verbose_name='источник')),
+                ('external_id', models.CharField(max_length=64, verbose_name='id в источнике')),
+                ('post', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='posts.Post', verbose_name='пост')),
+            ],
+            options={
+                'verbose_name': 'Импортированный пост',
+                'verbose_name_plural': 'Импортированные посты',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='importedpost',
+            constraint=models.UniqueConstraint(fields=('source', 'external_id'), name='unique_imported_post'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.16 on 2026-10-18 09:48
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def mark_pulled(apps, schema_editor):
+    # как и раньше: посты авторов сверх порога в ленты не разложены
+    AuthorStats = apps.get_model('posts', 'AuthorStats')
+    AuthorStats.objects.filter(
+        followers_count__gt=settings.FEED_PUSH_THRESHOLD).update(
+        feed_pulled=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0020_import_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='authorstats',
+            name='feed_pulled',
+            field=models.BooleanField(default=False, verbose_name='подмешивается в ленты'),
+        ),
+        migrations.AddIndex(
+            model_name='authorstats',
+            index=models.Index(condition=models.Q(feed_pulled=True), fields=['user'], name='authorstats_pulled_idx'),
+        ),
+        migrations.RunPython(mark_pulled, migrations.RunPython.noop),
+    ]
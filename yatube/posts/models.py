@@ -1,9 +1,28 @@
 from django.db import models
 from django.contrib.auth import get_user_model
 
+from .storage import ContentAddressedStorage
+
 User = get_user_model()
 
 
+class Match(models.Lookup):
+    """``field__match='запрос'`` - полнотекстовый ``MATCH`` SQLite FTS5."""
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', lhs_params + rhs_params
+
+
+class FullTextField(models.TextField):
+    """Столбец виртуальной таблицы FTS5."""
+
+
+FullTextField.register_lookup(Match)
+
+
 class Group(models.Model):
     title = models.CharField(
         "Название группы", max_length=200,
@@ -40,17 +59,56 @@ class Post(models.Model):
     image = models.ImageField(
         'Картинка',
         upload_to='posts/',
+        storage=ContentAddressedStorage(),
         blank=True
     )
+    # JSON-манифест WebP/AVIF-вариантов картинки, см. posts.variants
+    image_variants = models.TextField(
+        'Варианты картинки', blank=True, editable=False)
 
     class Meta:
         ordering = ['-pub_date']
         verbose_name = 'Пост'
         verbose_name_plural = 'Посты'
+        # ленты листаются keyset-паджинатором по (pub_date, id)
+        indexes = [
+            models.Index(fields=['pub_date', 'id'],
+                         name='post_pub_date_idx'),
+            models.Index(fields=['group', 'pub_date', 'id'],
+                         name='post_group_pub_date_idx'),
+            models.Index(fields=['author', 'pub_date', 'id'],
+                         name='post_author_pub_date_idx'),
+            # gc_media ищет посты по именам файлов и корням вариантов
+            models.Index(fields=['image'], name='post_image_idx'),
+        ]
 
     def __str__(self):
         return self.text[:15]
 
+    def save(self, *args, **kwargs):
+        # импорт здесь: media сама импортирует модели
+        from . import media
+        with media.holding():
+            super().save(*args, **kwargs)
+
+
+class PostText(models.Model):
+    """Полнотекстовый индекс текстов постов (виртуальная таблица FTS5).
+
+    Таблица создаётся миграцией и держится в синхронизации с ``posts_post``
+    триггерами SQLite, поэтому её видят и ``update()``, и ``bulk_create``.
+    ``rank`` - оценка bm25: чем меньше, тем релевантнее.
+    """
+    post = models.OneToOneField(Post, on_delete=models.DO_NOTHING,
+                                primary_key=True, db_column='rowid',
+                                related_name='+')
+    text = FullTextField("текст")
+    rank = models.FloatField("релевантность")
+
+    class Meta:
+        managed = False
+        db_table = 'posts_post_fts'
+
 
 class Comment(models.Model):
     text = models.TextField(verbose_name="текст",
@@ -68,6 +126,12 @@ class Comment(models.Model):
                              related_name='comments'
                              )
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['post', 'created'],
+                         name='comment_post_created_idx'),
+        ]
+
 
 class Follow(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE,
@@ -79,3 +143,135 @@ class Follow(models.Model):
                                help_text='автор на которого подписались',
                                related_name='following'
                                )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'author'],
+                                    name='unique_follow'),
+            models.CheckConstraint(check=~models.Q(user=models.F('author')),
+                                   name='no_self_follow'),
+        ]
+        # (user, author) покрыт уникальным индексом; обратный нужен
+        # для выборки подписчиков автора при раскладке ленты
+        indexes = [
+            models.Index(fields=['author', 'user'],
+                         name='follow_author_user_idx'),
+        ]
+
+
+class FeedEntry(models.Model):
+    """Материализованная лента подписок: строка на пару (читатель, пост).
+
+    Заполняется при публикации поста (fan-out на подписчиков автора),
+    поэтому страница ленты читается одним диапазоном по индексу
+    (user, pub_date, post).
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             verbose_name="читатель",
+                             related_name='feed')
+    post = models.ForeignKey(Post, on_delete=models.CASCADE,
+                             verbose_name="пост",
+                             related_name='feed_entries')
+    author = models.ForeignKey(User, on_delete=models.CASCADE,
+                               verbose_name="автор поста",
+                               related_name='+')
+    pub_date = models.DateTimeField(verbose_name="дата публикации")
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Записи ленты'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'post'],
+                                    name='unique_feed_entry'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'pub_date', 'post'],
+                         name='feed_user_pub_date_idx'),
+            models.Index(fields=['user', 'author'],
+                         name='feed_user_author_idx'),
+        ]
+
+
+class AuthorStats(models.Model):
+    """Денормализованные счётчики пользователя.
+
+    Обновляются атомарными ``F()``-инкрементами из сигналов, поэтому
+    страницам не нужен ``COUNT(*)``. Расхождения чинит команда
+    ``reconcile_stats``.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE,
+                                primary_key=True,
+                                verbose_name="пользователь",
+                                related_name='stats')
+    posts_count = models.PositiveIntegerField("постов", default=0)
+    followers_count = models.PositiveIntegerField("подписчиков", default=0,
+                                                  db_index=True)
+    following_count = models.PositiveIntegerField("подписок", default=0)
+    comments_count = models.PositiveIntegerField("комментариев", default=0)
+    # посты не раскладываются по лентам, а подмешиваются при чтении
+    # (см. posts.feed); меняется только вместе с лентами подписчиков
+    feed_pulled = models.BooleanField("подмешивается в ленты", default=False)
+
+    class Meta:
+        verbose_name = 'Статистика автора'
+        verbose_name_plural = 'Статистика авторов'
+        indexes = [
+            # таких авторов единицы: частичный индекс почти ничего не весит
+            models.Index(fields=['user'], name='authorstats_pulled_idx',
+                         condition=models.Q(feed_pulled=True)),
+        ]
+
+    def __str__(self):
+        return f'{self.user}: {self.posts_count}'
+
+
+class StoredFile(models.Model):
+    """Файл хранилища картинок и число постов, которые на него ссылаются.
+
+    Счётчик меняется ``F()``-выражениями из сигналов (см. ``posts.media``);
+    файл удаляется с диска, когда ссылок не остаётся.
+    """
+    name = models.CharField("имя файла", max_length=255, primary_key=True)
+    references = models.PositiveIntegerField("ссылок", default=0)
+
+    class Meta:
+        verbose_name = 'Файл картинки'
+        verbose_name_plural = 'Файлы картинок'
+
+    def __str__(self):
+        return f'{self.name}: {self.references}'
+
+
+class ImportProgress(models.Model):
+    """Сколько строк файла импорта уже в базе (см. ``import_posts``).
+
+    Меняется в той же транзакции, что и пачка строк, поэтому после сбоя
+    импорт продолжается ровно с первой незаписанной строки.
+    """
+    source = models.CharField("источник", max_length=255, primary_key=True)
+    rows = models.PositiveIntegerField("строк", default=0)
+    finished = models.BooleanField("завершён", default=False)
+
+    class Meta:
+        verbose_name = 'Ход импорта'
+        verbose_name_plural = 'Ход импорта'
+
+    def __str__(self):
+        return f'{self.source}: {self.rows}'
+
+
+class ImportedPost(models.Model):
+    """Соответствие id поста на старой платформе и поста здесь."""
+    source = models.CharField("источник", max_length=255)
+    external_id = models.CharField("id в источнике", max_length=64)
+    post = models.OneToOneField(Post, on_delete=models.CASCADE,
+                                verbose_name="пост",
+                                related_name='+')
+
+    class Meta:
+        verbose_name = 'Импортированный пост'
+        verbose_name_plural = 'Импортированные посты'
+        constraints = [
+            models.UniqueConstraint(fields=['source', 'external_id'],
+                                    name='unique_imported_post'),
+        ]
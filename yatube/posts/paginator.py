@@ -0,0 +1,241 @@
+import base64
+import binascii
+import heapq
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.paginator import Page, Paginator
+from django.db.models import Q
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class CursorPage(Page):
+    """Страница курсорного паджинатора.
+
+    В отличие от обычной страницы не знает общего числа записей:
+    вместо номеров страниц отдаёт непрозрачные курсоры соседних страниц.
+    """
+
+    def __init__(self, object_list, paginator, next_cursor=None,
+                 previous_cursor=None, number=None):
+        super().__init__(object_list, number, paginator)
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return f'<CursorPage of {len(self.object_list)} objects>'
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class CursorPaginator(Paginator):
+    """Keyset-паджинатор по (pub_date, id).
+
+    Каждая страница выбирается одним запросом вида
+    ``WHERE (pub_date, id) < (:pub_date, :id) ORDER BY ... LIMIT n + 1``,
+    поэтому глубокие страницы стоят столько же, сколько первая,
+    а ``COUNT(*)`` не выполняется вовсе.
+    """
+
+    def __init__(self, object_list, per_page,
+                 ordering=('-pub_date', '-id')):
+        self.ordering = tuple(ordering)
+        self.model = object_list.model
+        super().__init__(object_list.order_by(*self.ordering), per_page)
+
+    def get_page(self, cursor=None, number=None):
+        """Страница по курсору; битый курсор ведёт на первую страницу.
+
+        ``number`` поддерживается ради старых ссылок вида ``?page=N``:
+        такая страница выбирается через OFFSET, но тоже без подсчёта.
+        """
+        if cursor:
+            try:
+                return self.page_from_cursor(cursor)
+            except InvalidCursor:
+                pass
+        try:
+            number = max(int(number), 1)
+        except (TypeError, ValueError):
+            number = 1
+        return self._offset_page(number)
+
+    def page_from_cursor(self, cursor):
+        direction, position = self.decode_cursor(cursor)
+        reverse = direction == PREVIOUS
+        rows = self._window(position, reverse, self.per_page + 1)
+        has_more = len(rows) > self.per_page
+        if reverse and not has_more:
+            # Дошли до начала ленты: отдаём полноценную первую страницу.
+            return self._offset_page(1)
+        rows = rows[:self.per_page]
+        if reverse:
+            rows.reverse()
+        if not rows:
+            return CursorPage(rows, self)
+        first, last = rows[0], rows[-1]
+        if reverse:
+            return CursorPage(
+                rows, self,
+                next_cursor=self.encode_cursor(NEXT, last),
+                previous_cursor=self.encode_cursor(PREVIOUS, first),
+            )
+        return CursorPage(
+            rows, self,
+            next_cursor=self.encode_cursor(NEXT, last) if has_more else None,
+            previous_cursor=self.encode_cursor(PREVIOUS, first),
+        )
+
+    def _offset_page(self, number):
+        offset = (number - 1) * self.per_page
+        rows = self._head(offset, self.per_page + 1)
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        next_cursor = previous_cursor = None
+        if rows and has_more:
+            next_cursor = self.encode_cursor(NEXT, rows[-1])
+        if rows and number > 1:
+            previous_cursor = self.encode_cursor(PREVIOUS, rows[0])
+        return CursorPage(rows, self, next_cursor, previous_cursor, number)
+
+    def _head(self, offset, limit):
+        return list(self.object_list[offset:offset + limit])
+
+    def _window(self, position, reverse, limit):
+        return list(self._after(
+            self.object_list, self.ordering, position, reverse, limit))
+
+    @staticmethod
+    def _after(queryset, ordering, position, reverse, limit):
+        """Не больше ``limit`` записей строго после ``position``.
+
+        Условие строится как ``a <= x AND (a < x OR b < y)``: первая часть
+        даёт индексу диапазон, вторая отсекает уже показанные записи.
+        """
+        names = [field.lstrip('-') for field in ordering]
+        descending = [field.startswith('-') != reverse for field in ordering]
+        ordering = [
+            f'-{name}' if desc else name
+            for name, desc in zip(names, descending)
+        ]
+        if position is None:
+            return queryset.order_by(*ordering)[:limit]
+        tail = Q()
+        for i, name in enumerate(names):
+            lookup = 'lt' if descending[i] else 'gt'
+            step = Q(**{f'{name}__{lookup}': position[i]})
+            for prev, value in zip(names[:i], position[:i]):
+                step &= Q(**{prev: value})
+            tail |= step
+        head_lookup = 'lte' if descending[0] else 'gte'
+        return queryset.filter(
+            Q(**{f'{names[0]}__{head_lookup}': position[0]}), tail
+        ).order_by(*ordering)[:limit]
+
+    def _fields(self):
+        opts = self.model._meta
+        return [opts.get_field(field.lstrip('-')) for field in self.ordering]
+
+    def encode_cursor(self, direction, obj):
+        values = []
+        for field in self._fields():
+            value = getattr(obj, field.attname)
+            values.append(
+                value.isoformat() if hasattr(value, 'isoformat') else value
+            )
+        raw = json.dumps([direction] + values, separators=(',', ':'))
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        padding = '=' * (-len(cursor) % 4)
+        try:
+            raw = base64.urlsafe_b64decode(cursor + padding)
+            direction, *values = json.loads(raw)
+            fields = self._fields()
+            if direction not in (NEXT, PREVIOUS) or (
+                    len(values) != len(fields)):
+                raise ValueError(cursor)
+            position = [
+                field.to_python(value)
+                for field, value in zip(fields, values)
+            ]
+        except (binascii.Error, ValueError, TypeError,
+                AttributeError, ValidationError) as e:
+            raise InvalidCursor(cursor) from e
+        if any(value is None for value in position):
+            raise InvalidCursor(cursor)
+        return direction, position
+
+
+class MergedCursorPaginator(CursorPaginator):
+    """Курсорный паджинатор поверх k-way слияния нескольких источников.
+
+    ``sources`` - список ``(queryset, ordering, transform)``: каждый
+    источник упорядочен по своим полям, а ``transform`` превращает его
+    строку в объект ``model`` (например, FeedEntry -> Post). Из каждого
+    источника читается не больше страницы, после чего окна сливаются
+    кучей (``heapq.merge``), повторы по pk отбрасываются.
+    """
+
+    def __init__(self, sources, per_page, model,
+                 ordering=('-pub_date', '-id')):
+        self.ordering = tuple(ordering)
+        self.model = model
+        self.sources = [
+            (queryset, tuple(src_ordering), transform or _identity)
+            for queryset, src_ordering, transform in sources
+        ]
+        Paginator.__init__(self, [], per_page)
+
+    def _merge(self, windows, reverse, limit):
+        names = [self.model._meta.get_field(field.lstrip('-')).attname
+                 for field in self.ordering]
+        merged = heapq.merge(
+            *windows,
+            key=lambda obj: tuple(getattr(obj, name) for name in names),
+            reverse=self.ordering[0].startswith('-') != reverse,
+        )
+        rows, seen = [], set()
+        for obj in merged:
+            if obj.pk in seen:
+                continue
+            seen.add(obj.pk)
+            rows.append(obj)
+            if len(rows) == limit:
+                break
+        return rows
+
+    def _window(self, position, reverse, limit):
+        windows = [
+            map(transform,
+                self._after(queryset, ordering, position, reverse, limit))
+            for queryset, ordering, transform in self.sources
+        ]
+        return self._merge(windows, reverse, limit)
+
+    def _head(self, offset, limit):
+        rows = self._window(None, False, offset + limit)
+        return rows[offset:]
+
+
+def _identity(obj):
+    return obj
+
+
+def get_page(request, queryset, per_page=None):
+    """Курсорная страница для ``?cursor=`` (или старого ``?page=``)."""
+    paginator = CursorPaginator(queryset, per_page or settings.TEN_SLICE)
+    return paginator.get_page(
+        request.GET.get('cursor'), request.GET.get('page')
+    )
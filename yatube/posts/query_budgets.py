@@ -0,0 +1,26 @@
+"""Бюджеты SQL-запросов view приложения posts (см. core.middleware).
+
+Число - предел запросов на один запрос к странице с холодным кэшем,
+включая сессию и пользователя. Тесты (test_query_budgets) проходят все
+маршруты из posts.urls и падают, если view вышла за бюджет или бюджета
+для неё нет.
+"""
+BUDGETS = {
+    'posts:index': 5,
+    'posts:group_list': 8,
+    'posts:profile': 9,
+    'posts:post_detail': 6,
+    'posts:post_edit': 6,
+    # POST с картинкой и группой: проверка группы формой, ссылка на файл,
+    # манифест вариантов, счётчики и раскладка в ленты
+    'posts:post_create': 11,
+    'posts:add_comment': 7,
+    'posts:follow_index': 6,
+    # подписка раскладывает посты автора в ленту и правит счётчики
+    'posts:profile_follow': 18,
+    'posts:profile_unfollow': 16,
+    'posts:search': 5,
+    'posts:autocomplete': 4,
+    # строки выгрузки читаются уже после ответа, при отдаче потока
+    'posts:export': 4,
+}
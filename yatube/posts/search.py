@@ -0,0 +1,95 @@
+"""Полнотекстовый поиск по постам через индекс FTS5 (``PostText``).
+
+Запрос пользователя не передаётся в ``MATCH`` как есть: синтаксис FTS5
+(кавычки, ``AND``/``NOT``, ``*``) на произвольном вводе падает с ошибкой.
+Из запроса берутся слова, каждое ищется как префикс, все - через AND.
+
+Ранг bm25 зависит от статистики всего индекса и меняется с каждым новым
+или удалённым постом, поэтому курсор по рангу терял бы и повторял
+результаты между страницами. Первая страница сохраняет в кэше id первых
+``MAX_RESULTS`` результатов по порядку (снимок), а курсор - это ключ
+снимка и смещение в нём: следующие страницы не пересчитывают ранг и не
+сдвигаются от новых постов.
+"""
+import re
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+
+from .models import Post, PostText
+from .paginator import CursorPage
+
+WORD = re.compile(r'\w+')
+MAX_TERMS = 16
+# сначала релевантные, среди равных - новые
+ORDERING = ('rank', '-post_id')
+MAX_RESULTS = 1000
+SNAPSHOT_TIMEOUT = 30 * 60
+CURSOR = re.compile(r'^(?P<token>[0-9a-f]{32})\.(?P<start>\d+)$')
+
+
+def match_query(query):
+    """Запрос ``MATCH`` из слов ввода или '' если слов нет."""
+    words = WORD.findall(query or '')[:MAX_TERMS]
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def matches(query):
+    """Строки индекса, подходящие под запрос; пустой запрос - ничего."""
+    expression = match_query(query)
+    if not expression:
+        return PostText.objects.none()
+    return PostText.objects.filter(text__match=expression)
+
+
+def post_ids(query):
+    """Подзапрос id постов для ``pk__in``: идёт по индексу, без LIKE."""
+    return matches(query).values('post_id')
+
+
+def _snapshot_key(token):
+    return f'posts:search:{token}'
+
+
+def _snapshot(query, cursor):
+    """(токен, id результатов, смещение, снимок новый) по курсору."""
+    expression = match_query(query)
+    match = CURSOR.match(cursor or '')
+    start = 0
+    if match:
+        snapshot = cache.get(_snapshot_key(match['token']))
+        if snapshot is None:
+            # снимок протух: та же страница по свежему порядку
+            start = int(match['start'])
+        elif snapshot['query'] == expression:
+            return (match['token'], snapshot['ids'], int(match['start']),
+                    False)
+    ids = list(matches(query).order_by(*ORDERING).values_list(
+        'post_id', flat=True)[:MAX_RESULTS])
+    return uuid.uuid4().hex, ids, start, True
+
+
+def search_page(query, cursor=None, per_page=None):
+    """Страница результатов по релевантности из снимка порядка."""
+    per_page = per_page or settings.TEN_SLICE
+    token, ids, start, fresh = _snapshot(query, cursor)
+    if start >= len(ids):
+        start = 0
+    chunk = ids[start:start + per_page]
+    posts = Post.objects.select_related('author', 'group').in_bulk(chunk)
+    # удалённые после снимка посты просто пропускаются
+    object_list = [posts[pk] for pk in chunk if pk in posts]
+    has_next = start + per_page < len(ids)
+    # снимок нужен, только если есть другие страницы
+    if fresh and len(ids) > per_page:
+        cache.set(_snapshot_key(token),
+                  {'query': match_query(query), 'ids': ids},
+                  SNAPSHOT_TIMEOUT)
+    return CursorPage(
+        object_list, Paginator(ids, per_page),
+        next_cursor=f'{token}.{start + per_page}' if has_next else None,
+        previous_cursor=(f'{token}.{max(start - per_page, 0)}'
+                         if start else None),
+        number=start // per_page + 1)
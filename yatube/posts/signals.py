@@ -0,0 +1,135 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import (post_delete, post_init, post_save,
+                                      pre_save)
+from django.dispatch import receiver
+
+from . import (autocomplete, caching, feed, media, membership, stats,
+               thumbnails)
+from .models import AuthorStats, Comment, Follow, Group, Post
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=User)
+def user_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        AuthorStats.objects.get_or_create(user=instance)
+
+
+@receiver(post_save, sender=User)
+def user_names(sender, instance, created, raw=False, update_fields=None,
+               **kwargs):
+    # вход в систему сохраняет только last_login: имена не меняются
+    if raw or update_fields and not {'username', 'is_active'} & set(
+            update_fields):
+        return
+    autocomplete.user_saved(instance)
+    membership.added(membership.USER, instance.username)
+    if not created:
+        # имя автора выводится в карточках его постов во всех лентах
+        group_ids = instance.posts.exclude(group=None).values_list(
+            'group_id', flat=True).distinct().order_by()
+        caching.bump_generation(
+            caching.INDEX, caching.author_scope(instance.pk),
+            *map(caching.group_scope, group_ids))
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    autocomplete.user_deleted(instance)
+
+
+@receiver(post_save, sender=Group)
+def group_saved(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        autocomplete.group_saved(instance)
+        membership.added(membership.GROUP, instance.slug)
+    if not raw and not created:
+        # название и ссылка группы выводятся в карточках её постов
+        author_ids = instance.posts.values_list(
+            'author_id', flat=True).distinct().order_by()
+        caching.bump_generation(
+            caching.INDEX, caching.group_scope(instance.pk),
+            *map(caching.author_scope, author_ids))
+
+
+@receiver(post_delete, sender=Group)
+def group_deleted(sender, instance, **kwargs):
+    autocomplete.group_deleted(instance)
+
+
+@receiver(post_init, sender=Post)
+def post_remember_loaded(sender, instance, **kwargs):
+    instance._loaded_group_id = instance.group_id
+    instance._loaded_image = instance.image.name
+    instance._loaded_variants = instance.image_variants
+
+
+@receiver(pre_save, sender=Post)
+def post_image_replaced(sender, instance, raw=False, **kwargs):
+    # манифест вариантов относится к прежней картинке
+    if not raw and instance.image.name != instance._loaded_image:
+        instance.image_variants = ''
+
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    caching.bump_generation(*caching.post_scopes(
+        instance, instance._loaded_group_id))
+    if instance.image.name != instance._loaded_image:
+        thumbnails.forget(instance._loaded_image, instance.image.name)
+        media.acquire(instance.image.name)
+        media.release(instance._loaded_image, instance._loaded_variants)
+        manifest = instance.image and media.shared_variants(
+            instance.image.name)
+        if manifest:
+            # такая картинка уже загружалась: варианты готовы
+            Post.objects.filter(pk=instance.pk).update(
+                image_variants=manifest)
+            instance.image_variants = manifest
+        elif instance.image:
+            thumbnails.schedule(instance.image.name)
+    post_remember_loaded(sender, instance)
+
+
+@receiver(post_save, sender=Post)
+def post_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and instance.author_id:
+        stats.bump(instance.author_id, posts_count=1)
+        feed.fan_out(instance)
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    stats.bump(instance.author_id, posts_count=-1)
+    media.release(instance.image.name, instance.image_variants)
+    caching.bump_generation(*caching.post_scopes(instance))
+
+
+@receiver(post_save, sender=Follow)
+def follow_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        stats.bump(instance.author_id, followers_count=1)
+        stats.bump(instance.user_id, following_count=1)
+        feed.update_mode(instance.author_id)
+        feed.backfill(instance.user_id, instance.author_id)
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    stats.bump(instance.author_id, followers_count=-1)
+    stats.bump(instance.user_id, following_count=-1)
+    feed.trim(instance.user_id, instance.author_id)
+
+
+@receiver(post_save, sender=Comment)
+def comment_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        stats.bump(instance.author_id, comments_count=1)
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, **kwargs):
+    stats.bump(instance.author_id, comments_count=-1)
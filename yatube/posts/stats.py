@@ -0,0 +1,51 @@
+"""Денормализованные счётчики пользователей (AuthorStats)."""
+from django.db.models import Count, F
+from django.db.models.functions import Greatest
+
+from .models import AuthorStats, Comment, Follow, Post
+
+# счётчик -> (модель, поле со ссылкой на пользователя)
+COUNTERS = {
+    'posts_count': (Post, 'author'),
+    'followers_count': (Follow, 'author'),
+    'following_count': (Follow, 'user'),
+    'comments_count': (Comment, 'author'),
+}
+
+
+def bump(user_id, **deltas):
+    """Атомарно сдвигает счётчики одним ``UPDATE ... SET x = x + d``.
+
+    Отрицательные сдвиги не опускают счётчик ниже нуля: если счётчик уже
+    разошёлся с данными, это исправит ``reconcile_stats``.
+    """
+    if not user_id:
+        return
+    AuthorStats.objects.filter(user_id=user_id).update(**{
+        name: F(name) + delta if delta > 0 else Greatest(F(name) + delta, 0)
+        for name, delta in deltas.items()
+    })
+
+
+def recount(user_ids):
+    """Точные значения счётчиков для пользователей, по запросу на счётчик."""
+    user_ids = list(user_ids)
+    actual = {
+        user_id: dict.fromkeys(COUNTERS, 0) for user_id in user_ids
+    }
+    for name, (model, field) in COUNTERS.items():
+        rows = model.objects.filter(**{f'{field}__in': user_ids}).values_list(
+            field).annotate(total=Count('pk')).order_by()
+        for user_id, total in rows:
+            actual[user_id][name] = total
+    return actual
+
+
+def get_stats(user):
+    """Счётчики пользователя; недостающая запись создаётся пересчётом."""
+    try:
+        return user.stats
+    except AuthorStats.DoesNotExist:
+        stats, _ = AuthorStats.objects.get_or_create(
+            user=user, defaults=recount([user.pk])[user.pk])
+        return stats
@@ -0,0 +1,51 @@
+"""Хранилище картинок постов, адресуемое по содержимому.
+
+Имя файла - sha256 содержимого (``posts/ab/abcdef….jpg``), поэтому
+одинаковые загрузки (репосты, мемы) лежат на диске один раз и делят
+миниатюры sorl и WebP/AVIF-варианты. Сколько постов ссылается на файл,
+считает ``posts.media``: файл удаляется, только когда ссылок не осталось.
+"""
+import hashlib
+import os
+import uuid
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+CHUNK_SIZE = 64 * 2 ** 10
+
+
+def content_hash(content):
+    """sha256 django ``File``, прочитанного кусками."""
+    digest = hashlib.sha256()
+    for chunk in content.chunks(CHUNK_SIZE):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hashed_name(directory, digest, extension):
+    return os.path.join(
+        directory, digest[:2], digest + extension.lower()).replace('\\', '/')
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    def get_available_name(self, name, max_length=None):
+        # одинаковое имя - одинаковое содержимое, перезапись не страшна
+        return name
+
+    def _save(self, name, content):
+        directory, filename = os.path.split(name)
+        name = hashed_name(
+            directory, content_hash(content), os.path.splitext(filename)[1])
+        # ссылка - до проверки: иначе файл могут удалить между проверкой
+        # и сохранением поста; импорт здесь, media сама импортирует модели
+        from . import media
+        media.hold(name)
+        if self.exists(name):
+            return name
+        # пишем во временное имя и атомарно переименовываем: параллельная
+        # загрузка того же файла не увидит его недописанным
+        temporary = super()._save(f'{name}.{uuid.uuid4().hex}.tmp', content)
+        os.replace(self.path(temporary), self.path(name))
+        return name
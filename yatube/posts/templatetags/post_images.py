@@ -0,0 +1,17 @@
+from django import template
+
+from posts import thumbnails, variants
+
+register = template.Library()
+
+
+@register.simple_tag
+def post_thumbnail(image):
+    """Готовая миниатюра картинки поста или None (тогда - заглушка)."""
+    return thumbnails.ready_thumbnail(image)
+
+
+@register.simple_tag
+def post_picture(post):
+    """Данные для <picture> из манифеста вариантов поста или None."""
+    return variants.picture(post)
@@ -0,0 +1,11 @@
+from django import template
+
+from posts import caching
+
+register = template.Library()
+
+
+@register.simple_tag
+def postcards(page_obj):
+    """Готовый HTML карточек страницы из кэша карточек."""
+    return caching.render_postcards(page_obj)
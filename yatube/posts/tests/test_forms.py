@@ -1,9 +1,16 @@
+import os
 import shutil
+import subprocess
+import sys
 import tempfile
+from io import BytesIO
+
+from PIL import Image
 
 from ..forms import PostForm
 from ..models import Group, Post, User, Comment
 from django.test import Client, TestCase, override_settings
+from unittest import skipUnless
 from django.urls import reverse
 from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
@@ -12,7 +19,7 @@ from django.core.cache import cache
 TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
 
 
-@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, THUMBNAIL_WORKERS=0)
 class PostModelTest(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -80,7 +87,7 @@ class PostModelTest(TestCase):
                 text=form_data['text'],
                 author=self.user,
                 group=form_data['group'],
-                image='posts/small.gif',
+                image__regex=r'^posts/[0-9a-f]{2}/[0-9a-f]{64}\.gif$',
             ).exists(), Post.objects.filter(pk=2)[0]
         )
         self.assertEqual(Post.objects.count(), posts_count + 1)
@@ -141,3 +148,107 @@ class PostModelTest(TestCase):
                 post=self.post
             ).exists(),
         )
+
+
+# обрабатывает в свежем процессе большой JPEG и печатает прирост пика RSS;
+# VmHWM, в отличие от ru_maxrss, не наследуется от родителя через exec
+RSS_SCRIPT = """
+import sys
+import django
+django.setup()
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from posts.ingest import ingest
+def peak():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+upload = TemporaryUploadedFile('big.jpg', 'image/jpeg', 0, None)
+upload.file.close()
+upload.file = open(sys.argv[1], 'rb')
+upload.size = upload.file.seek(0, 2)
+before = peak()
+ingest(upload)
+print(peak() - before)
+"""
+
+
+class IngestTest(TestCase):
+    def upload(self, image, fmt='JPEG', name='photo.jpg', **options):
+        buffer = BytesIO()
+        image.save(buffer, fmt, **options)
+        return SimpleUploadedFile(name, buffer.getvalue(), 'image/jpeg')
+
+    def form(self, upload):
+        return PostForm({'text': 'картинка'}, {'image': upload})
+
+    @override_settings(POST_IMAGE_MAX_BYTES=100)
+    def test_rejects_large_file(self):
+        form = self.form(self.upload(Image.effect_noise((64, 64), 50)))
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors.as_data()['image'][0].code,
+                         'file_too_large')
+
+    @override_settings(POST_IMAGE_MAX_PIXELS=50 * 50)
+    def test_rejects_too_many_pixels(self):
+        form = self.form(self.upload(Image.new('RGB', (60, 60))))
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors.as_data()['image'][0].code,
+                         'too_many_pixels')
+
+    def test_rejects_animation(self):
+        for fmt, name in (('GIF', 'cat.gif'), ('WEBP', 'cat.webp')):
+            frames = [Image.new('RGB', (8, 8), color)
+                      for color in ('red', 'blue')]
+            form = self.form(self.upload(
+                frames[0], fmt, name, save_all=True,
+                append_images=frames[1:], duration=100))
+            self.assertFalse(form.is_valid())
+            self.assertEqual(form.errors.as_data()['image'][0].code,
+                             'animated_image')
+
+    def test_converts_modes_png_cannot_write(self):
+        for mode in ('CMYK', 'LAB'):
+            form = self.form(self.upload(
+                Image.new(mode, (8, 8)), 'TIFF', 'scan.tif'))
+            self.assertTrue(form.is_valid(), form.errors)
+            image = Image.open(form.cleaned_data['image'])
+            self.assertEqual((image.format, image.mode), ('PNG', 'RGB'))
+
+    def test_rejects_truncated_jpeg(self):
+        upload = self.upload(Image.effect_noise((256, 256), 50))
+        upload = SimpleUploadedFile(
+            'photo.jpg', upload.read()[:2000], 'image/jpeg')
+        form = self.form(upload)
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors.as_data()['image'][0].code,
+                         'invalid_image')
+
+    @override_settings(POST_IMAGE_MAX_SIDE=100)
+    def test_downscales_and_strips_exif(self):
+        exif = Image.Exif()
+        exif[0x010F] = 'Camera'
+        exif[0x0112] = 6  # повернуть на 90 градусов
+        form = self.form(self.upload(
+            Image.new('RGB', (400, 200)), exif=exif.tobytes()))
+        self.assertTrue(form.is_valid(), form.errors)
+        image = Image.open(form.cleaned_data['image'])
+        self.assertEqual(image.size, (50, 100))
+        self.assertEqual(dict(image.getexif()), {})
+        self.assertEqual(form.cleaned_data['image'].name, 'photo.jpg')
+
+    @skipUnless(os.path.exists('/proc/self/status'), 'нужен Linux /proc')
+    def test_peak_rss_is_bounded(self):
+        # 24 Мпикс: полное декодирование с уменьшением - около 140 МБ
+        with tempfile.NamedTemporaryFile(suffix='.jpg') as source:
+            Image.new('RGB', (6000, 4000), 'tan').save(source, 'JPEG')
+            source.flush()
+            output = subprocess.run(
+                [sys.executable, '-c', RSS_SCRIPT, source.name],
+                cwd=settings.BASE_DIR, check=True, capture_output=True,
+                env=dict(os.environ,
+                         DJANGO_SETTINGS_MODULE='yatube.settings',
+                         PYTHONPATH=settings.BASE_DIR)).stdout
+        # draft декодирует 3000x2000 (24 МБ, Pillow хранит пиксель
+        # в 4 байтах), уменьшение до 2048 - ещё около 28 МБ
+        self.assertLess(int(output), 64 * 2 ** 20)
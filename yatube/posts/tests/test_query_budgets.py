@@ -0,0 +1,113 @@
+import json
+import re
+import tempfile
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+
+from core.middleware import QueryBudgetExceeded
+from .. import autocomplete, membership
+from ..models import Comment, Follow, Group, Post, User
+from ..query_budgets import BUDGETS
+from ..urls import app_name, urlpatterns
+
+QUERIES = re.compile(r'\d+ queries')
+SMALL_GIF = (
+    b'\x47\x49\x46\x38\x39\x61\x02\x00'
+    b'\x01\x00\x80\x00\x00\x00\x00\x00'
+    b'\xFF\xFF\xFF\x21\xF9\x04\x00\x00'
+    b'\x00\x00\x00\x2C\x00\x00\x00\x00'
+    b'\x02\x00\x01\x00\x00\x02\x02\x0C'
+    b'\x0A\x00\x3B'
+)
+
+
+@override_settings(QUERY_BUDGET_ENFORCE=True)
+class QueryBudgetTest(TestCase):
+    """Страницы укладываются в бюджеты запросов из posts.query_budgets."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='budget')
+        cls.author = User.objects.create_user(username='spender')
+        cls.group = Group.objects.create(title='Бюджет', slug='budget')
+        Follow.objects.create(user=cls.user, author=cls.author)
+        for i in range(15):
+            Post.objects.create(author=cls.author, group=cls.group,
+                                text=f'пост {i}')
+        cls.post = Post.objects.create(author=cls.user, text='свой пост')
+
+    def setUp(self):
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def cold_get(self, url, data=None):
+        cache.clear()
+        membership.state.filter = None
+        autocomplete.state.index = None
+        return self.client.get(url, data)
+
+    def add_comments(self, count):
+        start = Comment.objects.count()
+        for i in range(start, start + count):
+            Comment.objects.create(
+                post=self.post, text='к',
+                author=User.objects.create_user(username=f'critic{i}'))
+
+    def test_every_view_has_budget(self):
+        names = {f'{app_name}:{pattern.name}' for pattern in urlpatterns}
+        self.assertEqual(names, set(BUDGETS))
+
+    def test_views_within_budget(self):
+        self.add_comments(5)
+        requests = [
+            ('posts:index', [], None),
+            ('posts:group_list', [self.group.slug], None),
+            ('posts:profile', [self.author.username], None),
+            ('posts:post_detail', [self.post.pk], None),
+            ('posts:post_edit', [self.post.pk], None),
+            ('posts:post_create', [], None),
+            ('posts:follow_index', [], None),
+            ('posts:search', [], {'q': 'пост'}),
+            ('posts:autocomplete', [], {'q': 'sp'}),
+            ('posts:profile_unfollow', [self.author.username], None),
+            ('posts:profile_follow', [self.author.username], None),
+        ]
+        for name, args, data in requests:
+            with self.subTest(view=name):
+                response = self.cold_get(reverse(name, args=args), data)
+                self.assertEqual(response.status_code, 200)
+        response = self.client.post(
+            reverse('posts:add_comment', args=[self.post.pk]),
+            {'text': 'ещё'})
+        self.assertEqual(response.status_code, 302)
+        # новый пост с картинкой и группой: ссылка на файл, манифест
+        with tempfile.TemporaryDirectory() as media, \
+                override_settings(MEDIA_ROOT=media):
+            response = self.client.post(reverse('posts:post_create'), {
+                'text': 'с картинкой', 'group': self.group.pk,
+                'image': SimpleUploadedFile(
+                    'budget.gif', SMALL_GIF, 'image/gif')})
+        self.assertEqual(response.status_code, 302)
+
+    def test_comments_do_not_add_queries(self):
+        url = reverse('posts:post_detail', args=[self.post.pk])
+        self.add_comments(1)
+        before = self.cold_get(url)['Server-Timing']
+        self.add_comments(5)
+        after = self.cold_get(url)['Server-Timing']
+        self.assertRegex(before, r'desc="\d+ queries, 0 duplicated"')
+        self.assertEqual(QUERIES.search(before)[0], QUERIES.search(after)[0])
+
+    def test_exceeded_budget_fails(self):
+        with mock.patch('core.middleware.load_budgets',
+                        return_value={'posts:index': 0}):
+            with self.assertLogs('core.middleware', 'WARNING') as logs:
+                with self.assertRaises(QueryBudgetExceeded):
+                    Client().get(reverse('posts:index'))
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['view'], 'posts:index')
+        self.assertEqual(record['budget'], 0)
@@ -0,0 +1,73 @@
+import re
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from ..models import Comment, Follow, Group, Post, User
+
+# полный просмотр таблицы: "SCAN posts_post" / "SCAN TABLE posts_post"
+# без "USING ... INDEX"; сортировка во временном B-дереве
+FULL_SCAN = re.compile(r'\bSCAN (?:TABLE )?(\w+)(?!.*\bUSING\b)')
+TEMP_SORT = 'USE TEMP B-TREE'
+
+
+class QueryPlanTest(TestCase):
+    """Запросы страниц не должны читать таблицы целиком и сортировать."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='planner')
+        cls.author = User.objects.create_user(username='planned')
+        cls.group = Group.objects.create(title='Группа', slug='plan')
+        Follow.objects.create(user=cls.user, author=cls.author)
+        for i in range(15):
+            Post.objects.create(author=cls.author, group=cls.group,
+                                text=f'пост {i}')
+        cls.post = Post.objects.first()
+        Comment.objects.create(post=cls.post, author=cls.user, text='к')
+
+    def setUp(self):
+        self.client = Client()
+        self.client.force_login(self.user)
+        cache.clear()
+
+    def plans(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        captured = queries.captured_queries
+        page = response.context.get('page_obj')
+        if page is not None and page.next_cursor:
+            # глубокая страница: keyset-условие тоже должно идти по индексу
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(f'{url}?cursor={page.next_cursor}')
+            captured += queries.captured_queries
+        with connection.cursor() as cursor:
+            for query in captured:
+                sql = query['sql']
+                if not sql.startswith('SELECT') or 'posts_' not in sql:
+                    continue
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                yield sql, [row[-1] for row in cursor.fetchall()]
+
+    def test_views_use_indexes(self):
+        urls = [
+            reverse('posts:index'),
+            reverse('posts:group_list', kwargs={'slug': self.group.slug}),
+            reverse('posts:profile',
+                    kwargs={'username': self.author.username}),
+            reverse('posts:follow_index'),
+            reverse('posts:post_detail', kwargs={'post_id': self.post.pk}),
+        ]
+        for url in urls:
+            for sql, plan in self.plans(url):
+                with self.subTest(url=url, sql=sql):
+                    for line in plan:
+                        self.assertNotIn(TEMP_SORT, line, plan)
+                        scan = FULL_SCAN.search(line)
+                        self.assertFalse(
+                            scan and scan.group(1).startswith('posts_'),
+                            plan)
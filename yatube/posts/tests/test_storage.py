@@ -0,0 +1,228 @@
+import json
+import os
+import shutil
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from .. import media, thumbnails
+from ..models import Post, StoredFile, User
+
+TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
+
+SMALL_GIF = (
+    b'\x47\x49\x46\x38\x39\x61\x02\x00'
+    b'\x01\x00\x80\x00\x00\x00\x00\x00'
+    b'\xFF\xFF\xFF\x21\xF9\x04\x00\x00'
+    b'\x00\x00\x00\x2C\x00\x00\x00\x00'
+    b'\x02\x00\x01\x00\x00\x02\x02\x0C'
+    b'\x0A\x00\x3B'
+)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, THUMBNAIL_WORKERS=0)
+class ContentAddressedStorageTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user = User.objects.create_user(username='reposter')
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def create(self, name='meme.gif'):
+        with mock.patch('posts.thumbnails.schedule'):
+            return Post.objects.create(
+                author=self.user, text='репост',
+                image=SimpleUploadedFile(name, SMALL_GIF, 'image/gif'))
+
+    def test_same_upload_stored_once(self):
+        first, second = self.create(), self.create('copy.gif')
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertRegex(first.image.name, r'^posts/[0-9a-f]{2}/\w{64}\.gif$')
+        directory = os.path.dirname(first.image.path)
+        self.assertEqual(os.listdir(directory),
+                         [os.path.basename(first.image.name)])
+        self.assertEqual(
+            StoredFile.objects.get(name=first.image.name).references, 2)
+
+    def test_file_removed_with_last_reference(self):
+        first, second = self.create(), self.create()
+        path = first.image.path
+        with mock.patch('posts.media.transaction.on_commit',
+                        side_effect=lambda func: func()):
+            first.delete()
+            self.assertTrue(os.path.exists(path))
+            second.delete()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(StoredFile.objects.exists())
+
+    def test_reupload_survives_pending_removal(self):
+        first = self.create()
+        path = first.image.path
+        callbacks = []
+        with mock.patch('posts.media.transaction.on_commit',
+                        side_effect=callbacks.append):
+            first.delete()
+        storage = Post._meta.get_field('image').storage
+        exists = storage.exists
+
+        def exists_then_commit(name):
+            # коммит удаления приходится между проверкой файла и постом
+            found = exists(name)
+            while callbacks:
+                callbacks.pop()()
+            return found
+
+        with mock.patch.object(storage, 'exists',
+                               side_effect=exists_then_commit):
+            second = self.create('again.gif')
+        self.assertEqual(second.image.name, first.image.name)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(
+            StoredFile.objects.get(name=second.image.name).references, 1)
+
+    def test_failed_save_releases_hold(self):
+        first = self.create()
+        # файл сохраняется, а INSERT с занятым pk падает
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Post.objects.create(
+                pk=first.pk, author=self.user, image=SimpleUploadedFile(
+                    'broken.gif', SMALL_GIF, 'image/gif'))
+        # ссылка неудачного сохранения не достаётся следующему посту
+        post = Post.objects.create(author=self.user)
+        post.image = first.image.name
+        post.save()
+        self.assertEqual(
+            StoredFile.objects.get(name=first.image.name).references, 2)
+
+    def test_dedupe_media_command(self):
+        os.makedirs(os.path.join(TEMP_MEDIA_ROOT, 'posts'), exist_ok=True)
+        names = ['posts/old1.gif', 'posts/old2.gif']
+        for name in names:
+            with open(os.path.join(TEMP_MEDIA_ROOT, name), 'wb') as file:
+                file.write(SMALL_GIF)
+        with mock.patch('posts.thumbnails.schedule'):
+            posts = [Post.objects.create(author=self.user, image=name)
+                     for name in names]
+        out = StringIO()
+        call_command('dedupe_media', '--batch-size', '1', stdout=out)
+        self.assertIn('удалено дубликатов: 1', out.getvalue())
+        targets = {Post.objects.get(pk=post.pk).image.name for post in posts}
+        self.assertEqual(len(targets), 1)
+        target = targets.pop()
+        self.assertTrue(os.path.exists(os.path.join(TEMP_MEDIA_ROOT, target)))
+        for name in names:
+            self.assertFalse(
+                os.path.exists(os.path.join(TEMP_MEDIA_ROOT, name)))
+        self.assertEqual(StoredFile.objects.get(name=target).references, 2)
+        self.assertFalse(StoredFile.objects.filter(name__in=names).exists())
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, THUMBNAIL_WORKERS=0)
+class GcMediaTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        cache.clear()
+        self.quarantine = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.quarantine, True)
+        user = User.objects.create_user(username='collector')
+        self.live, self.dead = (
+            Post.objects.create(
+                author=user, image=SimpleUploadedFile(
+                    name, SMALL_GIF + suffix, 'image/gif'))
+            for name, suffix in (('live.gif', b''), ('dead.gif', b'\0')))
+        for post in (self.live, self.dead):
+            thumbnails.build(post.image.name)
+            post.refresh_from_db()
+        # удаление без коммита: файлы остаются, как после старых каскадов
+        Post.objects.filter(pk=self.dead.pk).delete()
+        self.orphan = os.path.join(TEMP_MEDIA_ROOT, 'posts', 'orphan.jpg')
+        with open(self.orphan, 'wb') as file:
+            file.write(SMALL_GIF)
+        self.files = {
+            'live': self.names(self.live), 'dead': self.names(self.dead)}
+        # всё «старое», кроме свежего файла ниже
+        for entry in media.scan(TEMP_MEDIA_ROOT):
+            os.utime(entry.path, (0, 0))
+        self.fresh = os.path.join(TEMP_MEDIA_ROOT, 'posts', 'fresh.jpg')
+        with open(self.fresh, 'wb') as file:
+            file.write(SMALL_GIF)
+
+    def names(self, post):
+        thumbnail = thumbnails.default.backend.thumbnail_file(
+            post.image.name, thumbnails.POST_GEOMETRY,
+            **thumbnails.POST_OPTIONS)
+        manifest = json.loads(post.image_variants)
+        return [post.image.name, thumbnail.name] + [
+            name for source in manifest['sources']
+            for name, _ in source['files']]
+
+    def gc(self, *args):
+        out = StringIO()
+        call_command('gc_media', '--min-age', '60',
+                     '--quarantine', self.quarantine, *args, stdout=out)
+        return out.getvalue()
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(TEMP_MEDIA_ROOT, name))
+
+    def test_dry_run_changes_nothing(self):
+        # записи sorl в пробном прогоне не снимаются, поэтому миниатюра
+        # удалённого поста не в счёт, зато считается orphan.jpg
+        orphans = len(self.files['dead'])
+        self.assertIn(f'найдено сирот: {orphans}', self.gc('--dry-run'))
+        self.assertTrue(all(map(self.exists, self.files['dead'])))
+
+    def test_orphans_quarantined(self):
+        output = self.gc()
+        self.assertIn('записей sorl без картинки поста: 1', output)
+        self.assertTrue(all(map(self.exists, self.files['live'])))
+        for name in self.files['dead'] + ['posts/orphan.jpg']:
+            self.assertFalse(self.exists(name), name)
+            self.assertTrue(
+                os.path.exists(os.path.join(self.quarantine, name)), name)
+        self.assertTrue(os.path.exists(self.fresh))
+        self.assertFalse(StoredFile.objects.filter(
+            name=self.files['dead'][0]).exists())
+
+    def test_variants_kept_by_manifest(self):
+        # у оригинала необычное расширение: оставить вариант может только
+        # манифест поста
+        variant = 'posts/pic.320w.webp'
+        Post.objects.bulk_create([Post(
+            author=self.live.author, image='posts/pic.jfif',
+            image_variants=json.dumps(
+                {'sources': [{'files': [[variant, 320]]}]}))])
+        for name in (variant, 'posts/lost.320w.webp'):
+            path = os.path.join(TEMP_MEDIA_ROOT, name)
+            with open(path, 'wb') as file:
+                file.write(SMALL_GIF)
+            os.utime(path, (0, 0))
+        with CaptureQueriesContext(connection) as queries:
+            self.gc()
+        self.assertTrue(self.exists(variant))
+        self.assertFalse(self.exists('posts/lost.320w.webp'))
+        # манифесты читаются только для корней из пачки и по индексу
+        manifests = [query['sql'] for query in queries.captured_queries
+                     if 'image_variants' in query['sql']]
+        self.assertTrue(manifests)
+        with connection.cursor() as cursor:
+            for sql in manifests:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                plan = ' '.join(row[-1] for row in cursor.fetchall())
+                self.assertIn('post_image_idx', plan)
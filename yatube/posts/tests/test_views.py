@@ -1,13 +1,32 @@
+import csv
+import gzip
+import json
+import os
 import shutil
+import sqlite3
 import tempfile
+import threading
+import time
+from io import BytesIO, StringIO
+from unittest import mock
 
-from django.test import Client, TestCase, override_settings
+from django.test import (Client, TestCase, TransactionTestCase,
+                         override_settings)
+from PIL import Image
 from django.conf import settings
 from django import forms
 from django.urls import reverse
-from ..models import Group, Post, User, Follow
+from .. import autocomplete, membership, thumbnails
+from ..caching import render_postcards
+from ..management.commands.import_posts import Command
+from ..models import (AuthorStats, Comment, FeedEntry, Follow, Group,
+                      ImportedPost, Post, User)
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections
+from core import replicas
+from django.test.utils import CaptureQueriesContext
 
 POSTSNUM_PAGE1 = 10
 POSTSNUM_PAGE2_1 = 3
@@ -16,7 +35,7 @@ POSTSNUM_PAGE_EMT = 0
 TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
 
 
-@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, THUMBNAIL_WORKERS=0)
 class PostModelTest(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -126,17 +145,53 @@ class PostModelTest(TestCase):
         self.assertEqual(response.context.get('is_edit'), True)
 
     def test_index_cache(self):
+        # первый показ строит миниатюры, и манифест вариантов меняет ленту
+        self.guest_client.get(reverse('posts:index'))
         response = self.guest_client.get(reverse('posts:index'))
         res = response.content
-        response.context['page_obj'][0].delete()
+        # правка в обход сигналов не сбрасывает кэш фрагмента
+        Post.objects.filter(pk=self.post.pk).update(text='мимо кэша')
         response2 = self.guest_client.get(reverse('posts:index'))
         res2 = response2.content
         self.assertEqual(res, res2)
-        cache.clear()
+        # а удаление поста увеличивает поколение и сразу видно
+        response.context['page_obj'][0].delete()
         response3 = self.guest_client.get(reverse('posts:index'))
         res3 = response3.content
         self.assertNotEqual(res, res3)
 
+    def test_listing_cache_varies_on_page(self):
+        Post.objects.bulk_create(
+            Post(author=self.user, text=f'пост {i}', group=self.group)
+            for i in range(12))
+        for url in (reverse('posts:index'),
+                    reverse('posts:group_list',
+                            kwargs={'slug': self.group.slug}),
+                    reverse('posts:profile',
+                            kwargs={'username': self.user.username})):
+            with self.subTest(url=url):
+                first = self.guest_client.get(url)
+                cursor = first.context['page_obj'].next_cursor
+                second = self.guest_client.get(f'{url}?cursor={cursor}')
+                self.assertNotEqual(first.content, second.content)
+
+    def test_post_edit_invalidates_listings(self):
+        urls = (reverse('posts:index'),
+                reverse('posts:group_list', kwargs={'slug': self.group.slug}),
+                reverse('posts:profile',
+                        kwargs={'username': self.user.username}))
+        for url in urls:
+            self.guest_client.get(url)
+        self.authorized_client.post(
+            reverse('posts:post_edit', kwargs={'post_id': self.post.pk}),
+            data={'text': 'Отредактированный текст', 'group': ''})
+        for url in urls[::2]:
+            with self.subTest(url=url):
+                response = self.guest_client.get(url)
+                self.assertContains(response, 'Отредактированный текст')
+        response = self.guest_client.get(urls[1])
+        self.assertNotContains(response, 'Отредактированный текст')
+
     def test_following(self):
         self.authorized_client.get(reverse('posts:profile_follow', kwargs={
             'username':
@@ -240,3 +295,800 @@ class PaginatorViewsTest(TestCase):
                 'username': self.user.username}) + '?page=2')
         post = response.context['page_obj']
         self.assertEqual(len(post), POSTSNUM_PAGE2_1)
+
+    def test_index_cursor_pages(self):
+        """ Проход по курсорам вперёд и назад без COUNT(*) """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.guest_client.get(reverse('posts:index'))
+        page = response.context['page_obj']
+        self.assertFalse(page.has_previous())
+        self.assertFalse(any(
+            'COUNT(' in query['sql'] for query in queries.captured_queries))
+        response = self.guest_client.get(
+            reverse('posts:index') + f'?cursor={page.next_cursor}')
+        page2 = response.context['page_obj']
+        self.assertEqual(len(page2), POSTSNUM_PAGE2_1)
+        self.assertFalse(page2.has_next())
+        self.assertFalse(set(page) & set(page2))
+        response = self.guest_client.get(
+            reverse('posts:index') + f'?cursor={page2.previous_cursor}')
+        self.assertEqual(
+            list(response.context['page_obj']), list(page))
+
+    def test_broken_cursor_shows_first_page(self):
+        response = self.guest_client.get(
+            reverse('posts:index') + '?cursor=not-a-cursor')
+        post = response.context['page_obj']
+        self.assertEqual(len(post), POSTSNUM_PAGE1)
+
+
+class FeedTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.reader = User.objects.create_user(username='reader')
+        cls.author = User.objects.create_user(username='writer')
+        cls.old_post = Post.objects.create(author=cls.author, text='старый')
+
+    def setUp(self):
+        self.client = Client()
+        self.client.force_login(self.reader)
+        cache.clear()
+
+    def feed(self):
+        response = self.client.get(reverse('posts:follow_index'))
+        return list(response.context['page_obj'])
+
+    def test_follow_backfills_and_fans_out(self):
+        self.client.get(reverse('posts:profile_follow',
+                                kwargs={'username': self.author.username}))
+        self.assertEqual(self.feed(), [self.old_post])
+        new_post = Post.objects.create(author=self.author, text='новый')
+        self.assertEqual(self.feed(), [new_post, self.old_post])
+        self.client.get(reverse('posts:profile_unfollow',
+                                kwargs={'username': self.author.username}))
+        self.assertEqual(self.feed(), [])
+        self.assertFalse(FeedEntry.objects.filter(user=self.reader).exists())
+
+    def test_rebuild_feeds_command(self):
+        Follow.objects.create(user=self.reader, author=self.author)
+        Post.objects.bulk_create(
+            Post(author=self.author, text='без сигналов') for _ in range(3))
+        self.assertEqual(len(self.feed()), 1)
+        call_command('rebuild_feeds', stdout=StringIO())
+        self.assertEqual(len(self.feed()), 4)
+
+    @override_settings(FEED_PUSH_THRESHOLD=1)
+    def test_hybrid_feed_merges_popular_authors(self):
+        """ Посты автора с подписчиками сверх порога тянутся при чтении """
+        fan = User.objects.create_user(username='fan')
+        Follow.objects.create(user=fan, author=self.author)
+        Follow.objects.create(user=self.reader, author=self.author)
+        cache.clear()
+        regular = User.objects.create_user(username='regular')
+        Follow.objects.create(user=self.reader, author=regular)
+        posts = []
+        for i in range(12):
+            posts.append(Post.objects.create(
+                author=self.author if i % 2 else regular, text=str(i)))
+        self.assertFalse(FeedEntry.objects.filter(
+            author=self.author, post__in=posts).exists())
+        expected = [*reversed(posts), self.old_post]
+        response = self.client.get(reverse('posts:follow_index'))
+        page = response.context['page_obj']
+        response = self.client.get(
+            reverse('posts:follow_index') + f'?cursor={page.next_cursor}')
+        self.assertEqual(
+            list(page) + list(response.context['page_obj']), expected)
+
+    def pulled(self):
+        self.author.stats.refresh_from_db()
+        return self.author.stats.feed_pulled
+
+    @override_settings(FEED_PUSH_THRESHOLD=2)
+    def test_author_crosses_threshold_both_ways(self):
+        fans = [User.objects.create_user(username=f'fan{i}')
+                for i in range(2)]
+        for user in (self.reader, *fans):
+            Follow.objects.create(user=user, author=self.author)
+        self.assertTrue(self.pulled())
+        pulled = Post.objects.create(author=self.author, text='подмешан')
+        self.assertFalse(FeedEntry.objects.filter(post=pulled).exists())
+        self.assertEqual(self.feed(), [pulled, self.old_post])
+        # на пороге режим не меняется, и отписка не раскладывает посты
+        Follow.objects.filter(user=fans[0]).delete()
+        call_command('rebuild_feeds', '--modes-only', stdout=StringIO())
+        self.assertTrue(self.pulled())
+        Follow.objects.filter(user=fans[1]).delete()
+        self.assertTrue(self.pulled())
+        self.assertFalse(FeedEntry.objects.filter(post=pulled).exists())
+        # ниже полосы автор возвращается к раскладке вместе с постом
+        # периода подмешивания: лента без подмешивания его не теряет
+        call_command('rebuild_feeds', '--modes-only', stdout=StringIO())
+        self.assertFalse(self.pulled())
+        self.assertTrue(FeedEntry.objects.filter(
+            user=self.reader, post=pulled).exists())
+        cache.clear()
+        self.assertEqual(self.feed(), [pulled, self.old_post])
+        pushed = Post.objects.create(author=self.author, text='разложен')
+        self.assertEqual(self.feed(), [pushed, pulled, self.old_post])
+
+    def test_rebuild_feeds_applies_threshold(self):
+        Follow.objects.create(user=self.reader, author=self.author)
+        with override_settings(FEED_PUSH_THRESHOLD=0):
+            call_command('rebuild_feeds', stdout=StringIO())
+            self.assertTrue(self.pulled())
+        call_command('rebuild_feeds', stdout=StringIO())
+        self.assertFalse(self.pulled())
+        self.assertEqual(self.feed(), [self.old_post])
+
+
+class PostcardCacheTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user = User.objects.create_user(username='carder')
+        cls.group = Group.objects.create(title='Карточки', slug='cards')
+        Post.objects.bulk_create(
+            Post(author=cls.user, group=cls.group, text=f'карточка {i}')
+            for i in range(3))
+
+    def setUp(self):
+        cache.clear()
+
+    def posts(self):
+        return list(Post.objects.select_related('author', 'group'))
+
+    def test_cards_rendered_once(self):
+        first = render_postcards(self.posts())
+        with mock.patch('posts.caching.get_template') as get_template:
+            self.assertEqual(render_postcards(self.posts()), first)
+        get_template.assert_not_called()
+
+    def test_author_rename_changes_card(self):
+        render_postcards(self.posts())
+        User.objects.filter(pk=self.user.pk).update(username='renamed')
+        cards = render_postcards(self.posts())
+        self.assertTrue(all('renamed' in card for card in cards))
+        Group.objects.filter(pk=self.group.pk).update(title='Новая группа')
+        cards = render_postcards(self.posts())
+        self.assertTrue(all('Новая группа' in card for card in cards))
+
+    def test_rename_refreshes_cached_listings(self):
+        pages = [reverse('posts:index'),
+                 reverse('posts:group_list', args=[self.group.slug]),
+                 reverse('posts:profile', args=[self.user.username])]
+        for url in pages:
+            self.assertContains(self.client.get(url), 'Карточки')
+        group = Group.objects.get(pk=self.group.pk)
+        group.title, group.slug = 'Открытки', 'postcards'
+        group.save()
+        user = User.objects.get(pk=self.user.pk)
+        user.username = 'renamed'
+        user.save()
+        # ключи фрагментов - по pk группы и автора, а не по ссылке
+        pages[1:] = [reverse('posts:group_list', args=['postcards']),
+                     reverse('posts:profile', args=['renamed'])]
+        for url in pages:
+            response = self.client.get(url)
+            self.assertNotContains(response, 'Карточки')
+            self.assertContains(response, '/group/postcards/')
+            self.assertContains(response, 'renamed')
+
+
+class SearchTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user = User.objects.create_user(
+            username='searcher', is_staff=True, is_superuser=True)
+        Post.objects.bulk_create(
+            Post(author=cls.user, text=f'про котов, выпуск {i}')
+            for i in range(13))
+        cls.best = Post.objects.create(
+            author=cls.user, text='Кот, кот и ещё раз коты')
+        Post.objects.create(author=cls.user, text='про собак')
+
+    def search(self, query, cursor=''):
+        response = self.client.get(
+            reverse('posts:search'), {'q': query, 'cursor': cursor})
+        return response.context['page_obj']
+
+    def test_ranked_prefix_search(self):
+        page = self.search('КОТ')
+        self.assertEqual(page[0], self.best)
+        self.assertEqual(len(page), POSTSNUM_PAGE1)
+        self.assertFalse(any('собак' in post.text for post in page))
+
+    def test_cursor_pages(self):
+        page = self.search('кот')
+        page2 = self.search('кот', page.next_cursor)
+        self.assertEqual(len(page2), 14 - POSTSNUM_PAGE1)
+        self.assertFalse(page2.has_next())
+        self.assertFalse(set(page) & set(page2))
+        self.assertEqual(
+            list(self.search('кот', page2.previous_cursor)), list(page))
+
+    def test_pages_stable_while_index_changes(self):
+        page = self.search('кот')
+        # новый пост меняет ранги всех совпадений
+        Post.objects.create(author=self.user, text='кот кот кот котик')
+        with CaptureQueriesContext(connection) as queries:
+            page2 = self.search('кот', page.next_cursor)
+        sql = ' '.join(query['sql'] for query in queries.captured_queries)
+        self.assertNotIn('MATCH', sql)
+        self.assertEqual(len(page) + len(page2), 14)
+        self.assertFalse(set(page) & set(page2))
+
+    def test_index_follows_edits(self):
+        Post.objects.filter(pk=self.best.pk).update(text='теперь про ежей')
+        self.assertEqual(list(self.search('ежей')), [self.best])
+        self.assertNotIn(self.best, self.search('кот'))
+        Post.objects.filter(pk=self.best.pk).delete()
+        self.assertEqual(len(self.search('ежей')), 0)
+
+    def test_query_syntax_is_not_passed_through(self):
+        self.assertEqual(len(self.search('" AND (*')), 0)
+        self.assertEqual(len(self.search('')), 0)
+
+    def test_admin_search_uses_index(self):
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse('admin:posts_post_changelist'), {'q': 'собак'})
+        self.assertEqual(response.context['cl'].result_count, 1)
+        sql = ' '.join(query['sql'] for query in queries.captured_queries)
+        self.assertIn('MATCH', sql)
+        self.assertNotIn('LIKE', sql)
+
+
+class AutocompleteTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        User.objects.create_user(username='Anna')
+        User.objects.create_user(username='andrew')
+        User.objects.create_user(username='boris')
+        cls.group = Group.objects.create(title='Животные', slug='animals')
+
+    def setUp(self):
+        autocomplete.state.index = None
+
+    def complete(self, prefix):
+        response = self.client.get(
+            reverse('posts:autocomplete'), {'q': prefix})
+        return [item['value'] for item in response.json()['results']]
+
+    def test_prefix_matches_without_db(self):
+        self.assertEqual(self.complete('an'), ['andrew', 'animals', 'Anna'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.complete('жив'), ['animals'])
+            self.assertEqual(self.complete('x'), [])
+        response = self.client.get(reverse('posts:autocomplete'),
+                                   {'q': 'bor'})
+        self.assertEqual(response.json()['results'][0]['url'],
+                         reverse('posts:profile', args=['boris']))
+
+    def test_index_updated_in_place(self):
+        self.complete('a')
+        generation = autocomplete.state.generation
+        User.objects.create_user(username='anton')
+        self.group.slug = 'zoo'
+        self.group.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.complete('an'), ['andrew', 'Anna', 'anton'])
+            self.assertEqual(self.complete('zo'), ['zoo'])
+        self.assertNotEqual(autocomplete.state.generation, generation)
+
+    def other_process(self):
+        """Индекс «другого процесса» на время блока."""
+        return mock.patch.object(autocomplete, 'state',
+                                 autocomplete._State())
+
+    def test_other_process_change_replayed(self):
+        self.complete('a')
+        with self.other_process():
+            User.objects.create_user(username='alice')
+            self.group.delete()
+        autocomplete.state.checked = 0
+        with self.assertNumQueries(0):
+            self.assertEqual(self.complete('a'), ['alice', 'andrew', 'Anna'])
+
+    def test_bulk_changes_rebuild(self):
+        self.complete('a')
+        # bulk_create в обход сигналов, как в import_posts
+        User.objects.bulk_create([User(username='alice')])
+        with self.other_process():
+            autocomplete.invalidate()
+        autocomplete.state.checked = 0
+        self.assertIn('alice', self.complete('al'))
+
+    def test_invalidate_keeps_index_for_readers(self):
+        self.complete('a')
+        User.objects.bulk_create([User(username='alice')])
+        autocomplete.invalidate()
+        # параллельный complete() не должен застать индекс пустым
+        self.assertIsNotNone(autocomplete.state.index)
+        self.assertIn('alice', self.complete('al'))
+
+
+class MembershipTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user = User.objects.create_user(username='known')
+        Group.objects.create(title='Известная', slug='known-group')
+
+    def setUp(self):
+        cache.clear()
+        membership.state.filter = None
+
+    def test_bloom_filter(self):
+        bloom = membership.BloomFilter(1000)
+        for i in range(1000):
+            bloom.add(f'user:{i}')
+        self.assertTrue(all(f'user:{i}' in bloom for i in range(1000)))
+        false = sum(f'user:x{i}' in bloom for i in range(10000))
+        self.assertLess(false, 300)
+
+    def test_unknown_names_404_without_db(self):
+        self.client.get(reverse('posts:profile', args=['known']))
+        with self.assertNumQueries(0):
+            for url in (reverse('posts:profile', args=['nobody']),
+                        reverse('posts:group_list', args=['no-group'])):
+                self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_new_names_found(self):
+        self.client.get(reverse('posts:profile', args=['known']))
+        User.objects.create_user(username='newcomer')
+        Group.objects.create(title='Новая', slug='new-group')
+        for url in (reverse('posts:profile', args=['newcomer']),
+                    reverse('posts:group_list', args=['new-group'])):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_names_added_by_other_process(self):
+        self.client.get(reverse('posts:profile', args=['known']))
+        bloom = membership.state.filter
+        # другой процесс: фильтра этого процесса его запись не касается
+        membership.state.filter = None
+        User.objects.create_user(username='elsewhere')
+        membership.state.filter = bloom
+        response = self.client.get(
+            reverse('posts:profile', args=['elsewhere']))
+        self.assertEqual(response.status_code, 200)
+        self.assertIs(membership.state.filter, bloom)
+
+    def test_false_positive_cached(self):
+        url = reverse('posts:profile', args=['ghost'])
+        self.client.get(reverse('posts:profile', args=['known']))
+        with mock.patch.object(membership.BloomFilter, '__contains__',
+                               return_value=True):
+            with self.assertNumQueries(1):
+                self.assertEqual(self.client.get(url).status_code, 404)
+            with self.assertNumQueries(0):
+                self.assertEqual(self.client.get(url).status_code, 404)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, THUMBNAIL_WORKERS=0)
+class ThumbnailTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='painter')
+        self.image = SimpleUploadedFile(
+            name='thumb.gif',
+            content=(
+                b'\x47\x49\x46\x38\x39\x61\x02\x00'
+                b'\x01\x00\x80\x00\x00\x00\x00\x00'
+                b'\xFF\xFF\xFF\x21\xF9\x04\x00\x00'
+                b'\x00\x00\x00\x2C\x00\x00\x00\x00'
+                b'\x02\x00\x01\x00\x00\x02\x02\x0C'
+                b'\x0A\x00\x3B'
+            ),
+            content_type='image/gif')
+
+    def test_upload_schedules_thumbnail(self):
+        with mock.patch('posts.thumbnails.transaction.on_commit',
+                        side_effect=lambda func: func()):
+            post = Post.objects.create(
+                author=self.user, text='с картинкой', image=self.image)
+        self.assertIsNotNone(thumbnails.ready_thumbnail(post.image))
+
+    def test_placeholder_until_thumbnail_ready(self):
+        with mock.patch('posts.thumbnails.submit') as submit:
+            post = Post.objects.create(
+                author=self.user, text='с картинкой', image=self.image)
+            card, = render_postcards([post])
+        submit.assert_called_with(post.image.name)
+        self.assertIn('Картинка готовится', card)
+        thumbnails.generate(post.image.name)
+        card, = render_postcards([post])
+        self.assertNotIn('Картинка готовится', card)
+        self.assertIn(thumbnails.ready_thumbnail(post.image).url, card)
+
+    def test_page_thumbnails_in_one_query(self):
+        posts = [
+            Post.objects.create(
+                author=self.user, text=f'картинка {i}', image=self.image)
+            for i in range(3)
+        ]
+        for post in posts:
+            thumbnails.generate(post.image.name)
+        cache.clear()
+        thumbnails.lru.clear()
+        with CaptureQueriesContext(connection) as context:
+            render_postcards(posts)
+        kvstore = [query for query in context.captured_queries
+                   if 'thumbnail_kvstore' in query['sql']]
+        self.assertEqual(len(kvstore), 1)
+        # второй раз записи берутся из LRU процесса
+        cache.clear()
+        with mock.patch.object(
+                thumbnails.KVStoreModel.objects, 'filter') as kv_filter:
+            cards = render_postcards(posts)
+        kv_filter.assert_not_called()
+        self.assertFalse(any('Картинка готовится' in card for card in cards))
+
+    def test_image_change_forgets_lru(self):
+        post = Post.objects.create(
+            author=self.user, text='с картинкой', image=self.image)
+        thumbnails.generate(post.image.name)
+        self.assertIsNotNone(thumbnails.ready_thumbnail(post.image))
+        key = thumbnails.default.backend.thumbnail_file(
+            post.image.name, thumbnails.POST_GEOMETRY,
+            **thumbnails.POST_OPTIONS).key
+        raw_key = thumbnails.add_prefix(key)
+        self.assertIsNotNone(thumbnails.lru.get(raw_key))
+        with mock.patch('posts.thumbnails.schedule'):
+            post.image = SimpleUploadedFile(
+                name='other.gif', content=self.image.open().read() + b'\0',
+                content_type='image/gif')
+            post.save()
+        self.assertIsNone(thumbnails.lru.get(raw_key))
+
+    def test_forget_reaches_other_processes(self):
+        post = Post.objects.create(
+            author=self.user, text='с картинкой', image=self.image)
+        thumbnails.generate(post.image.name)
+        self.assertIsNotNone(thumbnails.ready_thumbnail(post.image))
+        # другой процесс удалил файл: записи sorl нет, а наш LRU её помнит
+        generation = thumbnails.lru.generation
+        with mock.patch.object(thumbnails, 'lru', thumbnails.LRU(10)):
+            thumbnails.default.kvstore.delete(
+                thumbnails.ImageFile(post.image.name))
+            thumbnails.forget(post.image.name)
+        self.assertNotEqual(thumbnails._lru_generation(), generation)
+        thumbnails.lru.checked = 0
+        with mock.patch('posts.thumbnails.submit'):
+            self.assertIsNone(thumbnails.ready_thumbnail(post.image))
+
+    def test_failed_build_backs_off(self):
+        with mock.patch('posts.thumbnails.schedule'):
+            post = Post.objects.create(
+                author=self.user, text='с картинкой', image=self.image)
+        with mock.patch('posts.thumbnails.build',
+                        side_effect=OSError('битый файл')) as build, \
+                self.assertLogs('posts.thumbnails', 'ERROR') as logs:
+            for _ in range(3):
+                self.assertIsNone(thumbnails.ready_thumbnail(post.image))
+            self.assertEqual(build.call_count, 1)
+            self.assertIn('через 60 с', logs.output[0])
+            # пауза вышла: пробуем снова, следующая пауза вдвое дольше
+            later = time.time() + 61
+            with mock.patch('posts.thumbnails.time.time',
+                            return_value=later):
+                thumbnails.ready_thumbnail(post.image)
+                thumbnails.ready_thumbnail(post.image)
+            self.assertEqual(build.call_count, 2)
+            self.assertIn('через 120 с', logs.output[1])
+
+    def test_variants_manifest_rendered_without_lookups(self):
+        post = Post.objects.create(
+            author=self.user, text='с картинкой', image=self.image)
+        thumbnails.generate(post.image.name)
+        post.refresh_from_db()
+        self.assertIn('.320w.webp', post.image_variants)
+        with mock.patch('posts.thumbnails.ready_thumbnails') as lookup:
+            card, = render_postcards([post])
+            response = self.client.get(
+                reverse('posts:post_detail', kwargs={'post_id': post.pk}))
+        lookup.assert_not_called()
+        for html in (card, response.content.decode()):
+            self.assertIn('<picture>', html)
+            self.assertIn('type="image/webp"', html)
+            self.assertIn('.960w.webp 960w', html)
+
+    def test_concurrent_requests_coalesce(self):
+        built = threading.Event()
+        calls = []
+
+        def build(backend, file_, geometry, **options):
+            calls.append(file_)
+            time.sleep(0.2)
+            built.set()
+            return 'thumbnail'
+
+        def kv_get(store, image_file):
+            return 'thumbnail' if built.is_set() else None
+
+        results = []
+        with mock.patch('sorl.thumbnail.base.ThumbnailBackend.get_thumbnail',
+                        autospec=True, side_effect=build), \
+                mock.patch.object(thumbnails.PostKVStore, 'get',
+                                  autospec=True, side_effect=kv_get):
+            workers = [
+                threading.Thread(target=lambda: results.append(
+                    thumbnails.default.backend.get_thumbnail(
+                        'posts/popular.gif', thumbnails.POST_GEOMETRY,
+                        **thumbnails.POST_OPTIONS)))
+                for _ in range(4)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        self.assertEqual(calls, ['posts/popular.gif'])
+        self.assertEqual(results, ['thumbnail'] * 4)
+        self.assertEqual(thumbnails.flight_counters(),
+                         {'generated': 1, 'coalesced': 3, 'timed_out': 0})
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, THUMBNAIL_WORKERS=0)
+class RegenerateThumbnailsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='regenerator')
+        with mock.patch('posts.thumbnails.schedule'):
+            for color in ('red', 'green', 'blue'):
+                buffer = BytesIO()
+                Image.new('RGB', (40, 20), color).save(buffer, 'PNG')
+                Post.objects.create(
+                    author=self.user, text=color,
+                    image=SimpleUploadedFile(
+                        f'{color}.png', buffer.getvalue(), 'image/png'))
+        self.names = sorted(Post.objects.values_list('image', flat=True))
+        self.checkpoint = os.path.join(TEMP_MEDIA_ROOT, 'regenerate.ckpt')
+
+    def regenerate(self, *args):
+        out = StringIO()
+        call_command('regenerate_thumbnails', '--workers', '0',
+                     '--checkpoint', self.checkpoint, *args, stdout=out)
+        return out.getvalue()
+
+    def built(self):
+        return {post.image.name for post in Post.objects.exclude(
+            image_variants='')}
+
+    def test_dry_run_estimates_without_writing(self):
+        output = self.regenerate('--dry-run')
+        self.assertIn('Картинок: 3', output)
+        self.assertIn('CPU на картинку', output)
+        self.assertEqual(self.built(), set())
+
+    def test_resumes_from_checkpoint(self):
+        with open(self.checkpoint, 'w') as file:
+            file.write(self.names[0])
+        output = self.regenerate()
+        self.assertIn(f'Продолжаем после {self.names[0]}', output)
+        self.assertIn('Готово: 2, ошибок: 0', output)
+        self.assertEqual(self.built(), set(self.names[1:]))
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.regenerate('--force')
+        self.assertEqual(self.built(), set(self.names))
+
+
+class ImportPostsTest(TransactionTestCase):
+    """Снятие индексов на SQLite невозможно внутри транзакции TestCase."""
+
+    def setUp(self):
+        cache.clear()
+        self.reader = User.objects.create_user(username='importreader')
+        self.author = User.objects.create_user(username='oldtimer')
+        Follow.objects.create(user=self.reader, author=self.author)
+        records = [
+            {'id': 1, 'author': 'oldtimer', 'group': 'archive',
+             'text': 'старый пост', 'pub_date': '2015-03-01T10:00:00'},
+            {'id': 2, 'author': 'newcomer', 'text': 'второй пост'},
+            {'type': 'comment', 'post': 1, 'author': 'newcomer',
+             'text': 'старый комментарий', 'created': '2015-03-02T10:00'},
+            {'id': 3, 'author': 'oldtimer', 'text': 'третий пост'},
+            {'post': 3, 'author': 'oldtimer', 'text': 'сам себе'},
+        ]
+        handle, self.path = tempfile.mkstemp(suffix='.jsonl')
+        self.addCleanup(os.remove, self.path)
+        with os.fdopen(handle, 'w', encoding='utf-8') as file:
+            for record in records:
+                file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def run_import(self, *args):
+        out = StringIO()
+        call_command('import_posts', self.path, '--batch-size', '2',
+                     '--create-missing', *args, stdout=out)
+        return out.getvalue()
+
+    def check_imported(self):
+        old = Post.objects.get(text='старый пост')
+        self.assertEqual(old.pub_date.year, 2015)
+        self.assertEqual(old.group.slug, 'archive')
+        self.assertEqual(Post.objects.filter(
+            author__username='newcomer').count(), 1)
+        self.assertEqual(old.comments.get().author.username, 'newcomer')
+        self.assertEqual(Post.objects.count(), 3)
+        self.assertEqual(Comment.objects.count(), 2)
+        self.assertEqual(
+            dict(ImportedPost.objects.values_list(
+                'external_id', 'post__text')),
+            {'1': 'старый пост', '2': 'второй пост', '3': 'третий пост'})
+        self.author.stats.refresh_from_db()
+        self.assertEqual(self.author.stats.posts_count, 2)
+        self.assertEqual(FeedEntry.objects.filter(user=self.reader).count(),
+                         2)
+        with connection.cursor() as cursor:
+            indexes = connection.introspection.get_constraints(
+                cursor, Post._meta.db_table)
+        self.assertIn('post_pub_date_idx', indexes)
+
+    def test_import(self):
+        # pk удалённого поста не выдаётся импортированным
+        deleted = Post.objects.create(author=self.author, text='удалён').pk
+        Post.objects.filter(pk=deleted).delete()
+        bystander = User.objects.create_user(username='bystander')
+        AuthorStats.objects.filter(user=bystander).update(posts_count=7)
+        output = self.run_import()
+        self.assertIn('Импортировано: 5', output)
+        self.check_imported()
+        self.assertGreater(Post.objects.order_by('pk').first().pk, deleted)
+        # счётчики пересчитываются только у затронутых импортом
+        bystander.stats.refresh_from_db()
+        self.assertEqual(bystander.stats.posts_count, 7)
+        self.assertIn('уже импортирован', self.run_import())
+
+    def test_bad_rows_reported(self):
+        records = [
+            {'type': 'comment', 'post': 5, 'author': 'oldtimer',
+             'text': 'раньше поста'},
+            {'id': 4, 'author': 'oldtimer', 'text': 'плохая дата',
+             'pub_date': '2021-13-45T10:00:00'},
+            {'id': 5, 'author': 'oldtimer', 'text': 'пятый пост'},
+            {'post': 5, 'author': 'oldtimer', 'text': 'к пятому',
+             'created': 'вчера'},
+        ]
+        with open(self.path, 'w', encoding='utf-8') as file:
+            for record in records:
+                file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        output = self.run_import()
+        self.assertIn('Импортировано: 1, пропущено: 3', output)
+        self.assertIn('Из пропущенных комментариев 1 стоят в файле', output)
+        self.assertEqual(list(Post.objects.values_list('text', flat=True)),
+                         ['пятый пост'])
+        self.assertFalse(Comment.objects.exists())
+
+    def test_resume_after_crash(self):
+        insert = Command.insert_comments
+        calls = []
+
+        def crash_on_second(command, rows):
+            calls.append(rows)
+            if len(calls) == 2:
+                raise RuntimeError('сбой')
+            return insert(command, rows)
+
+        with mock.patch.object(Command, 'insert_comments', crash_on_second):
+            with self.assertRaises(RuntimeError):
+                self.run_import()
+        # первая пачка записана, вторая откатилась целиком
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertIn('Продолжаем после строки 2', self.run_import())
+        self.check_imported()
+
+
+class ExportTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.staff = User.objects.create_user(username='exporter',
+                                             is_staff=True)
+        cls.user = User.objects.create_user(username='exported')
+        Follow.objects.create(user=cls.user, author=cls.staff)
+        for i in range(5):
+            post = Post.objects.create(author=cls.user, text=f'пост {i}')
+        Comment.objects.create(post=post, author=cls.staff, text='ответ')
+
+    def export(self, *args):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        call_command('export_data', *args, '--output', path,
+                     stdout=StringIO())
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def test_keyset_chunks(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = self.export('posts', '--chunk-size', '2')
+        records = [json.loads(line) for line in data.decode().splitlines()]
+        self.assertEqual([record['text'] for record in records],
+                         [f'пост {i}' for i in range(5)])
+        self.assertEqual(records[0]['author'], 'exported')
+        self.assertEqual(records[0]['type'], 'post')
+        # три порции по два поста, без полного чтения таблицы
+        self.assertEqual(len(queries), 3)
+        self.assertTrue(all('LIMIT 2' in query['sql']
+                            for query in queries.captured_queries))
+
+    def test_csv_and_gzip(self):
+        data = gzip.decompress(
+            self.export('comments', '--format', 'csv', '--gzip'))
+        rows = list(csv.DictReader(data.decode().splitlines()))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['author'], 'exporter')
+        self.assertEqual(rows[0]['type'], 'comment')
+
+    def test_view_staff_only(self):
+        url = reverse('posts:export', args=['follows'])
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(self.staff)
+        response = self.client.get(url)
+        self.assertTrue(response.streaming)
+        record = json.loads(b''.join(response.streaming_content))
+        self.assertEqual((record['user'], record['author']),
+                         ('exported', 'exporter'))
+        response = self.client.get(reverse('posts:export', args=['users']))
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(READ_REPLICAS=['replica'])
+class LaggingReplicaTest(TransactionTestCase):
+    """Реплика отстаёт от основной базы: общие кэши её не запоминают."""
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user(username='writer')
+        self.group = Group.objects.create(title='Старая', slug='old')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        connections.databases['replica'] = {
+            **connections.databases['default'],
+            'NAME': os.path.join(directory, 'replica.sqlite3'),
+        }
+        self.addCleanup(self.drop_replica)
+        self.sync_replica()
+        self.client.force_login(self.author)
+        self.visitor = Client()
+
+    def drop_replica(self):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.databases['replica']
+
+    def sync_replica(self):
+        connections['replica'].close()
+        connection.ensure_connection()
+        target = sqlite3.connect(connections.databases['replica']['NAME'])
+        connection.connection.backup(target)
+        target.close()
+
+    def test_author_sees_post_after_visitor_read_replica(self):
+        response = self.client.post(reverse('posts:post_create'),
+                                    {'text': 'только что'})
+        self.assertIn(replicas.COOKIE, response.cookies)
+        url = reverse('posts:profile', args=[self.author.username])
+        # реплика ещё не догнала: гость пост не видит
+        self.assertNotContains(self.visitor.get(url), 'только что')
+        self.assertContains(self.client.get(url), 'только что')
+        self.sync_replica()
+        cache.clear()
+        self.assertContains(self.visitor.get(url), 'только что')
+
+    def test_new_group_not_remembered_missing(self):
+        Group.objects.create(title='Новая', slug='fresh')
+        url = reverse('posts:group_list', args=['fresh'])
+        self.assertEqual(self.visitor.get(url).status_code, 200)
+        self.assertTrue(membership.may_exist(membership.GROUP, 'fresh'))
+        self.client.cookies[replicas.COOKIE] = '1'
+        self.assertEqual(self.client.get(url).status_code, 200)
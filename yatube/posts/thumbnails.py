@@ -0,0 +1,420 @@
+"""Фоновая подготовка миниатюр картинок постов.
+
+Шаблоны больше не вызывают ``{% thumbnail %}``, который декодирует и
+сжимает оригинал прямо в запросе. Миниатюры нужных геометрий строятся
+в пуле фоновых потоков сразу после сохранения картинки, а до готовности
+шаблон показывает заглушку.
+
+Одну и ту же миниатюру на хосте строит один процесс: остальные ждут его
+под ``core.locks.single_flight`` до ``THUMBNAIL_LOCK_WAIT`` секунд и берут
+готовый результат. Такие «склеенные» запросы считаются в кэше, см.
+``flight_counters``.
+
+Без пула (``THUMBNAIL_WORKERS = 0``, так в тестах) миниатюры строятся в том
+же потоке, но запрошенные во время HTTP-запроса - уже после ответа
+(``request_finished``): сборка не попадает в учёт запросов страницы
+и не меняет поколение ленты, пока её фрагмент рендерится.
+
+Если сборка упала, картинка не ставится в очередь снова до конца паузы
+(``THUMBNAIL_RETRY_DELAY``, удваивается с каждой неудачей): иначе каждая
+страница с ней заново тратила бы CPU и писала в лог ту же ошибку.
+
+Готовность миниатюр страницы проверяется пачкой: ``PostKVStore`` читает
+все ключи одним ``get_many`` кэша и одним запросом к таблице sorl, а перед
+ними держит LRU процесса с уже найденными миниатюрами. ``forget`` чистит
+LRU своего процесса и сдвигает поколение LRU в кэше; остальные процессы
+сверяются с ним не чаще раза в ``LRU_SYNC_INTERVAL`` секунд и при
+расхождении очищают свой LRU целиком.
+"""
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished, request_started
+from django.db import connection, transaction
+from django.dispatch import receiver
+from sorl.thumbnail import default
+from sorl.thumbnail.base import ThumbnailBackend
+from sorl.thumbnail.conf import defaults as default_settings
+from sorl.thumbnail.conf import settings as thumbnail_settings
+from sorl.thumbnail.images import ImageFile, deserialize_image_file
+from sorl.thumbnail.kvstores.base import add_prefix
+from sorl.thumbnail.kvstores.cached_db_kvstore import EMPTY_VALUE, KVStore
+from sorl.thumbnail.models import KVStore as KVStoreModel
+
+from core.locks import single_flight
+
+from . import variants
+from .models import Post
+
+logger = logging.getLogger(__name__)
+
+# геометрии, которые выводят шаблоны карточки и страницы поста
+POST_GEOMETRY = '960x339'
+POST_OPTIONS = {'crop': 'center', 'upscale': True}
+GEOMETRIES = [(POST_GEOMETRY, POST_OPTIONS)]
+LRU_GENERATION_KEY = 'thumbnails:lru:generation'
+LRU_SYNC_INTERVAL = getattr(settings, 'THUMBNAIL_LRU_SYNC_INTERVAL', 1)
+
+_executor = None
+_pending = set()
+_lock = Lock()
+# картинки, отложенные до конца HTTP-запроса этого потока (без пула)
+_deferred = local()
+
+
+class LRU:
+    """Потокобезопасный LRU фиксированного размера."""
+
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = Lock()
+        # поколение в кэше, с которым LRU сверялся последним, и когда
+        self.generation = None
+        self.checked = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def discard(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# только найденные записи: отсутствие миниатюры может смениться в любой
+# момент в другом процессе, а готовая запись под своим ключом не меняется
+lru = LRU(settings.THUMBNAIL_LRU_SIZE)
+
+
+def _lru_generation():
+    generation = cache.get(LRU_GENERATION_KEY)
+    if generation is None:
+        cache.add(LRU_GENERATION_KEY, 0, None)
+        generation = cache.get(LRU_GENERATION_KEY)
+    return generation
+
+
+def sync_lru():
+    """Очищает LRU, если другой процесс забыл какие-то картинки."""
+    now = time.monotonic()
+    if now - lru.checked < LRU_SYNC_INTERVAL:
+        return
+    generation = _lru_generation()
+    if generation != lru.generation:
+        lru.clear()
+        lru.generation = generation
+    lru.checked = now
+
+
+class PostKVStore(KVStore):
+    """KV-хранилище sorl (кэш + БД) с LRU процесса и пакетным чтением."""
+
+    def _get_raw(self, key):
+        sync_lru()
+        value = lru.get(key)
+        if value is None:
+            value = super()._get_raw(key)
+            if value is not None:
+                lru.put(key, value)
+        return value
+
+    def _set_raw(self, key, value):
+        super()._set_raw(key, value)
+        lru.put(key, value)
+
+    def _delete_raw(self, *keys):
+        super()._delete_raw(*keys)
+        lru.discard(*keys)
+
+    def get_many(self, image_files):
+        """{ключ: ImageFile} найденных записей: LRU, кэш, затем один запрос."""
+        keys = {add_prefix(image_file.key): image_file.key
+                for image_file in image_files}
+        sync_lru()
+        values = {}
+        for raw_key in keys:
+            value = lru.get(raw_key)
+            if value is not None:
+                values[raw_key] = value
+        missing = [raw_key for raw_key in keys if raw_key not in values]
+        if missing:
+            cached = self.cache.get_many(missing)
+            absent = [raw_key for raw_key in missing if raw_key not in cached]
+            if absent:
+                rows = dict(KVStoreModel.objects.filter(
+                    key__in=absent).values_list('key', 'value'))
+                # как и _get_raw, запоминаем в кэше и отсутствие записи
+                loaded = {raw_key: rows.get(raw_key, EMPTY_VALUE)
+                          for raw_key in absent}
+                self.cache.set_many(
+                    loaded, thumbnail_settings.THUMBNAIL_CACHE_TIMEOUT)
+                cached.update(loaded)
+            for raw_key, value in cached.items():
+                if value != EMPTY_VALUE:
+                    values[raw_key] = value
+                    lru.put(raw_key, value)
+        return {keys[raw_key]: deserialize_image_file(value)
+                for raw_key, value in values.items()}
+
+
+class PostThumbnailBackend(ThumbnailBackend):
+    """Бэкенд sorl, умеющий вычислить миниатюру, не создавая её."""
+
+    def _options(self, source, options):
+        options = dict(options)
+        if thumbnail_settings.THUMBNAIL_PRESERVE_FORMAT:
+            options.setdefault('format', self._get_format(source))
+        for key, value in self.default_options.items():
+            options.setdefault(key, value)
+        for key, attr in self.extra_options:
+            value = getattr(thumbnail_settings, attr)
+            if value != getattr(default_settings, attr):
+                options.setdefault(key, value)
+        return options
+
+    def thumbnail_file(self, file_, geometry_string, **options):
+        """ImageFile с тем же именем, что построит ``get_thumbnail``."""
+        source = ImageFile(file_)
+        name = self._get_thumbnail_filename(
+            source, geometry_string, self._options(source, options))
+        return ImageFile(name, default.storage)
+
+    def get_thumbnail(self, file_, geometry_string, **options):
+        """Как в sorl, но параллельные запросы одной миниатюры склеиваются.
+
+        Не дождавшись чужого процесса, возвращает ещё не готовый файл:
+        имя у него уже окончательное.
+        """
+        thumbnail = self.thumbnail_file(file_, geometry_string, **options)
+        if default.kvstore.get(thumbnail):
+            return super().get_thumbnail(file_, geometry_string, **options)
+        with single_flight(f'thumbnail:{thumbnail.key}',
+                           settings.THUMBNAIL_LOCK_WAIT,
+                           settings.THUMBNAIL_LOCK_DIR) as flight:
+            record_flight(flight)
+            if flight.leader:
+                # дождавшийся процесс берёт то, что построил лидер
+                cached = flight.waited and default.kvstore.get(thumbnail)
+                return cached or super().get_thumbnail(
+                    file_, geometry_string, **options)
+        return thumbnail
+
+
+FLIGHT_COUNTERS = ('generated', 'coalesced', 'timed_out')
+
+
+def _counter_key(name):
+    return f'thumbnails:flight:{name}'
+
+
+def count(name):
+    key = _counter_key(name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def record_flight(flight):
+    """generated - строили сами, coalesced - дождались чужой результат,
+    timed_out - не дождались."""
+    if not flight.waited:
+        count('generated')
+    elif flight.leader:
+        count('coalesced')
+    else:
+        count('timed_out')
+
+
+def flight_counters():
+    values = cache.get_many([_counter_key(name) for name in FLIGHT_COUNTERS])
+    return {name: values.get(_counter_key(name), 0)
+            for name in FLIGHT_COUNTERS}
+
+
+def _failure_key(name):
+    digest = hashlib.md5(name.encode()).hexdigest()
+    return f'thumbnails:failed:{digest}'
+
+
+def record_failure(name):
+    """Запоминает неудачу сборки; возвращает паузу до повтора."""
+    key = _failure_key(name)
+    attempts = (cache.get(key) or {}).get('attempts', 0) + 1
+    delay = min(settings.THUMBNAIL_RETRY_DELAY * 2 ** (attempts - 1),
+                settings.THUMBNAIL_RETRY_MAX_DELAY)
+    # число попыток живёт дольше паузы, чтобы следующая была длиннее
+    cache.set(key, {'attempts': attempts, 'retry': time.time() + delay},
+              delay + settings.THUMBNAIL_RETRY_MAX_DELAY)
+    return delay
+
+
+def backing_off(names):
+    """Имена, сборка которых упала и повторять которую ещё рано."""
+    keys = {_failure_key(name): name for name in names}
+    now = time.time()
+    return {keys[key] for key, failure in cache.get_many(keys).items()
+            if failure['retry'] > now}
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.THUMBNAIL_WORKERS,
+            thread_name_prefix='thumbnails')
+    return _executor
+
+
+def build(name, force=False):
+    """Строит миниатюры и варианты картинки; возвращает затраченное CPU.
+
+    ``force`` сначала удаляет уже построенные миниатюры картинки.
+    """
+    started = time.process_time()
+    if force:
+        default.kvstore.delete_thumbnails(ImageFile(name))
+        forget(name)
+    for geometry, options in GEOMETRIES:
+        default.backend.get_thumbnail(name, geometry, **options)
+    save_variants(name)
+    return time.process_time() - started
+
+
+def generate(name):
+    """Строит миниатюры и варианты картинки; выполняется в фоновом потоке."""
+    try:
+        build(name)
+    except Exception:
+        delay = record_failure(name)
+        logger.exception('Не удалось построить миниатюры для %s, '
+                         'повтор не раньше чем через %d с', name, delay)
+    else:
+        cache.delete(_failure_key(name))
+    finally:
+        with _lock:
+            _pending.discard(name)
+        if settings.THUMBNAIL_WORKERS:
+            # соединение потока пула не должно висеть открытым
+            connection.close()
+
+
+def save_variants(name):
+    """Строит WebP/AVIF-варианты и записывает манифест в посты с картинкой."""
+    fallback = default.backend.get_thumbnail(
+        name, POST_GEOMETRY, **POST_OPTIONS)
+    # варианты одной картинки тоже строит один процесс; остальным
+    # ждать незачем: манифест получат все посты с этой картинкой
+    with single_flight(f'variants:{name}', 0,
+                       settings.THUMBNAIL_LOCK_DIR) as flight:
+        if not flight.leader:
+            count('coalesced')
+            return
+        count('generated')
+        manifest = variants.dumps(variants.build(name, fallback.name))
+    # save(), а не update(): сигнал сменит поколение лент с этим постом
+    for post in Post.objects.filter(image=name):
+        post.image_variants = manifest
+        post.save(update_fields=['image_variants'])
+
+
+def submit(name):
+    """Ставит картинку в очередь, если она ещё не в работе."""
+    if not name:
+        return
+    with _lock:
+        if name in _pending:
+            return
+        _pending.add(name)
+    if settings.THUMBNAIL_WORKERS:
+        _get_executor().submit(generate, name)
+    elif getattr(_deferred, 'names', None) is not None:
+        _deferred.names.append(name)
+    else:
+        generate(name)
+
+
+@receiver(request_started)
+def _defer_builds(**kwargs):
+    _deferred.names = []
+
+
+@receiver(request_finished)
+def _run_deferred(**kwargs):
+    names, _deferred.names = getattr(_deferred, 'names', None), None
+    for name in names or ():
+        generate(name)
+
+
+def schedule(name):
+    """Запускает подготовку миниатюр после коммита сохранения поста."""
+    transaction.on_commit(lambda: submit(name))
+
+
+def forget(*names):
+    """Убирает записи картинок и их миниатюр из LRU всех процессов."""
+    keys = []
+    for name in filter(None, names):
+        keys.append(add_prefix(ImageFile(name).key))
+        keys.extend(
+            add_prefix(default.backend.thumbnail_file(
+                name, geometry, **options).key)
+            for geometry, options in GEOMETRIES)
+    if not keys:
+        return
+    lru.discard(*keys)
+    before = _lru_generation()
+    after = cache.incr(LRU_GENERATION_KEY)
+    # поколение сдвинули только мы: свой LRU уже в порядке
+    if lru.generation == before and after == before + 1:
+        lru.generation = after
+
+
+def ready_thumbnails(images, geometry=POST_GEOMETRY, options=POST_OPTIONS):
+    """{имя картинки: готовая миниатюра} для пачки картинок.
+
+    Недостающие миниатюры ставятся в очередь.
+    """
+    files = {
+        image.name: default.backend.thumbnail_file(
+            image.name, geometry, **options)
+        for image in images if image
+    }
+    found = default.kvstore.get_many(files.values())
+    ready = {name: found[thumbnail.key]
+             for name, thumbnail in files.items() if thumbnail.key in found}
+    missing = files.keys() - ready.keys()
+    if missing:
+        for name in missing - backing_off(missing):
+            submit(name)
+    return ready
+
+
+def ready_thumbnail(image, geometry=POST_GEOMETRY, options=POST_OPTIONS):
+    """Готовая миниатюра или None; недостающая ставится в очередь."""
+    if not image:
+        return None
+    return ready_thumbnails([image], geometry, options).get(image.name)
@@ -0,0 +1,93 @@
+"""Адаптивные варианты картинки поста в WebP и AVIF.
+
+Варианты нескольких ширин строятся один раз, в той же фоновой задаче,
+что и миниатюра, и кладутся рядом с оригиналом. Их список (манифест)
+сохраняется в ``Post.image_variants``, так что шаблону для ``<picture>``
+и ``srcset`` не нужно ничего искать: всё берётся из самого поста.
+"""
+import json
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+# те же пропорции, что у миниатюры 960x339
+ASPECT = 339 / 960
+
+MIME_TYPES = {'AVIF': 'image/avif', 'WEBP': 'image/webp'}
+QUALITY = {'AVIF': 60, 'WEBP': 80}
+
+
+def formats():
+    """Форматы вариантов: AVIF, только если его умеет этот Pillow."""
+    Image.init()
+    return [fmt for fmt in ('AVIF', 'WEBP') if fmt in Image.SAVE]
+
+
+def variant_name(name, width, fmt):
+    root, _ = os.path.splitext(name)
+    return f'{root}.{width}w.{fmt.lower()}'
+
+
+def _save(name, image, fmt):
+    buffer = BytesIO()
+    image.save(buffer, fmt, quality=QUALITY[fmt])
+    # имя варианта вычисляется из оригинала: перестраиваем поверх
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def build(name, fallback):
+    """Строит варианты картинки ``name`` и возвращает манифест.
+
+    ``fallback`` - имя миниатюры sorl для ``<img>`` в старых браузерах.
+    """
+    with default_storage.open(name) as source:
+        original = Image.open(source)
+        original.load()
+    original = ImageOps.exif_transpose(original)
+    if original.mode not in ('RGB', 'RGBA'):
+        original = original.convert(
+            'RGBA' if 'transparency' in original.info else 'RGB')
+    sources = []
+    for fmt in formats():
+        files = []
+        for width in settings.POST_IMAGE_WIDTHS:
+            size = (width, round(width * ASPECT))
+            # как crop="center" upscale=True у миниатюры
+            image = ImageOps.fit(original, size, Image.LANCZOS)
+            files.append([_save(variant_name(name, width, fmt), image, fmt),
+                          width])
+        sources.append({'type': MIME_TYPES[fmt], 'files': files})
+    return {'src': fallback, 'sources': sources}
+
+
+def dumps(manifest):
+    return json.dumps(manifest, separators=(',', ':'))
+
+
+def picture(post):
+    """Данные для ``<picture>`` из манифеста поста или None."""
+    if not post.image or not post.image_variants:
+        return None
+    url = default_storage.url
+    try:
+        manifest = json.loads(post.image_variants)
+        return {
+            'src': url(manifest['src']),
+            'sources': [
+                {
+                    'type': source['type'],
+                    'srcset': ', '.join(f'{url(name)} {width}w'
+                                        for name, width in source['files']),
+                }
+                for source in manifest['sources']
+            ],
+        }
+    except (ValueError, TypeError, KeyError):
+        # битый манифест: шаблон покажет обычную миниатюру
+        return None
@@ -1,11 +1,18 @@
-from django.shortcuts import render, get_object_or_404
+from django.shortcuts import render
 from .models import Post, Group, Comment, Follow
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import Paginator
 from .forms import PostForm, CommentForm
 from django.shortcuts import redirect
 from .models import User
+from . import autocomplete, caching, export, membership
+from .feed import get_feed_page
+from .paginator import get_page
+from .search import search_page
+from .stats import get_stats
 from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from core import replicas
 
 
 # Главная страница
@@ -14,51 +21,99 @@ from django.conf import settings
 # @cache_page(20)
 def index(request):
     post_list = Post.objects.select_related('author', 'group').all()
-    paginator = Paginator(post_list, settings.TEN_SLICE)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = get_page(request, post_list)
     context = {
         'page_obj': page_obj,
+        **caching.listing_context(caching.INDEX),
     }
     template = 'posts/index.html'
     return render(request, template, context)
 
 
+def _existing(kind, queryset, **lookup):
+    """Объект по имени; заведомо несуществующее имя - 404 без БД."""
+    name, = lookup.values()
+    if not membership.may_exist(kind, name):
+        raise Http404
+    obj = queryset.filter(**lookup).first()
+    if obj is None and replicas.current():
+        # реплика могла отстать: отсутствие подтверждает основная база
+        obj = queryset.using('default').filter(**lookup).first()
+    if obj is None:
+        membership.remember_missing(kind, name)
+        raise Http404
+    return obj
+
+
 # Страница со сгруппированными постами
 def group_posts(request, slug):
-    group = get_object_or_404(Group, slug=slug)
+    group = _existing(membership.GROUP, Group.objects, slug=slug)
     post_list = group.posts.select_related('author', 'group').all()
-    paginator = Paginator(post_list, settings.TEN_SLICE)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = get_page(request, post_list)
     context = {
         'group': group,
-        'page_obj': page_obj
+        'page_obj': page_obj,
+        **caching.listing_context(caching.group_scope(group.pk)),
     }
     template = 'posts/group_list.html'
     return render(request, template, context)
 
 
 def profile(request, username):
-    author = User.objects.filter(username=username)[0]
+    author = _existing(membership.USER, User.objects.select_related('stats'),
+                       username=username)
     sameuser = 0
     posts = author.posts.select_related('author', 'group').all()
-    num_of_posts = posts.count()
-    paginator = Paginator(posts, settings.TEN_SLICE)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = get_page(request, posts)
     following = Follow.objects.filter(user=request.user.id, author=author)
     sameuser = author == request.user
     context = {
         'author': author,
-        'postsnum': num_of_posts,
+        'stats': get_stats(author),
         'page_obj': page_obj,
         'following': following,
-        'sameuser': sameuser
+        'sameuser': sameuser,
+        **caching.listing_context(caching.author_scope(author.pk)),
     }
     return render(request, 'posts/profile.html', context)
 
 
+def search(request):
+    query = request.GET.get('q', '').strip()
+    page_obj = search_page(query, request.GET.get('cursor'))
+    context = {
+        'query': query,
+        'page_obj': page_obj,
+    }
+    return render(request, 'posts/search.html', context)
+
+
+def autocomplete_names(request):
+    prefix = request.GET.get('q', '').strip()
+    try:
+        limit = min(max(int(request.GET.get('limit', 10)), 1), 20)
+    except ValueError:
+        limit = 10
+    results = autocomplete.complete(prefix, limit) if prefix else []
+    return JsonResponse({'results': results})
+
+
+@staff_member_required
+def export_data(request, name):
+    if name not in export.EXPORTS:
+        raise Http404
+    fmt = request.GET.get('format')
+    fmt = fmt if fmt in export.FORMATS else 'jsonl'
+    compress = bool(request.GET.get('gzip'))
+    response = StreamingHttpResponse(
+        export.stream(name, fmt, compress),
+        content_type='application/gzip' if compress else (
+            'text/csv' if fmt == 'csv' else 'application/x-ndjson'))
+    response['Content-Disposition'] = (
+        f'attachment; filename="{export.filename(name, fmt, compress)}"')
+    return response
+
+
 @login_required
 def post_create(request):
     groups = Group.objects.all()
@@ -76,10 +131,12 @@ def post_create(request):
 
 
 def post_detail(request, post_id):
-    post = Post.objects.select_related('author', 'group').filter(pk=post_id)[0]
-    comments = Comment.objects.filter(post=post_id)
-    author = User.objects.filter(username=post.author)[0]
-    num_of_posts = author.posts.all().count()
+    post = Post.objects.select_related(
+        'author__stats', 'group').filter(pk=post_id)[0]
+    comments = Comment.objects.select_related('author').filter(
+        post=post_id)
+    author = post.author
+    stats = get_stats(author)
     title = post.text[:30]
     if request.user == author:
         is_author = True
@@ -94,7 +151,7 @@ def post_detail(request, post_id):
         return render(request, 'posts/post_detail.html', {
             'form': form,
             'post': post,
-            'postsnum': num_of_posts,
+            'stats': stats,
             'title': title,
             'author': author,
             'is_author': is_author,
@@ -104,7 +161,7 @@ def post_detail(request, post_id):
     return render(request, 'posts/post_detail.html', {
         'form': form,
         'post': post,
-        'postsnum': num_of_posts,
+        'stats': stats,
         'title': title,
         'author': author,
         'is_author': is_author,
@@ -149,13 +206,9 @@ def add_comment(request, post_id):
 @login_required
 def follow_index(request):
     ''' информация о текущем пользователе доступна в request.user '''
-    followslst = Follow.objects.select_related(
-        'user', 'author').filter(user=request.user)
-    authors = followslst.values_list('author', flat=True)
-    posts_list = Post.objects.filter(author__in=authors)
-    paginator = Paginator(posts_list, settings.TEN_SLICE)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = get_feed_page(request.user, settings.TEN_SLICE,
+                             request.GET.get('cursor'),
+                             request.GET.get('page'))
     context = {
         'page_obj': page_obj,
     }
@@ -166,11 +219,9 @@ def follow_index(request):
 @login_required
 def profile_follow(request, username):
     author = User.objects.filter(username=username).first()
-    follower_name = request.user.username
-    follows = Follow.objects.filter(
-        user=request.user, author=author).count()
-    if follower_name != username and not follows:
-        Follow.objects.create(user=request.user, author=author)
+    if author is not None and author != request.user:
+        # уникальный индекс (user, author) защищает от гонки двух запросов
+        Follow.objects.get_or_create(user=request.user, author=author)
     return profile(request, username)
 
 
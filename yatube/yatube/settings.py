@@ -53,8 +53,12 @@ INSTALLED_APPS = [
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# куда gc_media переносит файлы, на которые ничто не ссылается
+MEDIA_QUARANTINE_ROOT = os.path.join(BASE_DIR, 'media_quarantine')
 
 MIDDLEWARE = [
+    'core.middleware.QueryBudgetMiddleware',
+    'core.replicas.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -93,9 +97,43 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # соединение переживает запрос: PRAGMA и кэш страниц не теряются
+        'CONN_MAX_AGE': 60,
     }
 }
 
+# Реплики только для чтения, например ['replica']: копии db.sqlite3, которые
+# обновляет manage.py sync_replicas (см. core.replicas)
+READ_REPLICAS = []
+for alias in READ_REPLICAS:
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'NAME': os.path.join(BASE_DIR, f'db-{alias}.sqlite3'),
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['core.replicas.ReplicaRouter']
+# страницы, которые при GET читают с реплики
+REPLICA_VIEWS = {
+    'posts:index',
+    'posts:group_list',
+    'posts:profile',
+    'posts:post_detail',
+}
+# после записи пользователь столько секунд читает только основную базу;
+# окно должно быть больше интервала sync_replicas
+REPLICA_STICKY_SECONDS = 15
+
+# PRAGMA для каждого нового соединения с SQLite (см. core.sqlite)
+SQLITE_PRAGMAS = {
+    'busy_timeout': 5000,
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 2 ** 20,
+    # отрицательное значение - в килобайтах: 64 МБ на соединение
+    'cache_size': -64000,
+    'temp_store': 'MEMORY',
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -117,11 +155,19 @@ AUTH_PASSWORD_VALIDATORS = [
 
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
 
+# Общий для всех воркеров хоста кэш в SQLite (WAL), без внешнего сервера
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'BACKEND': 'core.cache.SQLiteCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache.sqlite3'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+            'MAX_SIZE': 256 * 2 ** 20,
+        },
     }
 }
+# тесты работают с временной копией кэшей, а не с cache.sqlite3 сайта
+TEST_RUNNER = 'core.testing.TestRunner'
 
 # Internationalization
 # https://docs.djangoproject.com/en/2.2/topics/i18n/
@@ -147,3 +193,61 @@ LOGIN_REDIRECT_URL = 'posts:index'
 EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
 EMAIL_FILE_PATH = os.path.join(BASE_DIR, 'sent_emails')
 TEN_SLICE = 10
+# Авторы, у которых подписчиков больше порога, не раскладываются по лентам
+# при публикации: их посты подмешиваются в ленту при чтении
+FEED_PUSH_THRESHOLD = 5000
+# К раскладке автор возвращается, только когда подписчиков стало меньше
+# порога с этим множителем: на границе режим не переключается туда-обратно
+FEED_PUSH_RETURN_RATIO = 0.9
+# Время жизни кэша фрагментов лент; свежесть обеспечивают счётчики поколений
+LISTING_CACHE_TIMEOUT = 5 * 60
+# Карточки постов кэшируются по хэшу содержимого, поэтому TTL может быть долгим
+POSTCARD_CACHE_TIMEOUT = 24 * 60 * 60
+# Миниатюры картинок постов строятся фоновым пулом потоков сразу после
+# загрузки; 0 - строить синхронно (после коммита)
+THUMBNAIL_BACKEND = 'posts.thumbnails.PostThumbnailBackend'
+THUMBNAIL_KVSTORE = 'posts.thumbnails.PostKVStore'
+THUMBNAIL_WORKERS = 2
+# сколько найденных записей KV-хранилища sorl держать в памяти процесса
+THUMBNAIL_LRU_SIZE = 4096
+# одну миниатюру на хосте строит один процесс, остальные ждут до
+# THUMBNAIL_LOCK_WAIT секунд; None - каталог блокировок во временной папке
+THUMBNAIL_LOCK_WAIT = 5
+THUMBNAIL_LOCK_DIR = None
+# упавшая сборка миниатюр повторяется не раньше чем через столько секунд;
+# пауза удваивается с каждой неудачей до THUMBNAIL_RETRY_MAX_DELAY
+THUMBNAIL_RETRY_DELAY = 60
+THUMBNAIL_RETRY_MAX_DELAY = 24 * 60 * 60
+# ширины WebP/AVIF-вариантов картинки поста для srcset
+POST_IMAGE_WIDTHS = (320, 640, 960)
+
+# загрузки пишутся во временный файл, а не в память процесса
+FILE_UPLOAD_HANDLERS = [
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+# лимиты картинки поста и размер, до которого уменьшается оригинал
+POST_IMAGE_MAX_BYTES = 20 * 2 ** 20
+POST_IMAGE_MAX_PIXELS = 40 * 10 ** 6
+POST_IMAGE_MAX_SIDE = 2048
+
+# бюджеты SQL-запросов по view (см. core.middleware); превышение - ошибка
+# запроса при QUERY_BUDGET_ENFORCE (так в manage.py test), иначе
+# предупреждение в логе
+QUERY_BUDGET_MODULES = ('posts.query_budgets',)
+QUERY_BUDGET_ENFORCE = False
+
+# строка JSON на каждый запрос от core.middleware - в stderr
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'core.middleware': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}